@@ -1 +1,4 @@
+from deferred import Deferred
 from emmer import Emmer
+from rate_limit import RateLimit
+from response_router import map_file
@@ -0,0 +1,105 @@
+import logging
+import threading
+
+from clock import monotonic
+from rate_limit import TokenBucket
+from utility import lock
+
+
+class AdmissionController(object):
+    """An AdmissionController decides whether a request may start a new
+    conversation. It caps the amount of active conversations, the amount of
+    active conversations per client host, and the rate at which new
+    conversations are started. Requests over a cap are refused before any
+    application action runs, so that a flood of requests sheds load instead
+    of exhausting memory.
+
+    A limit of 0 disables that cap. Refused requests are answered with a
+    server busy error, or not at all if reject_silently is set.
+
+    Properties:
+        active_conversations: The amount of conversations in the conversation
+            table.
+        conversations_admitted: The amount of requests admitted.
+        rejected_for_total: The amount of requests refused because
+            max_conversations conversations were active.
+        rejected_for_host: The amount of requests refused because their
+            client host had max_conversations_per_host conversations active.
+        rejected_for_rate: The amount of requests refused because
+            max_new_per_second conversations had already been started.
+    """
+    def __init__(self, conversation_table, max_conversations=0,
+                 max_conversations_per_host=0, max_new_per_second=0,
+                 reject_silently=False):
+        """
+        Args:
+            conversation_table: The conversation table that new conversations
+                are added to.
+            max_conversations: How many conversations may be active at once.
+            max_conversations_per_host: How many conversations a single client
+                host may have active at once.
+            max_new_per_second: How many new conversations may be started per
+                second, on average. Up to a second's worth may start at once.
+            reject_silently: Whether refused requests are dropped without an
+                answer, leaving nothing for a spoofed source to amplify.
+        """
+        self.conversation_table = conversation_table
+        self.max_conversations = max_conversations
+        self.max_conversations_per_host = max_conversations_per_host
+        self.max_new_per_second = max_new_per_second
+        self.reject_silently = reject_silently
+        self.lock = threading.Lock()
+        self.new_conversation_bucket = None
+        if max_new_per_second:
+            self.new_conversation_bucket = TokenBucket(max_new_per_second)
+        self.conversations_admitted = 0
+        self.rejected_for_total = 0
+        self.rejected_for_host = 0
+        self.rejected_for_rate = 0
+
+    @property
+    def active_conversations(self):
+        return len(self.conversation_table)
+
+    @lock
+    def admit(self, client_host, client_port):
+        """Decides whether a request may start a new conversation, and
+        accounts for the decision. Retransmissions of a request that already
+        has a conversation are always admitted.
+
+        The caller should hold the conversation table's lock until the new
+        conversation has been added, so that concurrent requests cannot
+        overshoot the caps.
+
+        Args:
+            client_host: A hostname or ip address of the client.
+            client_port: The port from which the client is connecting.
+
+        Returns:
+            True if the request may start a new conversation.
+        """
+        if self.conversation_table.get_conversation(client_host, client_port):
+            return True
+        if (self.max_conversations
+                and len(self.conversation_table) >= self.max_conversations):
+            self.rejected_for_total += 1
+            return self._reject(client_host, client_port,
+                                "too many conversations")
+        if (self.max_conversations_per_host
+                and self.conversation_table.count_for_host(client_host)
+                >= self.max_conversations_per_host):
+            self.rejected_for_host += 1
+            return self._reject(client_host, client_port,
+                                "too many conversations for host")
+        if (self.new_conversation_bucket
+                and not self.new_conversation_bucket.take(1, monotonic())):
+            self.rejected_for_rate += 1
+            return self._reject(client_host, client_port,
+                                "too many new conversations")
+        self.conversations_admitted += 1
+        return True
+
+    def _reject(self, client_host, client_port, reason):
+        logging.debug("%s:%s: Request refused, %s"
+                      % (client_host, client_port, reason))
+        return False
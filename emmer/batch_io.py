@@ -0,0 +1,344 @@
+"""
+batch_io.py
+
+Implements sending and receiving of many UDP datagrams per system call.
+
+On Linux, a BatchIO uses the recvmmsg and sendmmsg system calls through
+ctypes, reusing preallocated message buffers between calls. Everywhere else,
+or with a batch size of 1, it falls back to one recvfrom or sendto call per
+datagram behind the same interface.
+
+A datagram to send may be given as a (header, payload) pair instead of a
+string. sendmmsg then gathers a large payload straight from its own memory,
+which may be a buffer into a memory mapped file, instead of from a copy.
+
+Only IPv4 sockets are supported, which is all that Emmer listens on.
+"""
+
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import socket
+import struct
+import sys
+
+# Flag for recvmmsg/sendmmsg to fail with EAGAIN instead of blocking
+MSG_DONTWAIT = 0x40
+
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p),
+                ("iov_len", ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p),
+                ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.c_void_p),
+                ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p),
+                ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _MsgHdr),
+                ("msg_len", ctypes.c_uint)]
+
+
+# struct sockaddr_in: family in host order, then port and address in network
+# order, padded to 16 bytes
+_SOCKADDR_IN = struct.Struct("=H2s4s8x")
+
+# A pair of struct iovecs, the header and the payload of a datagram, for
+# filling in many of them with a single copy
+_IOVEC_PAIR = struct.Struct("@PPPP")
+
+# The msg_len field of struct mmsghdr, read out of an array of them
+_MSG_LEN = struct.Struct("@I")
+
+# How many distinct addresses to remember the encoding of
+_ADDRESS_CACHE_SIZE = 4096
+
+
+def _load_libc():
+    """Returns the C library if it offers recvmmsg and sendmmsg, otherwise
+    None.
+    """
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr),
+                                  ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+        libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr),
+                                  ctypes.c_uint, ctypes.c_int]
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+
+_libc = _load_libc()
+
+# Finds the memory of any object with the buffer interface, such as strings
+# and buffers. Called without argtypes, which is about twice as fast.
+_as_read_buffer = ctypes.pythonapi.PyObject_AsReadBuffer
+
+# Payloads smaller than this many bytes are copied into the send buffer along
+# with their header, which is cheaper than looking up where they are
+MIN_GATHERED_PAYLOAD_SIZE = 4096
+
+BATCH_SYSCALLS_AVAILABLE = _libc is not None
+
+
+class BatchIO(object):
+    """A BatchIO receives and sends batches of datagrams on UDP sockets. The
+    sockets should be non-blocking.
+
+    A BatchIO reuses its buffers between calls, so each thread that does
+    batched I/O should have its own.
+    """
+    def __init__(self, batch_size, buffer_size=65536):
+        """
+        Args:
+            batch_size: The maximum amount of datagrams to receive or send per
+                system call.
+            buffer_size: The maximum size of a received datagram.
+        """
+        self.batch_size = batch_size
+        self.buffer_size = buffer_size
+        self.use_syscalls = BATCH_SYSCALLS_AVAILABLE and batch_size > 1
+        self.encoded_addresses = {}
+        self.decoded_addresses = {}
+        if self.use_syscalls:
+            self._allocate()
+
+    def _allocate(self):
+        """Preallocates the buffers and message headers used by recvmmsg and
+        sendmmsg. Receiving and sending each get their own. Every message
+        header permanently points at its slot of the buffers, so that a
+        batch is set up by copying into the buffers only. A sent message
+        gathers two iovecs: its header, copied into the send buffer, and its
+        payload, which is left where it is.
+        """
+        self.recv_buffer = ctypes.create_string_buffer(
+            self.buffer_size * self.batch_size)
+        self.recv_iovecs = (_IOVec * self.batch_size)()
+        self.recv_addresses = ctypes.create_string_buffer(
+            _SOCKADDR_IN.size * self.batch_size)
+        self.recv_messages = (_MMsgHdr * self.batch_size)()
+        self.send_buffer = ctypes.create_string_buffer(
+            self.buffer_size * self.batch_size)
+        self.send_iovecs = (_IOVec * (2 * self.batch_size))()
+        self.send_addresses = ctypes.create_string_buffer(
+            _SOCKADDR_IN.size * self.batch_size)
+        self.send_messages = (_MMsgHdr * self.batch_size)()
+        self.payload_address = ctypes.c_void_p()
+        self.payload_address_ref = ctypes.byref(self.payload_address)
+        self.payload_length = ctypes.c_ssize_t()
+        self.payload_length_ref = ctypes.byref(self.payload_length)
+        recv_buffer = ctypes.addressof(self.recv_buffer)
+        for i in xrange(self.batch_size):
+            self.recv_iovecs[i].iov_base = recv_buffer + i * self.buffer_size
+            self.recv_iovecs[i].iov_len = self.buffer_size
+            for messages, iovecs, addresses, iovec_count in (
+                    (self.recv_messages, self.recv_iovecs,
+                     self.recv_addresses, 1),
+                    (self.send_messages, self.send_iovecs,
+                     self.send_addresses, 2)):
+                header = messages[i].msg_hdr
+                header.msg_name = (ctypes.addressof(addresses)
+                                   + i * _SOCKADDR_IN.size)
+                header.msg_namelen = _SOCKADDR_IN.size
+                header.msg_iov = ctypes.addressof(iovecs[i * iovec_count])
+                header.msg_iovlen = iovec_count
+
+    def recv(self, sock):
+        """Receives the datagrams waiting on a socket, up to batch_size.
+
+        Args:
+            sock: A non-blocking UDP socket.
+
+        Returns:
+            A list of (data, (host, port)) tuples. Empty if no datagram was
+            waiting.
+        """
+        if not self.use_syscalls:
+            return self._recv_fallback(sock)
+        count = _libc.recvmmsg(sock.fileno(), self.recv_messages,
+                               self.batch_size, MSG_DONTWAIT, None)
+        if count < 0:
+            self._raise_unless_would_block()
+            return []
+        recv_buffer = ctypes.addressof(self.recv_buffer)
+        addresses = ctypes.string_at(self.recv_addresses,
+                                     _SOCKADDR_IN.size * count)
+        messages = ctypes.string_at(self.recv_messages,
+                                    ctypes.sizeof(_MMsgHdr) * count)
+        received = []
+        for i in xrange(count):
+            length, = _MSG_LEN.unpack_from(
+                messages, i * ctypes.sizeof(_MMsgHdr) + _MMsgHdr.msg_len.offset)
+            data = ctypes.string_at(recv_buffer + i * self.buffer_size, length)
+            encoded_address = addresses[i * _SOCKADDR_IN.size:
+                                        (i + 1) * _SOCKADDR_IN.size]
+            received.append((data, self._decode_address(encoded_address)))
+        return received
+
+    def _decode_address(self, encoded_address):
+        """Returns the (host, port) tuple for a struct sockaddr_in."""
+        addr = self.decoded_addresses.get(encoded_address)
+        if addr is None:
+            _, port, host = _SOCKADDR_IN.unpack(encoded_address)
+            addr = (socket.inet_ntoa(host), struct.unpack("!H", port)[0])
+            if len(self.decoded_addresses) >= _ADDRESS_CACHE_SIZE:
+                self.decoded_addresses.clear()
+            self.decoded_addresses[encoded_address] = addr
+        return addr
+
+    def _encode_address(self, addr):
+        """Returns the struct sockaddr_in for a (host, port) tuple."""
+        encoded_address = self.encoded_addresses.get(addr)
+        if encoded_address is None:
+            host, port = addr
+            encoded_address = _SOCKADDR_IN.pack(
+                socket.AF_INET, struct.pack("!H", port),
+                socket.inet_aton(host))
+            if len(self.encoded_addresses) >= _ADDRESS_CACHE_SIZE:
+                self.encoded_addresses.clear()
+            self.encoded_addresses[addr] = encoded_address
+        return encoded_address
+
+    def _recv_fallback(self, sock):
+        """Receives datagrams with one recvfrom call each."""
+        received = []
+        while len(received) < self.batch_size:
+            try:
+                received.append(sock.recvfrom(self.buffer_size))
+            except socket.error as ex:
+                if ex.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+        return received
+
+    def send(self, sock, datagrams):
+        """Sends datagrams from a socket, batch_size of them per system call.
+        If the socket's send buffer fills up, the remaining datagrams are
+        dropped, as UDP would; TFTP retransmission recovers from that. A
+        datagram that cannot be sent for any other reason is logged and
+        skipped, without affecting the rest of the batch.
+
+        Args:
+            sock: A UDP socket.
+            datagrams: A list of (data, (host, port)) tuples. The data is a
+                string, or a (header, payload) pair of a string and any
+                object with the buffer interface.
+
+        Returns:
+            The amount of datagrams sent.
+        """
+        if not self.use_syscalls:
+            return self._send_fallback(sock, datagrams)
+        sent = 0
+        position = 0
+        while position < len(datagrams):
+            batch = datagrams[position:position + self.batch_size]
+            self._fill_send_buffers(batch)
+            count = _libc.sendmmsg(sock.fileno(), self.send_messages,
+                                   len(batch), MSG_DONTWAIT)
+            if count < 0:
+                error = ctypes.get_errno()
+                if error in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                self._log_failed(datagrams[position][1],
+                                 os.strerror(error))
+                position += 1
+                continue
+            sent += count
+            position += count
+        self._log_dropped(len(datagrams) - position)
+        return sent
+
+    def _fill_send_buffers(self, batch):
+        """Copies a batch of datagrams into the send buffer, apart from their
+        large payloads, and their lengths, offsets, payload locations and
+        addresses into the message headers.
+        """
+        copied = []
+        copied_lengths = []
+        gathered = []
+        for data, _ in batch:
+            if isinstance(data, tuple):
+                header, payload = data
+                if len(payload) < MIN_GATHERED_PAYLOAD_SIZE:
+                    copied.append(header)
+                    copied.append(str(payload))
+                    copied_lengths.append(len(header) + len(payload))
+                    gathered.append(None)
+                else:
+                    copied.append(header)
+                    copied_lengths.append(len(header))
+                    gathered.append(payload)
+            else:
+                copied.append(data)
+                copied_lengths.append(len(data))
+                gathered.append(None)
+        joined = "".join(copied)
+        if len(joined) > ctypes.sizeof(self.send_buffer):
+            self.send_buffer = ctypes.create_string_buffer(len(joined))
+        ctypes.memmove(self.send_buffer, joined, len(joined))
+        offset = ctypes.addressof(self.send_buffer)
+        iovecs = []
+        for length, payload in zip(copied_lengths, gathered):
+            if payload is None:
+                iovecs.append(_IOVEC_PAIR.pack(offset, length, 0, 0))
+            else:
+                _as_read_buffer(ctypes.py_object(payload),
+                                self.payload_address_ref,
+                                self.payload_length_ref)
+                iovecs.append(_IOVEC_PAIR.pack(offset, length,
+                                               self.payload_address.value,
+                                               self.payload_length.value))
+            offset += length
+        ctypes.memmove(self.send_iovecs, "".join(iovecs),
+                       _IOVEC_PAIR.size * len(batch))
+        addresses = "".join([self._encode_address(addr)
+                             for _, addr in batch])
+        ctypes.memmove(self.send_addresses, addresses, len(addresses))
+
+    def _send_fallback(self, sock, datagrams):
+        """Sends datagrams with one sendto call each."""
+        sent = 0
+        position = 0
+        for data, addr in datagrams:
+            if isinstance(data, tuple):
+                data = data[0] + str(data[1])
+            try:
+                sock.sendto(data, addr)
+                sent += 1
+            except socket.error as ex:
+                if ex.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                self._log_failed(addr, ex)
+            position += 1
+        self._log_dropped(len(datagrams) - position)
+        return sent
+
+    def _log_dropped(self, dropped):
+        if dropped:
+            logging.warn("Send buffer full, dropped %s datagrams" % dropped)
+
+    def _log_failed(self, addr, reason):
+        logging.warn("%s:%s: Failed to send datagram: %s"
+                     % (addr[0], addr[1], reason))
+
+    def _raise_unless_would_block(self):
+        """Raises the error of a failed system call, unless the call failed
+        only because it would have blocked.
+        """
+        error = ctypes.get_errno()
+        if error not in (errno.EAGAIN, errno.EWOULDBLOCK):
+            raise socket.error(error, "%s" % errno.errorcode.get(error))
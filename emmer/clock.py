@@ -0,0 +1,57 @@
+"""
+clock.py
+
+Provides a monotonic clock for timeouts, deadlines and rate limits, which
+unlike time.time never jumps when the wall clock is changed.
+
+On Linux, and other platforms whose C library offers clock_gettime, the clock
+is read through ctypes. Everywhere else it falls back to time.time.
+"""
+
+
+import ctypes
+import ctypes.util
+import sys
+import time
+
+# The clock id of CLOCK_MONOTONIC on Linux
+CLOCK_MONOTONIC = 1
+
+
+class _TimeSpec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long),
+                ("tv_nsec", ctypes.c_long)]
+
+
+def _load_clock_gettime():
+    """Returns the C library's clock_gettime function, or None if it is not
+    available.
+    """
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        clock_gettime = libc.clock_gettime
+    except (OSError, AttributeError):
+        return None
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_TimeSpec)]
+    if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(_TimeSpec())) != 0:
+        return None
+    return clock_gettime
+
+
+_clock_gettime = _load_clock_gettime()
+
+MONOTONIC_CLOCK_AVAILABLE = _clock_gettime is not None
+
+
+def monotonic():
+    """Returns the seconds elapsed since an arbitrary point in the past, with
+    sub-millisecond resolution. Only differences between two readings are
+    meaningful.
+    """
+    if _clock_gettime is None:
+        return time.time()
+    timespec = _TimeSpec()
+    _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(timespec))
+    return timespec.tv_sec + timespec.tv_nsec * 1e-9
@@ -7,15 +7,92 @@
 HOST = "127.0.0.1"
 PORT = 3942
 
-# How many seconds to wait before resending a non acked packet.
+# How many seconds to wait before resending a non acked packet, until the
+# round trip time to the client has been measured. From then on, the wait
+# adapts to the measured round trip time, staying between
+# MIN_RESEND_TIMEOUT and MAX_RESEND_TIMEOUT, and doubles with every resend.
+# Clients may ask for a fixed wait with the timeout option of RFC 2349.
 RESEND_TIMEOUT = 5
+MIN_RESEND_TIMEOUT = 0.2
+MAX_RESEND_TIMEOUT = 10
 
 # How many times to retry sending a non acked packet before giving up.
 RETRIES_BEFORE_GIVEUP = 6
 
+# Whether every transfer is answered from its own ephemeral port, its
+# transfer ID as RFC 1350 specifies, instead of from the listening port.
+PER_TRANSFER_SOCKETS = False
+
+# The largest block size, in bytes, that clients may negotiate with the
+# blksize option of RFC 2348. Requests for larger blocks are granted this
+# size. At most 65464.
+MAX_BLOCK_SIZE = 65464
+
+# The largest window, in blocks, that clients may negotiate with the
+# windowsize option of RFC 7440 when reading. The server then sends that
+# many blocks before waiting for an acknowledgement. At most 65535.
+MAX_WINDOW_SIZE = 64
+
+# The block number that follows 65535 in transfers of more than 65535 blocks,
+# such as a 100 MB image at 512 byte blocks. Most clients roll over to 0,
+# some to 1.
+BLOCK_ROLLOVER = 0
+
+# Admission control for new conversations. Requests beyond these caps are
+# answered with a server busy error, or dropped if REJECT_SILENTLY is set,
+# before any action runs. Set a cap to 0 for no limit, the default.
+MAX_CONVERSATIONS = 0
+MAX_CONVERSATIONS_PER_HOST = 0
+MAX_NEW_CONVERSATIONS_PER_SECOND = 0
+REJECT_SILENTLY = False
+
+# Token bucket limits on the DATA packets sent, in bytes and in packets per
+# second, across all clients (GLOBAL_) and to each client host (HOST_).
+# Routes may override the per host limits. Throttled packets are sent late
+# rather than dropped. Set a limit to 0 for no limit.
+GLOBAL_BYTES_PER_SECOND = 0
+GLOBAL_PACKETS_PER_SECOND = 0
+HOST_BYTES_PER_SECOND = 0
+HOST_PACKETS_PER_SECOND = 0
+
 #################################
 # Internal Tuning Configuration #
 #################################
 
-# How often the daemon thread should sweep through
+# How often the daemon thread should sweep through. Resends happen up to
+# this many seconds after their timeout.
 PERFORMER_THREAD_INTERVAL = 1
+
+# How many workers run application actions. Set to 0, the default, to run
+# actions on the thread that handles the request instead.
+ACTION_WORKERS = 0
+
+# Whether the action workers are processes instead of threads. Actions must
+# then be module level functions, and their results must be picklable.
+ACTION_WORKERS_ARE_PROCESSES = False
+
+# How many actions may wait for a free worker. Requests beyond that are
+# answered with a server busy error. Set to 0, the default, for no limit.
+ACTION_QUEUE_SIZE = 0
+
+# How many bytes of an upload to a spooling write route are kept in memory
+# before the upload is moved to a temporary file.
+WRITE_SPOOL_SIZE = 1 << 20
+
+# How many bytes of read action results may be cached, for routes that ask
+# for caching. The least recently used results are dropped beyond that.
+RESPONSE_CACHE_SIZE = 64 << 20
+
+# How many independently locked shards the conversation table is split
+# into, so that threads handling different clients rarely wait on each other.
+CONVERSATION_TABLE_SHARDS = 16
+
+# How many seconds a finished conversation lingers after it is retired, to
+# acknowledge again a client that repeats its final DATA packet because the
+# acknowledgement was lost. Set to 0 to forget finished conversations at once.
+TOMBSTONE_LIFETIME = 5
+
+# How many datagrams the event loop and the performer receive or send per
+# system call, using recvmmsg and sendmmsg where available. Set to 1 for a
+# system call per datagram.
+BATCH_SIZE = 32
@@ -1,5 +1,8 @@
+import functools
 import threading
 
+from clock import monotonic
+from scheduler import TimerHeap
 from utility import lock
 
 
@@ -18,9 +21,11 @@ def check_for_conversation_existence(alternate_return_value):
         exist.
     """
     def decorator_outer(function):
-        def decorator_inner(self, client_host, client_port, *args):
+        @functools.wraps(function)
+        def decorator_inner(self, client_host, client_port, *args, **kwargs):
             if (client_host, client_port) in self.conversation_table:
-                return function(self, client_host, client_port, *args)
+                return function(self, client_host, client_port, *args,
+                                **kwargs)
             else:
                 return alternate_return_value
 
@@ -35,10 +40,31 @@ class ConversationTable(object):
     against the same ConversationTable.
 
     (client host, client port) => conversation
+
+    Also keeps count of the conversations of every client host, for admission
+    control, and when each conversation is next due to be checked for
+    timeouts and completion, so that the Performer never has to scan the
+    whole table. New conversations are due right away.
+
+    Completed conversations are retired to tombstones, which linger for a
+    while to answer late duplicates of a transfer's final packets. Tombstones
+    count neither towards the length of the table nor towards admission
+    control.
     """
-    def __init__(self):
+    def __init__(self, tombstone_lifetime=0):
+        """
+        Args:
+            tombstone_lifetime: How many seconds a retired conversation
+                lingers as a tombstone. If 0, retired conversations are
+                dropped right away.
+        """
         self.conversation_table = {}
+        self.checks = TimerHeap()
+        self.host_counts = {}
         self.lock = threading.RLock()
+        self.tombstone_expiries = TimerHeap()
+        self.tombstone_lifetime = tombstone_lifetime
+        self.tombstones = {}
 
     @lock
     def add_conversation(self, client_host, client_port, conversation):
@@ -50,7 +76,13 @@ class ConversationTable(object):
             client_port: The port from which the client is connecting.
             conversation: An already created TFTPConversation object.
         """
-        self.conversation_table[(client_host, client_port)] = conversation
+        # A single key tuple is shared by the table and the deadline heap
+        key = (client_host, client_port)
+        if key not in self.conversation_table:
+            self.host_counts[client_host] = (
+                self.host_counts.get(client_host, 0) + 1)
+        self.conversation_table[key] = conversation
+        self.checks.schedule(key, monotonic())
 
     @lock
     @check_for_conversation_existence(None)
@@ -83,13 +115,115 @@ class ConversationTable(object):
             True on success. False if there didn't exist a TFTPConversation.
         """
         del self.conversation_table[(client_host, client_port)]
+        self.checks.cancel((client_host, client_port))
+        count = self.host_counts.get(client_host, 0) - 1
+        if count > 0:
+            self.host_counts[client_host] = count
+        else:
+            self.host_counts.pop(client_host, None)
+        return True
+
+    @lock
+    @check_for_conversation_existence(False)
+    def retire_conversation(self, client_host, client_port):
+        """Given a client hostname and port, deletes the corresponding
+        TFTPConversation and keeps it as a tombstone for the tombstone
+        lifetime, replacing any older tombstone of the client.
+
+        Args:
+            client_host: A hostname or ip address of the client.
+            client_port: The port from which the client is connecting.
+
+        Returns:
+            True on success. False if there didn't exist a TFTPConversation.
+        """
+        conversation = self.conversation_table[(client_host, client_port)]
+        self.delete_conversation(client_host, client_port)
+        if self.tombstone_lifetime > 0:
+            self.tombstones[(client_host, client_port)] = conversation
+            self.tombstone_expiries.schedule(
+                (client_host, client_port),
+                monotonic() + self.tombstone_lifetime)
+        return True
+
+    @lock
+    def get_tombstone(self, client_host, client_port):
+        """Given a client hostname and port, looks up the tombstone of the
+        client's most recently retired TFTPConversation.
+
+        Args:
+            client_host: A hostname or ip address of the client.
+            client_port: The port from which the client is connecting.
+
+        Returns:
+            A retired TFTPConversation. None if the client has no tombstone.
+        """
+        return self.tombstones.get((client_host, client_port))
+
+    @lock
+    def expire_tombstones(self, now=None):
+        """Forgets the tombstones that have outlived the tombstone lifetime.
+
+        Args:
+            now: The current time on the monotonic clock. If None, the clock
+                is read.
+        """
+        for key in self.tombstone_expiries.pop_due(now):
+            del self.tombstones[key]
+
+    @lock
+    def count_for_host(self, client_host):
+        """Returns the number of conversations with the given client host.
+
+        Args:
+            client_host: A hostname or ip address of the client.
+        """
+        return self.host_counts.get(client_host, 0)
+
+    @lock
+    @check_for_conversation_existence(False)
+    def schedule_check(self, client_host, client_port, deadline=None):
+        """Sets when a conversation is next due to be checked, replacing any
+        earlier or later time it was due.
+
+        Args:
+            client_host: A hostname or ip address of the client.
+            client_port: The port from which the client is connecting.
+            deadline: The time on the monotonic clock when the conversation
+                is due. If None, it is due right away.
+
+        Returns:
+            True on success. False if there didn't exist a TFTPConversation.
+        """
+        if deadline is None:
+            deadline = monotonic()
+        self.checks.schedule((client_host, client_port), deadline)
         return True
 
+    @lock
+    def pop_due_checks(self, now=None):
+        """Returns the (client host, client port) of every conversation that
+        is due to be checked, earliest first. A conversation is not due again
+        until it is rescheduled with schedule_check.
+
+        Args:
+            now: The current time on the monotonic clock. If None, the clock
+                is read.
+        """
+        return self.checks.pop_due(now)
+
     @property
     def conversations(self):
         """Returns a list of all conversations currently stored"""
         return self.conversation_table.values()
 
+    @property
+    def shards(self):
+        """Returns the tables that make up this table, each guarded by its
+        own lock. A ConversationTable is its own single shard.
+        """
+        return [self]
+
     def __len__(self):
         """Returns the number of conversations in the ConversationTable"""
         return len(self.conversation_table)
@@ -97,3 +231,111 @@ class ConversationTable(object):
     def __str__(self):
         """Returns a human readable form of the ConversationTable"""
         return str(self.conversation_table)
+
+
+class ShardedConversationTable(object):
+    """Spreads conversations over independent ConversationTables, its shards,
+    by a hash of the client address. Each shard has its own lock, so threads
+    working on different conversations rarely wait on each other, and the
+    Performer checks one shard at a time instead of locking out every
+    lookup for a whole pass.
+
+    Offers the same interface as a ConversationTable. Its lock only
+    serializes the creation of conversations, so that admission control
+    sees consistent counts; lookups and deletions take nothing but their
+    shard's lock.
+    """
+    def __init__(self, shard_count=16, tombstone_lifetime=0):
+        """
+        Args:
+            shard_count: The amount of shards.
+            tombstone_lifetime: How many seconds a retired conversation
+                lingers as a tombstone. If 0, retired conversations are
+                dropped right away.
+        """
+        self.shards = [ConversationTable(tombstone_lifetime)
+                       for _ in xrange(shard_count)]
+        self.lock = threading.RLock()
+
+    def shard_for(self, client_host, client_port):
+        """Returns the shard that holds the conversation of a client.
+
+        Args:
+            client_host: A hostname or ip address of the client.
+            client_port: The port from which the client is connecting.
+        """
+        return self.shards[hash((client_host, client_port))
+                           % len(self.shards)]
+
+    def add_conversation(self, client_host, client_port, conversation):
+        """See ConversationTable.add_conversation."""
+        self.shard_for(client_host, client_port).add_conversation(
+            client_host, client_port, conversation)
+
+    def get_conversation(self, client_host, client_port):
+        """See ConversationTable.get_conversation."""
+        return self.shard_for(client_host, client_port).get_conversation(
+            client_host, client_port)
+
+    def delete_conversation(self, client_host, client_port):
+        """See ConversationTable.delete_conversation."""
+        return self.shard_for(client_host, client_port).delete_conversation(
+            client_host, client_port)
+
+    def retire_conversation(self, client_host, client_port):
+        """See ConversationTable.retire_conversation."""
+        return self.shard_for(client_host, client_port).retire_conversation(
+            client_host, client_port)
+
+    def get_tombstone(self, client_host, client_port):
+        """See ConversationTable.get_tombstone."""
+        return self.shard_for(client_host, client_port).get_tombstone(
+            client_host, client_port)
+
+    def expire_tombstones(self, now=None):
+        """Forgets the tombstones of every shard that have outlived the
+        tombstone lifetime. See ConversationTable.expire_tombstones.
+        """
+        for shard in self.shards:
+            shard.expire_tombstones(now)
+
+    def schedule_check(self, client_host, client_port, deadline=None):
+        """See ConversationTable.schedule_check."""
+        return self.shard_for(client_host, client_port).schedule_check(
+            client_host, client_port, deadline)
+
+    def pop_due_checks(self, now=None):
+        """Returns the (client host, client port) of every conversation that
+        is due to be checked, shard by shard. See
+        ConversationTable.pop_due_checks.
+        """
+        due = []
+        for shard in self.shards:
+            due.extend(shard.pop_due_checks(now))
+        return due
+
+    def count_for_host(self, client_host):
+        """Returns the number of conversations with the given client host,
+        across all shards.
+
+        Args:
+            client_host: A hostname or ip address of the client.
+        """
+        return sum(shard.count_for_host(client_host)
+                   for shard in self.shards)
+
+    @property
+    def conversations(self):
+        """Returns a list of all conversations currently stored"""
+        conversations = []
+        for shard in self.shards:
+            conversations.extend(shard.conversations)
+        return conversations
+
+    def __len__(self):
+        """Returns the number of conversations in all shards"""
+        return sum(len(shard) for shard in self.shards)
+
+    def __str__(self):
+        """Returns a human readable form of the ShardedConversationTable"""
+        return "\n".join(str(shard) for shard in self.shards)
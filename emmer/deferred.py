@@ -0,0 +1,104 @@
+import logging
+import threading
+
+
+class Deferred(object):
+    """A Deferred stands in for the result of an application action that is
+    not available yet, such as a lookup against a slow backend. An action may
+    return a Deferred instead of its result. The conversation waiting on it
+    then holds no thread while the lookup is outstanding.
+
+    Whoever produces the result completes the Deferred exactly once by calling
+    either resolve or fail. This is safe to do from any thread.
+
+    Properties:
+        completed: Whether resolve or fail has been called.
+        result: The value given to resolve.
+        error: The exception given to fail. None if the Deferred resolved.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.callbacks = []
+        self.completed = False
+        self.result = None
+        self.error = None
+
+    def resolve(self, result):
+        """Completes the Deferred successfully. If the result is itself a
+        Deferred, this Deferred completes with its outcome once it completes.
+
+        Args:
+            result: The result of the action.
+        """
+        if isinstance(result, Deferred):
+            result.add_callback(self._adopt)
+            return
+        self._complete(result, None)
+
+    def fail(self, error):
+        """Completes the Deferred unsuccessfully.
+
+        Args:
+            error: An exception describing why the action failed.
+        """
+        self._complete(None, error)
+
+    def add_callback(self, callback):
+        """Registers a function to run once the Deferred completes. If it has
+        already completed, the function runs immediately.
+
+        Args:
+            callback: A function taking this Deferred as its only argument.
+        """
+        self.lock.acquire()
+        completed = self.completed
+        if not completed:
+            self.callbacks.append(callback)
+        self.lock.release()
+        if completed:
+            callback(self)
+
+    def then(self, function):
+        """Returns a new Deferred that resolves with the result of applying
+        the given function to this Deferred's result. Failures, including
+        exceptions raised by the function, carry over to the new Deferred.
+
+        Args:
+            function: A function taking the result of this Deferred.
+        """
+        chained = Deferred()
+
+        def callback(deferred):
+            if deferred.error is not None:
+                chained.fail(deferred.error)
+                return
+            try:
+                chained.resolve(function(deferred.result))
+            except Exception as ex:
+                chained.fail(ex)
+
+        self.add_callback(callback)
+        return chained
+
+    def _adopt(self, deferred):
+        """Completes this Deferred with the outcome of another one."""
+        self._complete(deferred.result, deferred.error)
+
+    def _complete(self, result, error):
+        """Stores the outcome and runs all registered callbacks."""
+        self.lock.acquire()
+        if self.completed:
+            self.lock.release()
+            logging.warn("Deferred completed more than once")
+            return
+        self.completed = True
+        self.result = result
+        self.error = error
+        callbacks = self.callbacks
+        self.callbacks = []
+        self.lock.release()
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                logging.exception("Deferred callback %s failed" % callback)
@@ -2,10 +2,19 @@ import socket
 import thread
 
 import config
-from conversation_table import ConversationTable
-from reactor import Reactor
+from admission import AdmissionController
+from conversation_table import ShardedConversationTable
+from reactor import EventLoopReactor, Reactor
+from response_cache import ResponseCache
 from response_router import ResponseRouter
 from performer import Performer
+from rate_limit import RateLimit, RateLimiter
+from supervisor import Supervisor
+from worker_pool import ProcessWorkerPool, WorkerPool
+
+# Older Python 2 builds do not expose SO_REUSEPORT. This is its value on
+# Linux.
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", 15)
 
 
 class Emmer(object):
@@ -15,16 +24,65 @@ class Emmer(object):
     def __init__(self):
         self.host = config.HOST
         self.port = config.PORT
-        self.response_router = ResponseRouter()
-        self.conversation_table = ConversationTable()
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.action_pool = self._create_action_pool()
+        self.response_cache = ResponseCache(config.RESPONSE_CACHE_SIZE)
+        self.response_router = ResponseRouter(self.action_pool,
+                                              config.WRITE_SPOOL_SIZE,
+                                              self.response_cache)
+        self._create_services(socket.socket(socket.AF_INET, socket.SOCK_DGRAM),
+                              config.PER_TRANSFER_SOCKETS)
+
+    def _create_services(self, sock, per_transfer_sockets):
+        """Creates the services that belong to a single serving process: the
+        conversation table, and the admission controller, rate limiter,
+        reactor and performer operating on it.
+
+        Args:
+            sock: The socket to listen for requests on.
+            per_transfer_sockets: Whether each conversation is answered from
+                its own ephemeral socket rather than the listening socket.
+        """
+        self.sock = sock
+        self.per_transfer_sockets = per_transfer_sockets
+        self.conversation_table = ShardedConversationTable(
+            config.CONVERSATION_TABLE_SHARDS, config.TOMBSTONE_LIFETIME)
+        self.admission_controller = AdmissionController(
+            self.conversation_table, config.MAX_CONVERSATIONS,
+            config.MAX_CONVERSATIONS_PER_HOST,
+            config.MAX_NEW_CONVERSATIONS_PER_SECOND, config.REJECT_SILENTLY)
+        self.rate_limiter = RateLimiter(
+            RateLimit(config.GLOBAL_BYTES_PER_SECOND,
+                      config.GLOBAL_PACKETS_PER_SECOND),
+            RateLimit(config.HOST_BYTES_PER_SECOND,
+                      config.HOST_PACKETS_PER_SECOND))
         self.reactor = Reactor(self.sock, self.response_router,
-                               self.conversation_table)
+                               self.conversation_table, per_transfer_sockets,
+                               self.admission_controller, self.rate_limiter,
+                               config.MAX_BLOCK_SIZE, config.MAX_WINDOW_SIZE,
+                               config.BLOCK_ROLLOVER)
         self.performer = Performer(self.sock, self.conversation_table,
                                    config.RESEND_TIMEOUT,
-                                   config.RETRIES_BEFORE_GIVEUP)
+                                   config.RETRIES_BEFORE_GIVEUP,
+                                   config.BATCH_SIZE,
+                                   config.MIN_RESEND_TIMEOUT,
+                                   config.MAX_RESEND_TIMEOUT)
+
+    def _create_action_pool(self):
+        """Creates the pool that application actions run on, as configured
+        by config.ACTION_WORKERS and friends.
+
+        Returns:
+            A WorkerPool, or None if actions should not run on a pool.
+        """
+        if not config.ACTION_WORKERS:
+            return None
+        if config.ACTION_WORKERS_ARE_PROCESSES:
+            return ProcessWorkerPool(config.ACTION_WORKERS,
+                                     config.ACTION_QUEUE_SIZE)
+        return WorkerPool(config.ACTION_WORKERS, config.ACTION_QUEUE_SIZE)
 
-    def route_read(self, filename_pattern):
+    def route_read(self, filename_pattern, rate_limit=None, cache_ttl=None,
+                   cache_key=None, coalesce=False):
         """Adds a function with a filename pattern to the Emmer server. Upon a
         read request, Emmer will run the action corresponding to the first
         filename pattern to match the request's filename.
@@ -34,13 +92,40 @@ class Emmer(object):
 
         Args:
             filename_pattern: a regex pattern to match filenames against.
+            rate_limit: a RateLimit for the data sent to each client host by
+                this route, overriding the server's per host limit.
+            cache_ttl: how many seconds the action's results are cached for,
+                so that requests for the same file are served without running
+                the action again. Only strings and mapped files are cached.
+            cache_key: a function of the client host, the client port and the
+                filename that returns the key a request is cached and
+                coalesced by, or None to neither cache nor coalesce it.
+                Defaults to the filename.
+            coalesce: whether requests that arrive while the action runs for
+                a request with the same key wait on that run's result, or
+                failure, instead of running the action again.
         """
         def decorator(action):
-            self.response_router.append_read_rule(filename_pattern, action)
+            self.response_router.append_read_rule(filename_pattern, action,
+                                                  rate_limit, cache_ttl,
+                                                  cache_key, coalesce)
+            return action
 
         return decorator
 
-    def route_write(self, filename_pattern):
+    def invalidate_cache(self, key=None):
+        """Drops a cached read action result, so that the next request for
+        it runs the action again. Transfers already served from it are not
+        affected. With multiple workers, only the calling process's cache is
+        dropped.
+
+        Args:
+            key: the cache key to drop, by default the filename. If None,
+                every cached result is dropped.
+        """
+        self.response_router.invalidate_cache(key)
+
+    def route_write(self, filename_pattern, spool=False):
         """Adds a function with a filename pattern to the Emmer server. Upon a
         write request, Emmer will run the action corresponding to the first
         filename pattern to match the request's filename.
@@ -50,20 +135,108 @@ class Emmer(object):
 
         Args:
             filename_pattern: a regex pattern to match filenames against.
+            spool: whether uploads are spooled to a temporary file once they
+                outgrow config.WRITE_SPOOL_SIZE, and handed to the action as
+                a file object rather than as a string.
         """
         def decorator(action):
-            self.response_router.append_write_rule(filename_pattern, action)
+            self.response_router.append_write_rule(filename_pattern, action,
+                                                   spool)
+            return action
+
+        return decorator
+
+    def route_write_sink(self, filename_pattern):
+        """Adds a sink factory with a filename pattern to the Emmer server.
+        Upon a write request, Emmer will run the sink factory corresponding
+        to the first filename pattern to match the request's filename, and
+        hand every block of the upload to the write sink that it returns.
+
+        Use this function as a decorator on a function to add that function
+        as a sink factory with which to handle a tftp conversation.
+
+        Args:
+            filename_pattern: a regex pattern to match filenames against.
+        """
+        def decorator(sink_factory):
+            self.response_router.append_write_sink_rule(filename_pattern,
+                                                        sink_factory)
+            return sink_factory
 
         return decorator
 
-    def run(self):
+    def run(self, event_loop=False, workers=0):
         """Initiates the Emmer server. This includes:
         * Listening on the given UDP host and port.
         * Sending messages through the given port to reach out on timed out
           tftp conversations.
+
+        Args:
+            event_loop: If True, handle messages inline on a single epoll
+                driven event loop, leaving only application actions to the
+                action pool. Otherwise, spawn a thread for every message
+                received.
+            workers: If given, fork this many worker processes instead of
+                serving from this one. Each worker binds the port with
+                SO_REUSEPORT, keeps its own conversations and answers them
+                from per transfer sockets, so that every packet of a
+                conversation reaches the worker that owns it. Workers that
+                die are restarted. Routes must be registered before calling
+                run.
         """
+        if workers:
+            print ("TFTP Server running at %s:%s with %s workers"
+                   % (self.host, self.port, workers))
+            Supervisor(workers, lambda: self._run_worker(event_loop)).run()
+            return
+        if event_loop:
+            self.reactor = EventLoopReactor(
+                self.sock, self.response_router, self.conversation_table,
+                self.per_transfer_sockets, batch_size=config.BATCH_SIZE,
+                admission_controller=self.admission_controller,
+                rate_limiter=self.rate_limiter,
+                max_block_size=config.MAX_BLOCK_SIZE,
+                max_window_size=config.MAX_WINDOW_SIZE,
+                block_rollover=config.BLOCK_ROLLOVER)
+        if self.action_pool:
+            self.action_pool.start()
         self.sock.bind((self.host, self.port))
         print "TFTP Server running at %s:%s" % (self.host, self.port)
         thread.start_new_thread(self.performer.run,
                                 (config.PERFORMER_THREAD_INTERVAL,))
         self.reactor.run()
+
+    def _run_worker(self, event_loop):
+        """Runs a single worker process of a multi process server. The worker
+        replaces the services inherited from the supervising process with its
+        own, listening on a socket that shares the port with its siblings.
+
+        Args:
+            event_loop: Whether the worker runs an EventLoopReactor.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        self._create_services(sock, True)
+        self.run(event_loop)
+
+    def serve(self):
+        """Initiates the Emmer server on a single thread. Messages, timeouts
+        and actions are all handled on one event loop, so no thread is ever
+        spawned. Actions that wait on slow backends should return a Deferred
+        and complete it later, either from the application's own non-blocking
+        I/O registered with self.reactor.add_reader or from another thread.
+        """
+        self.response_router.action_pool = None
+        self.reactor = EventLoopReactor(
+            self.sock, self.response_router, self.conversation_table,
+            self.per_transfer_sockets, performer=self.performer,
+            housekeeping_interval=config.PERFORMER_THREAD_INTERVAL,
+            batch_size=config.BATCH_SIZE,
+            admission_controller=self.admission_controller,
+            rate_limiter=self.rate_limiter,
+            max_block_size=config.MAX_BLOCK_SIZE,
+            max_window_size=config.MAX_WINDOW_SIZE,
+            block_rollover=config.BLOCK_ROLLOVER)
+        self.sock.bind((self.host, self.port))
+        print "TFTP Server running at %s:%s" % (self.host, self.port)
+        self.reactor.run()
@@ -9,9 +9,13 @@ All Packet objects offer the following functions:
     __str__: Return a human readable string describing the contents of that
         packet.
 
+Packets are created by the million, so their classes declare __slots__ and
+keep their opcode on the class rather than on every instance.
+
 Furthermore, this module offers a function called `unpack_packet`, which takes
 packet data that satisfies the tftp specification and returns an instance of
-the corresponding type of packet.
+the corresponding type of packet, and a function called `pack_segments`,
+which packs a packet for sending without copying its data.
 """
 
 
@@ -24,6 +28,40 @@ WRITE_REQUEST_OPCODE = 2
 DATA_OPCODE = 3
 ACKNOWLEDGEMENT_OPCODE = 4
 ERROR_OPCODE = 5
+OPTION_ACKNOWLEDGEMENT_OPCODE = 6
+
+# The block size of the original protocol, used unless the blksize option of
+# RFC 2348 negotiates another
+DEFAULT_BLOCK_SIZE = 512
+
+# The block sizes that the blksize option may negotiate
+MIN_BLOCK_SIZE = 8
+MAX_BLOCK_SIZE = 65464
+
+# The amount of blocks sent before waiting for an acknowledgement, 1 unless
+# the windowsize option of RFC 7440 negotiates more
+DEFAULT_WINDOW_SIZE = 1
+
+# The window sizes that the windowsize option may negotiate
+MIN_WINDOW_SIZE = 1
+MAX_WINDOW_SIZE = 65535
+
+# The retransmission timeouts, in seconds, that the timeout option of RFC
+# 2349 may ask for
+MIN_TIMEOUT = 1
+MAX_TIMEOUT = 255
+
+# The largest block number that fits in a packet. Block numbers of longer
+# transfers roll over to 0 or 1, depending on the client, and conversations
+# count blocks past it internally
+MAX_BLOCK_NUMBER = 65535
+
+# The opcode that every packet begins with
+OPCODE = struct.Struct(">H")
+
+# The opcode and the number that follows it in DATA, ACK and ERROR packets:
+# the block number, or the error code. Both are unsigned.
+HEADER = struct.Struct(">HH")
 
 
 def unpack_packet(packet_data):
@@ -38,42 +76,127 @@ def unpack_packet(packet_data):
         tftp conversation. If the packet is illegal in some way, then a
         NoOpPacket is returned.
     """
+    unpack = _UNPACKERS.get(packet_data[:2])
     try:
-        opcode = bytes_to_int(packet_data[0:2])
-        if opcode == READ_REQUEST_OPCODE:
-            split_data = packet_data[2:].split("\x00")
-            filename = split_data[0]
-            mode = split_data[1]
-            options = options_list_to_dictionary(split_data[2:-1])
-            return ReadRequestPacket(filename, mode, options)
-        elif opcode == WRITE_REQUEST_OPCODE:
-            split_data = packet_data[2:].split("\x00")
-            filename = split_data[0]
-            mode = split_data[1]
-            options = options_list_to_dictionary(split_data[2:-1])
-            return WriteRequestPacket(filename, mode, options)
-        elif opcode == DATA_OPCODE:
-            block_num = bytes_to_int(packet_data[2:4])
-            data = packet_data[4:]
-            return DataPacket(block_num, data)
-        elif opcode == ACKNOWLEDGEMENT_OPCODE:
-            block_num = bytes_to_int(packet_data[2:4])
-            return AcknowledgementPacket(block_num)
-        elif opcode == ERROR_OPCODE:
-            error_code = bytes_to_int(packet_data[2:4])
-            error_message = packet_data[4:-1]
-            return ErrorPacket(error_code, error_message)
-        # TODO: Add method for error response, Code 4, Illegal TFTP Operation
-    except:
+        if unpack:
+            return unpack(packet_data)
+        if len(packet_data) < 2:
+            raise ValueError("Packet too short")
+    except Exception:
         logging.warn("Invalid packet %s" % packet_data)
     return NoOpPacket()
 
 
+def _unpack_read_request(packet_data):
+    split_data = packet_data[2:].split("\x00")
+    return ReadRequestPacket(split_data[0], split_data[1],
+                             options_list_to_dictionary(split_data[2:-1]))
+
+
+def _unpack_write_request(packet_data):
+    split_data = packet_data[2:].split("\x00")
+    return WriteRequestPacket(split_data[0], split_data[1],
+                              options_list_to_dictionary(split_data[2:-1]))
+
+
+def _unpack_data(packet_data):
+    _, block_num = HEADER.unpack(packet_data[:4])
+    return DataPacket(block_num, packet_data[4:])
+
+
+def _unpack_acknowledgement(packet_data):
+    _, block_num = HEADER.unpack(packet_data[:4])
+    return AcknowledgementPacket(block_num)
+
+
+def _unpack_error(packet_data):
+    _, error_code = HEADER.unpack(packet_data[:4])
+    return ErrorPacket(error_code, packet_data[4:-1])
+
+
+def _unpack_option_acknowledgement(packet_data):
+    return OptionAcknowledgementPacket(
+        options_list_to_dictionary(packet_data[2:].split("\x00")[:-1]))
+
+
+# The function that unpacks each kind of packet, keyed on the packed opcode
+# so that dispatching takes a single dictionary lookup. Headers are unpacked
+# from slices rather than with Struct.unpack_from, which parses its
+# arguments by keyword and is several times slower on Python 2.
+_UNPACKERS = {
+    OPCODE.pack(READ_REQUEST_OPCODE): _unpack_read_request,
+    OPCODE.pack(WRITE_REQUEST_OPCODE): _unpack_write_request,
+    OPCODE.pack(DATA_OPCODE): _unpack_data,
+    OPCODE.pack(ACKNOWLEDGEMENT_OPCODE): _unpack_acknowledgement,
+    OPCODE.pack(ERROR_OPCODE): _unpack_error,
+    OPCODE.pack(OPTION_ACKNOWLEDGEMENT_OPCODE): _unpack_option_acknowledgement,
+}
+
+
+def pack_segments(packet):
+    """Packs a packet as the segments that make up its datagram, for a
+    BatchIO to send without joining them. A DataPacket is packed as a
+    (header, data) pair, so that its data, which may be a buffer into a
+    memory mapped file, is never copied. Any other packet is packed into a
+    single string.
+
+    Args:
+        packet: The packet to pack.
+    """
+    if isinstance(packet, DataPacket):
+        return packet.pack_segments()
+    return packet.pack()
+
+
+def wrap_block_number(block_num, rollover=0):
+    """Returns the block number that goes on the wire for a block counted
+    from the start of a transfer. Past MAX_BLOCK_NUMBER, block numbers
+    roll over to 0 or 1.
+
+    Args:
+        block_num: The block number counted from the start of the transfer,
+            without bound.
+        rollover: The block number that follows MAX_BLOCK_NUMBER, 0 or 1.
+    """
+    if block_num <= MAX_BLOCK_NUMBER:
+        return block_num
+    return rollover + ((block_num - MAX_BLOCK_NUMBER - 1)
+                       % (MAX_BLOCK_NUMBER + 1 - rollover))
+
+
+def unwrap_block_number(wire_block_num, reference, rollover=0):
+    """Returns the block number counted from the start of a transfer for a
+    block number off the wire: the latest block, no later than the given
+    reference block, whose number wraps to it.
+
+    Args:
+        wire_block_num: The block number of a received packet.
+        reference: The block number counted from the start of the transfer
+            of the latest block sent or received.
+        rollover: The block number that follows MAX_BLOCK_NUMBER, 0 or 1.
+
+    Returns:
+        The block number counted from the start of the transfer. Negative if
+        no block up to the reference wraps to the given number.
+    """
+    if reference <= MAX_BLOCK_NUMBER:
+        # No block number has come round yet
+        if wire_block_num <= reference:
+            return wire_block_num
+        return -1
+    if wire_block_num < rollover:
+        # Block numbers below the rollover only occur before the first wrap
+        return wire_block_num
+    cycle = MAX_BLOCK_NUMBER + 1 - rollover
+    return reference - ((wrap_block_number(reference, rollover)
+                         - wire_block_num) % cycle)
+
+
 def int_to_bytes(int_value):
-    return struct.pack(">h", int_value)
+    return OPCODE.pack(int_value)
 
 def bytes_to_int(byte_value):
-    return struct.unpack(">h", byte_value)[0]
+    return OPCODE.unpack(byte_value)[0]
 
 def options_dictionary_to_string(options_dictionary):
     """Given a dictionary, returns a string in the form:
@@ -82,13 +205,8 @@ def options_dictionary_to_string(options_dictionary):
 
     Sorted in order of key
     """
-    ops = []
-    for (key, value) in sorted(options_dictionary.iteritems()):
-        ops.append(key)
-        ops.append(value)
-    ops_string = "\x00".join(ops)
-    ops_string +=  "\x00" if ops else ""
-    return ops_string
+    return "".join(["%s\x00%s\x00" % option
+                    for option in sorted(options_dictionary.iteritems())])
 
 def options_list_to_dictionary(options_list):
     """Given a list of options of the form:
@@ -96,9 +214,7 @@ def options_list_to_dictionary(options_list):
 
     Returns a dictionary of those keys and values.
     """
-    options = dict([(options_list[i*2], options_list[i*2+1])
-                    for i in xrange(len(options_list) / 2)])
-    return options
+    return dict(zip(options_list[0::2], options_list[1::2]))
 
 
 class ReadRequestPacket(object):
@@ -115,8 +231,10 @@ class ReadRequestPacket(object):
         +-------+---~~---+---+---~~---+---+---~~---+---+---~~---+---+
 
     """
+    __slots__ = ("filename", "mode", "options")
+    opcode = READ_REQUEST_OPCODE
+
     def __init__(self, filename, mode, options={}):
-        self.opcode = READ_REQUEST_OPCODE
         self.filename = filename
         self.mode = mode
         self.options = options
@@ -125,11 +243,9 @@ class ReadRequestPacket(object):
         """Take internal values and return a string satisfying the tftp
         specification with this packet's values.
         """
-        opcode_encoded = int_to_bytes(self.opcode)
-        ops_string = options_dictionary_to_string(self.options)
-
-        return (opcode_encoded + self.filename + "\x00" + self.mode
-            + "\x00" + ops_string)
+        return "%s%s\x00%s\x00%s" % (OPCODE.pack(self.opcode), self.filename,
+                                     self.mode,
+                                     options_dictionary_to_string(self.options))
 
     def __str__(self):
         """ Return a human readable string describing the contents of the
@@ -148,8 +264,10 @@ class WriteRequestPacket(object):
         ------------------------------------------------
 
     """
+    __slots__ = ("filename", "mode", "options")
+    opcode = WRITE_REQUEST_OPCODE
+
     def __init__(self, filename, mode, options={}):
-        self.opcode = WRITE_REQUEST_OPCODE
         self.filename = filename
         self.mode = mode
         self.options = options
@@ -158,10 +276,9 @@ class WriteRequestPacket(object):
         """Take internal values and return a string satisfying the tftp
         specification with this packet's values.
         """
-        opcode_encoded = int_to_bytes(self.opcode)
-        ops_string = options_dictionary_to_string(self.options)
-        return (opcode_encoded + self.filename + "\x00" + self.mode
-                + "\x00" + ops_string)
+        return "%s%s\x00%s\x00%s" % (OPCODE.pack(self.opcode), self.filename,
+                                     self.mode,
+                                     options_dictionary_to_string(self.options))
 
     def __str__(self):
         """ Return a human readable string describing the contents of the
@@ -179,8 +296,10 @@ class DataPacket(object):
        | Opcode |   Block #  |   Data     |
         ----------------------------------
     """
+    __slots__ = ("block_num", "data")
+    opcode = DATA_OPCODE
+
     def __init__(self, block_num, data):
-        self.opcode = DATA_OPCODE
         self.block_num = block_num
         self.data = data
 
@@ -188,9 +307,15 @@ class DataPacket(object):
         """Take internal values and return a string satisfying the tftp
         specification with this packet's values.
         """
-        opcode_encoded = int_to_bytes(self.opcode)
-        block_num_encoded = int_to_bytes(self.block_num)
-        return opcode_encoded + block_num_encoded + self.data
+        header, data = self.pack_segments()
+        return header + str(data)
+
+    def pack_segments(self):
+        """Return this packet packed as a (header, data) pair, which joined
+        satisfy the tftp specification. The data is the packet's own, not a
+        copy of it.
+        """
+        return (HEADER.pack(self.opcode, self.block_num), self.data)
 
     def __str__(self):
         """ Return a human readable string describing the contents of the
@@ -208,17 +333,17 @@ class AcknowledgementPacket(object):
         | Opcode |   Block #  |
          ---------------------
     """
+    __slots__ = ("block_num",)
+    opcode = ACKNOWLEDGEMENT_OPCODE
+
     def __init__(self, block_num):
-        self.opcode = ACKNOWLEDGEMENT_OPCODE
         self.block_num = block_num
 
     def pack(self):
         """Take internal values and return a string satisfying the tftp
         specification with this packet's values.
         """
-        opcode_encoded = int_to_bytes(self.opcode)
-        block_num_encoded = int_to_bytes(self.block_num)
-        return opcode_encoded + block_num_encoded
+        return HEADER.pack(self.opcode, self.block_num)
 
     def __str__(self):
         """ Return a human readable string describing the contents of the
@@ -235,8 +360,10 @@ class ErrorPacket(object):
         | Opcode |  ErrorCode |   ErrMsg   |   0  |
         -----------------------------------------
     """
+    __slots__ = ("error_code", "error_message")
+    opcode = ERROR_OPCODE
+
     def __init__(self, error_code, error_message):
-        self.opcode = ERROR_OPCODE
         self.error_code = error_code
         self.error_message = error_message
 
@@ -244,10 +371,8 @@ class ErrorPacket(object):
         """Take internal values and return a string satisfying the tftp
         specification with this packet's values.
         """
-        opcode_encoded = int_to_bytes(self.opcode)
-        error_code_encoded = int_to_bytes(self.error_code)
-        return (opcode_encoded + error_code_encoded
-                + self.error_message + "\x00")
+        return "%s%s\x00" % (HEADER.pack(self.opcode, self.error_code),
+                             self.error_message)
 
     def __str__(self):
         """ Return a human readable string describing the contents of the
@@ -257,8 +382,37 @@ class ErrorPacket(object):
                 % (self.error_code, self.error_message))
 
 
+class OptionAcknowledgementPacket(object):
+    """
+    Structure of an OACK packet, as defined by RFC 2347:
+        +-------+---~~---+---+---~~---+---+---~~---+---+---~~---+---+
+        |  opc  |  opt1  | 0 | value1 | 0 |  optN  | 0 | valueN | 0 |
+        +-------+---~~---+---+---~~---+---+---~~---+---+---~~---+---+
+    """
+    __slots__ = ("options",)
+    opcode = OPTION_ACKNOWLEDGEMENT_OPCODE
+
+    def __init__(self, options):
+        self.options = options
+
+    def pack(self):
+        """Take internal values and return a string satisfying the tftp
+        specification with this packet's values.
+        """
+        return (OPCODE.pack(self.opcode)
+                + options_dictionary_to_string(self.options))
+
+    def __str__(self):
+        """ Return a human readable string describing the contents of the
+        packet.
+        """
+        return ("<OptionAcknowledgementPacket:: options: %s>"
+                % (self.options))
+
+
 class NoOpPacket(object):
     """This packet type is used when no action should be taken"""
+    __slots__ = ()
 
     def __str__(self):
         """ Return a human readable string describing the contents of the
@@ -1,10 +1,12 @@
-import calendar
 import logging
+import socket
 import time
 import threading
 
 import packets
 import tftp_conversation
+from batch_io import BatchIO
+from clock import monotonic
 from utility import lock
 
 
@@ -13,103 +15,191 @@ class Performer(object):
     * Timeout detection for packet resending.
     * Garbage collection for conversations that have run out of allowed retry
       attempts or conversations that have already completed.
+
+    Only the conversations that the conversation table says are due are
+    checked on each pass. A conversation is due once its retransmission
+    timeout could have expired, or right away once it completes.
+
+    Each conversation is resent to after its own retransmission timeout,
+    derived from its measured round trip time and kept between
+    min_resend_timeout and max_resend_timeout, or after the timeout that its
+    client asked for with the timeout option. Until a round trip time is
+    measured, resend_timeout is used.
     """
     def __init__(self, sock, conversation_table,
-                 resend_timeout, retries_before_giveup):
+                 resend_timeout, retries_before_giveup, batch_size=1,
+                 min_resend_timeout=None, max_resend_timeout=None):
         """
         Args:
             sock: The UDP socket that the server is listening on.
             conversation_table: A conversation table to poll for
                 conversations.
             resend_timeout: The amount of seconds to wait before attempting a
-                packet resend.
+                packet resend, until a round trip time is measured.
             retries_before_giveup: The amount of packet retries to make before
                 permanently discarding a conversation.
+            batch_size: The maximum amount of retransmissions to send per
+                system call.
+            min_resend_timeout: The least amount of seconds to wait before a
+                resend. If None, resend_timeout.
+            max_resend_timeout: The most amount of seconds to wait before a
+                resend, backoff included. If None, resend_timeout.
         """
         self.conversation_table = conversation_table
         self.lock = threading.Lock()
         self.sock = sock
         self.resend_timeout = resend_timeout
+        self.min_resend_timeout = min_resend_timeout
+        if min_resend_timeout is None:
+            self.min_resend_timeout = resend_timeout
+        self.max_resend_timeout = max_resend_timeout
+        if max_resend_timeout is None:
+            self.max_resend_timeout = resend_timeout
         self.retries_before_giveup = retries_before_giveup
+        self.batch_io = BatchIO(batch_size)
 
     def run(self, sleep_interval):
         while True:
-            try:
-                logging.debug(self.conversation_table)
-                self.conversation_table.lock.acquire()
-                self.find_and_handle_stale_conversations()
-                self.sweep_completed_conversations()
-                self.conversation_table.lock.release()
-                time.sleep(sleep_interval)
-            except Exception as ex:
-                logging.debug("\033[31m%s\033[0m" % ex)
+            self.perform_tasks()
+            time.sleep(sleep_interval)
+
+    def perform_tasks(self):
+        """Runs a single pass of every background task. Called periodically
+        either by run or by an event loop that drives the Performer itself.
+        """
+        logging.debug("%s", self.conversation_table)
+        try:
+            self.check_due_conversations()
+        except Exception as ex:
+            logging.debug("\033[31m%s\033[0m" % ex)
 
     @lock
-    def find_and_handle_stale_conversations(self):
-        """Finds all conversations that are stale (not interacted with within
-        the resend timeout window) and for each one either retries the previous
-        message or destroys it.
+    def check_due_conversations(self, now=None):
+        """Checks every conversation that is due, and forgets expired
+        tombstones. Completed conversations that were not retired yet are
+        retired. Stale conversations (not interacted with within their
+        retransmission timeout) either get the previous message resent or are
+        destroyed. Every other conversation is rescheduled for when its
+        timeout will expire. The packets to resend are sent in batches per
+        socket once all due conversations have been checked.
+
+        The shards of the conversation table are checked one at a time, each
+        under its own lock, so that lookups in the other shards go on
+        meanwhile.
+
+        Args:
+            now: The current time on the monotonic clock. If None, the clock
+                is read.
         """
-        stale_conversations = (
-            self._get_stale_conversations(self.resend_timeout))
-        for conversation in stale_conversations:
-            self._handle_stale_conversation(conversation)
+        if now is None:
+            now = monotonic()
+        outgoing = {}
+        for shard in self.conversation_table.shards:
+            shard.lock.acquire()
+            try:
+                self._check_shard(shard, now, outgoing)
+            finally:
+                shard.lock.release()
+        for sock, datagrams in outgoing.iteritems():
+            # A transfer socket may have been closed since its conversation
+            # was checked, which must not hold up the other sockets
+            try:
+                self.batch_io.send(sock, datagrams)
+            except socket.error:
+                logging.exception("Failed to send %s datagrams"
+                                  % len(datagrams))
 
-    def _handle_stale_conversation(self, conversation):
+    def _check_shard(self, shard, now, outgoing):
+        """Checks every due conversation of a single shard of the
+        conversation table. The caller holds the shard's lock.
+        """
+        shard.expire_tombstones(now)
+        for client_addr in shard.pop_due_checks(now):
+            conversation = shard.get_conversation(*client_addr)
+            try:
+                self._check_conversation(shard, client_addr, conversation,
+                                         now, outgoing)
+            except Exception:
+                logging.exception("%s:%s: Failed to check conversation"
+                                  % client_addr)
+                shard.schedule_check(client_addr[0], client_addr[1],
+                                     now + self.resend_timeout)
+
+    def _check_conversation(self, shard, client_addr, conversation, now,
+                            outgoing):
+        """Checks a single due conversation, as check_due_conversations
+        describes, and reschedules it unless it was retired or deleted.
+        """
+        client_host, client_port = client_addr
+        if conversation.state == tftp_conversation.COMPLETED:
+            shard.retire_conversation(client_host, client_port)
+            return
+        if self.get_resend_deadline(conversation) <= now:
+            self._handle_stale_conversation(conversation, outgoing)
+        # Does nothing if the conversation was given up on
+        shard.schedule_check(client_host, client_port,
+                             self.get_resend_deadline(conversation))
+
+    def _handle_stale_conversation(self, conversation, outgoing=None):
         """Given a conversation that is known to be stale
-        (time_of_last_interaction beyond resend_timeout), either:
+        (time_of_last_interaction beyond its retransmission timeout), either:
         * Retry sending of the most recent packet if retries_made is less
           than retries_before_giveup.
         * Destroy that conversation and send ErrorPacket about Timeout otherwise.
 
+        Packets are sent from the conversation's own socket if it has one.
+
         Args:
             conversation: The conversation described above.
+            outgoing: A dictionary of socket to a list of (data, address)
+                tuples to queue the packet into instead of sending it right
+                away. The data is packed with packets.pack_segments.
         """
         client_host = conversation.client_host
         client_port = conversation.client_port
+        sock = conversation.sock or self.sock
+        if outgoing is None:
+            send = lambda packet, addr: sock.sendto(packet.pack(), addr)
+        else:
+            send = lambda packet, addr: (
+                outgoing.setdefault(sock, []).append(
+                    (packets.pack_segments(packet), addr)))
         if conversation.retries_made < self.retries_before_giveup:
             packet = conversation.mark_retry()
-            if not isinstance(packet, packets.NoOpPacket):
-                logging.debug("%s:%s Resending" % (client_host, client_port))
-                self.sock.sendto(packet.pack(), (client_host, client_port))
+            # A window of DATA packets is resent whole, from its first block
+            if not isinstance(packet, list):
+                packet = [packet]
+            for window_packet in packet:
+                if (window_packet is not None
+                        and not isinstance(window_packet, packets.NoOpPacket)):
+                    logging.debug("%s:%s Resending"
+                                  % (client_host, client_port))
+                    send(window_packet, (client_host, client_port))
             return
         packet = packets.ErrorPacket(0, "Conversation Timed Out")
-        self.sock.sendto(packet.pack(), (client_host, client_port))
+        send(packet, (client_host, client_port))
+        conversation.give_up()
         self.conversation_table.delete_conversation(client_host, client_port)
 
-    def _get_stale_conversations(self, time_elapsed, time_reference=None):
-        """Returns all conversations that have not been interacted with
-        for a time greater than or equal to the given time elapsed.
+    def get_resend_deadline(self, conversation):
+        """Returns the time on the monotonic clock after which a conversation
+        is stale.
 
         Args:
-            time_elapsed: The amount of time in seconds which sets the
-                threshold for which conversations should be retrieved.
-            time_reference: The time (since epoch) that should be used as the
-                reference point. If not passed anything, seconds since epoch is
-                used.
-
-        Returns:
-            A list of conversations.
+            conversation: The conversation to resend to.
         """
-        if not time_reference:
-            time_reference = calendar.timegm(time.gmtime())
-        stale_conversations = []
-        for client_addr in self.conversation_table.conversation_table:
-            conversation = (
-                self.conversation_table.get_conversation(*client_addr))
-            time_of_last_interaction = conversation.time_of_last_interaction
-            if time_reference - time_elapsed >= time_of_last_interaction:
-                stale_conversations.append(conversation)
-        return stale_conversations
+        return (conversation.time_of_last_interaction
+                + self.get_resend_timeout(conversation))
 
-    @lock
-    def sweep_completed_conversations(self):
-        """Deletes all completed conversations from the conversation table."""
-        completed_conversation_client_addrs = []
-        for client_addr in self.conversation_table.conversation_table:
-            conversation = (
-                self.conversation_table.get_conversation(*client_addr))
-            if conversation.state == tftp_conversation.COMPLETED:
-                completed_conversation_client_addrs.append(client_addr)
-        for client_addr in completed_conversation_client_addrs:
-            self.conversation_table.delete_conversation(*client_addr)
+    def get_resend_timeout(self, conversation):
+        """Returns how many seconds to wait for an answer from a conversation's
+        client before resending to it.
+
+        Args:
+            conversation: The conversation to resend to.
+        """
+        if conversation.timeout:
+            return conversation.timeout
+        return conversation.rtt_estimator.timeout(self.resend_timeout,
+                                                  self.min_resend_timeout,
+                                                  self.max_resend_timeout)
@@ -0,0 +1,165 @@
+import collections
+import threading
+
+from clock import monotonic
+from utility import lock
+
+# How many per host buckets to keep before forgetting the idle ones
+MAX_IDLE_HOST_BUCKETS = 1024
+
+
+class RateLimit(collections.namedtuple("RateLimit",
+                                       ["bytes_per_second",
+                                        "packets_per_second"])):
+    """A RateLimit caps the DATA packets sent, in bytes and in packets per
+    second. A rate of 0 leaves that dimension unlimited.
+    """
+    def __new__(cls, bytes_per_second=0, packets_per_second=0):
+        return super(RateLimit, cls).__new__(cls, bytes_per_second,
+                                             packets_per_second)
+
+    def __nonzero__(self):
+        return bool(self.bytes_per_second or self.packets_per_second)
+
+
+class TokenBucket(object):
+    """A TokenBucket refills at a fixed rate up to a capacity of one second's
+    worth of tokens.
+
+    Reserving tokens never fails: a bucket may go into debt, and the caller
+    is told how long to wait until the debt is paid off. This lets throttled
+    packets be sent late instead of being dropped, while packets queued
+    behind them wait their turn.
+    """
+    def __init__(self, rate):
+        """
+        Args:
+            rate: How many tokens are added per second.
+        """
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.last_refill = monotonic()
+
+    def reserve(self, amount, now):
+        """Takes tokens from the bucket.
+
+        Args:
+            amount: How many tokens to take.
+            now: The current time on the monotonic clock.
+
+        Returns:
+            How many seconds to wait before using the tokens.
+        """
+        self._refill(now)
+        self.tokens -= amount
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+    def take(self, amount, now):
+        """Takes tokens from the bucket only if it holds enough of them.
+
+        Args:
+            amount: How many tokens to take.
+            now: The current time on the monotonic clock.
+
+        Returns:
+            Whether the tokens were taken.
+        """
+        self._refill(now)
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+    def is_full(self, now):
+        """Returns whether the bucket has refilled completely."""
+        self._refill(now)
+        return self.tokens >= self.rate
+
+    def _refill(self, now):
+        if now <= self.last_refill:
+            return
+        self.tokens = min(self.rate,
+                          self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+
+class RateLimiter(object):
+    """A RateLimiter keeps fairness between the conversations of a server by
+    limiting the DATA packets sent, both globally and per client host. For
+    each packet it tells how long sending should be deferred so that every
+    limit is respected.
+
+    Routes may override the per host limit for their own conversations.
+    Those are accounted separately from the server wide per host limit.
+    """
+    def __init__(self, global_limit=None, host_limit=None):
+        """
+        Args:
+            global_limit: A RateLimit for all packets sent.
+            host_limit: A RateLimit for the packets sent to each client host,
+                unless the route overrides it.
+        """
+        self.global_limit = global_limit or RateLimit()
+        self.host_limit = host_limit or RateLimit()
+        self.lock = threading.Lock()
+        self.global_buckets = self._create_buckets(self.global_limit)
+        self.host_buckets = {}
+
+    @lock
+    def reserve(self, client_host, size, route_limit=None):
+        """Accounts for a DATA packet about to be sent.
+
+        Args:
+            client_host: The host the packet is sent to.
+            size: The size of the packet in bytes.
+            route_limit: The RateLimit of the packet's route, overriding the
+                per host limit. None uses the server's per host limit.
+
+        Returns:
+            How many seconds to defer sending the packet by. 0 if it may be
+            sent right away.
+        """
+        now = monotonic()
+        host_limit = route_limit or self.host_limit
+        delay = self._reserve_from(self.global_buckets, size, now)
+        if host_limit:
+            key = (client_host, host_limit)
+            buckets = self.host_buckets.get(key)
+            if buckets is None:
+                if len(self.host_buckets) >= MAX_IDLE_HOST_BUCKETS:
+                    self._forget_idle_hosts(now)
+                buckets = self._create_buckets(host_limit)
+                self.host_buckets[key] = buckets
+            delay = max(delay, self._reserve_from(buckets, size, now))
+        return delay
+
+    def _create_buckets(self, limit):
+        """Returns a (bytes bucket, packets bucket) tuple for a RateLimit,
+        with None standing in for unlimited dimensions.
+        """
+        byte_bucket = None
+        packet_bucket = None
+        if limit.bytes_per_second:
+            byte_bucket = TokenBucket(limit.bytes_per_second)
+        if limit.packets_per_second:
+            packet_bucket = TokenBucket(limit.packets_per_second)
+        return byte_bucket, packet_bucket
+
+    def _reserve_from(self, buckets, size, now):
+        byte_bucket, packet_bucket = buckets
+        delay = 0
+        if byte_bucket:
+            delay = byte_bucket.reserve(size, now)
+        if packet_bucket:
+            delay = max(delay, packet_bucket.reserve(1, now))
+        return delay
+
+    def _forget_idle_hosts(self, now):
+        """Drops the buckets of hosts that have not been sent anything for
+        long enough to refill them completely.
+        """
+        for key, buckets in self.host_buckets.items():
+            if all(bucket.is_full(now) for bucket in buckets if bucket):
+                del self.host_buckets[key]
@@ -1,9 +1,29 @@
+import collections
+import errno
+import fcntl
 import logging
+import math
+import os
+import select
+import socket
 import thread
+import threading
 
 import packets
+import tftp_conversation
+from batch_io import BatchIO
+from clock import monotonic
+from scheduler import Scheduler
 from tftp_conversation import TFTPConversation
 
+# How often, in seconds, sockets of per transfer conversations are checked for
+# whether their transfer has finished
+TRANSFER_SOCKET_CHECK_INTERVAL = 1
+
+# The largest datagram that is read from a socket: a DATA packet of the
+# largest block size
+MAX_DATAGRAM_SIZE = packets.MAX_BLOCK_SIZE + 4
+
 
 class Reactor(object):
     """A Reactor object runs the event loop and handles incoming requests. It
@@ -12,8 +32,24 @@ class Reactor(object):
 
     A client of this module should call the run function in order to
     permanently listen on the given port.
+
+    With per transfer sockets, every conversation gets its own ephemeral UDP
+    socket as its transfer ID, as RFC 1350 specifies. The listening socket then
+    only ever sees requests, and the kernel delivers the rest of a transfer
+    straight to the conversation's socket.
+
+    With an admission controller, requests that would exceed its caps do not
+    start a conversation. With a rate limiter, DATA packets that would exceed
+    its limits are sent late instead of right away.
+
+    Malformed packets, and requests for filenames that no route matches, are
+    answered with an error straight away, without creating a conversation.
+    Malformed packets from clients with a conversation are ignored instead.
     """
-    def __init__(self, sock, response_router, conversation_table):
+    def __init__(self, sock, response_router, conversation_table,
+                 per_transfer_sockets=False, admission_controller=None,
+                 rate_limiter=None, max_block_size=packets.MAX_BLOCK_SIZE,
+                 max_window_size=packets.MAX_WINDOW_SIZE, block_rollover=0):
         """
         Args:
             sock: A socket to listen for messages on.
@@ -21,10 +57,29 @@ class Reactor(object):
                 level actions into conversations.
             conversation_mangager: A conversation table object to poll and
                 store conversations to.
+            per_transfer_sockets: Whether each conversation is answered from
+                its own ephemeral socket rather than the listening socket.
+            admission_controller: An AdmissionController deciding whether
+                requests may start new conversations. If None, every request
+                does.
+            rate_limiter: A RateLimiter deciding how long to defer DATA
+                packets by. If None, packets are never deferred.
+            max_block_size: The largest block size that clients may negotiate
+                with the blksize option.
+            max_window_size: The largest window size that clients may
+                negotiate with the windowsize option.
+            block_rollover: The block number that follows 65535 in transfers
+                of more than 65535 blocks, 0 or 1.
         """
         self.response_router = response_router
         self.conversation_table = conversation_table
         self.sock = sock
+        self.per_transfer_sockets = per_transfer_sockets
+        self.admission_controller = admission_controller
+        self.rate_limiter = rate_limiter
+        self.max_block_size = max_block_size
+        self.max_window_size = max_window_size
+        self.block_rollover = block_rollover
 
     def run(self):
         """Runs the Reactor, listening on the socket given by this
@@ -32,7 +87,7 @@ class Reactor(object):
         function invocation will never return.
         """
         while True:
-            data, addr = self.sock.recvfrom(1024)
+            data, addr = self.sock.recvfrom(MAX_DATAGRAM_SIZE)
             thread.start_new_thread(self.handle_message,
                                     (self.sock, addr, data))
 
@@ -53,19 +108,136 @@ class Reactor(object):
         # Invalid Packets are NoOp
         if isinstance(packet, packets.NoOpPacket):
             logging.info("Invalid packet received: %s" % data)
+            self.reject_malformed_packet(client_host, client_port)
+            return
+        if self.reject_unrouted_request(client_host, client_port, packet):
             return
 
         conversation = self.get_conversation(client_host, client_port, packet)
-        response_packet = conversation.handle_packet(packet)
-        self.respond_with_packet(client_host, client_port,
-                response_packet)
+        if not conversation:
+            logging.info("%s:%s: No conversation for packet: %s"
+                         % (client_host, client_port, packet))
+            return
+        self.handle_packet(conversation, packet)
+
+    def handle_transfer_message(self, conversation, addr, data):
+        """Accepts and responds (if applicable) to a message received on a
+        conversation's own socket. Messages from anyone but the conversation's
+        client are answered with an unknown transfer ID error.
+
+        Args:
+            conversation: The conversation that owns the socket.
+            addr: A tuple representing (client host, client port).
+            data: Data received in a message from the client.
+        """
+        if addr != (conversation.client_host, conversation.client_port):
+            logging.info("%s:%s: Message for another transfer ID"
+                         % (addr[0], addr[1]))
+            self.respond_with_packet(
+                addr[0], addr[1],
+                packets.ErrorPacket(5, "Unknown transfer ID"),
+                conversation.sock)
+            return
+        packet = packets.unpack_packet(data)
+        logging.debug("%s:%s:   received: %s" % (addr[0], addr[1], packet))
+        if isinstance(packet, packets.NoOpPacket):
+            logging.info("Invalid packet received: %s" % data)
+            return
+        self.handle_packet(conversation, packet)
 
+    def handle_packet(self, conversation, packet):
+        """Advances a conversation with a packet and responds to the client
+        with the conversation's output.
+
+        Args:
+            conversation: The conversation that the packet belongs to.
+            packet: The packet that the client sent unpacked.
+        """
+        response_packet, pending_action = conversation.advance(packet)
+        self.respond_to_conversation(conversation, response_packet)
+        self.retire_if_completed(conversation)
+        if pending_action is not None:
+            pending_action.add_callback(
+                lambda deferred: self.resume_conversation(conversation))
+
+    def resume_conversation(self, conversation):
+        """Resumes a conversation whose read action returned a Deferred that
+        has now completed, and responds to the client with the first block.
+        The base Reactor does this on whichever thread completed the Deferred.
+
+        Args:
+            conversation: A PENDING conversation.
+        """
+        response_packet = conversation.resume()
+        self.respond_to_conversation(conversation, response_packet)
+        self.retire_if_completed(conversation)
+
+    def retire_if_completed(self, conversation):
+        """Retires a completed conversation from the conversation table right
+        away, releasing it from admission control. It lingers as a tombstone
+        to answer late duplicates of the final packets.
+
+        Args:
+            conversation: The conversation that just handled a packet.
+        """
+        if conversation.state == tftp_conversation.COMPLETED:
+            self.conversation_table.retire_conversation(
+                conversation.client_host, conversation.client_port)
+
+    def respond_to_conversation(self, conversation, packet):
+        """Sends a packet produced by a conversation to its client, from the
+        conversation's socket. DATA packets are deferred for as long as the
+        rate limiter asks.
+
+        Args:
+            conversation: The conversation that produced the packet.
+            packet: The packet to send to the client, or a list of DataPackets
+                making up a window.
+        """
+        if isinstance(packet, list):
+            for window_packet in packet:
+                self.respond_to_conversation(conversation, window_packet)
+            return
+        delay = 0
+        if self.rate_limiter and isinstance(packet, packets.DataPacket):
+            delay = self.rate_limiter.reserve(conversation.client_host,
+                                              len(packet.data) + 4,
+                                              conversation.rate_limit)
+        if delay > 0:
+            self.send_later(delay, conversation, packet)
+        else:
+            self.respond_with_packet(conversation.client_host,
+                                     conversation.client_port, packet,
+                                     conversation.sock)
+
+    def send_later(self, delay, conversation, packet):
+        """Sends a conversation's packet after a delay, and restarts the
+        conversation's resend timeout once it is sent. The base Reactor
+        uses a timer thread for this.
+
+        Args:
+            delay: How many seconds to wait before sending.
+            conversation: The conversation that produced the packet.
+            packet: The packet to send to the client.
+        """
+        timer = threading.Timer(delay, self.send_deferred_packet,
+                                (conversation, packet))
+        timer.daemon = True
+        timer.start()
+
+    def send_deferred_packet(self, conversation, packet):
+        """Sends a packet that was deferred by the rate limiter."""
+        self.respond_with_packet(conversation.client_host,
+                                 conversation.client_port, packet,
+                                 conversation.sock)
+        conversation.mark_sent()
 
     def get_conversation(self, client_host, client_port, packet):
         """Given a packet and client address information, retrieves the
         corresponding conversation. Read and Write request packets initiate new
         conversations, adding them to the conversation manager. Everything else
-        retrieves preexisting conversations.
+        retrieves preexisting conversations, or the tombstone of a retired
+        one.
 
         Args:
             client_host: A hostname or ip address of the client.
@@ -73,21 +245,136 @@ class Reactor(object):
             packet: The packet that the client sent unpacked.
 
         Returns:
-            A conversation.
+            A conversation. None if there is no conversation for the packet,
+            if the packet is a retransmitted request for a conversation that
+            already has its own socket, or if the admission controller
+            refused the request. A retransmitted request for a conversation
+            that is still waiting on its read action returns that
+            conversation, which ignores the request.
         """
         if (isinstance(packet, (packets.WriteRequestPacket,
                                 packets.ReadRequestPacket))):
-            conversation = TFTPConversation(client_host, client_port,
-                                            self.response_router)
-            self.conversation_table.add_conversation(
-                client_host, client_port, conversation)
+            existing_conversation = (
+                self.conversation_table.get_conversation(client_host,
+                                                         client_port))
+            if (existing_conversation and existing_conversation.state
+                    == tftp_conversation.PENDING):
+                # Replacing it would leave its read action to answer the
+                # client alongside the new conversation.
+                return existing_conversation
+            if self.per_transfer_sockets:
+                if (existing_conversation and existing_conversation.state
+                        != tftp_conversation.COMPLETED):
+                    # The transfer is already answered from its own transfer
+                    # ID. Starting over from a new one would confuse clients
+                    # that latched onto the first.
+                    return None
+            self.conversation_table.lock.acquire()
+            try:
+                if not self.admit(client_host, client_port):
+                    return None
+                conversation = TFTPConversation(client_host, client_port,
+                                                self.response_router,
+                                                self.max_block_size,
+                                                self.max_window_size,
+                                                self.block_rollover)
+                if self.per_transfer_sockets:
+                    conversation.sock = self.open_transfer_socket()
+                self.conversation_table.add_conversation(
+                    client_host, client_port, conversation)
+            finally:
+                self.conversation_table.lock.release()
+            if conversation.sock:
+                self.watch_transfer_socket(conversation)
         else:
             conversation = (
                 self.conversation_table.get_conversation(client_host,
+                                                         client_port)
+                or self.conversation_table.get_tombstone(client_host,
                                                          client_port))
         return conversation
 
-    def respond_with_packet(self, client_host, client_port, packet):
+    def reject_malformed_packet(self, client_host, client_port):
+        """Answers a malformed packet with an illegal operation error, unless
+        the client has a conversation or a tombstone, whose transfer a stray
+        packet should not abort, or the admission controller rejects
+        silently, so that spoofed packets are not answered with larger ones.
+
+        Args:
+            client_host: A hostname or ip address of the client.
+            client_port: The port from which the client is connecting.
+        """
+        if (self.conversation_table.get_conversation(client_host,
+                                                     client_port)
+                or self.conversation_table.get_tombstone(client_host,
+                                                         client_port)):
+            return
+        if (self.admission_controller
+                and self.admission_controller.reject_silently):
+            return
+        self.respond_with_packet(
+            client_host, client_port,
+            packets.ErrorPacket(4, "Illegal TFTP operation. Host: %s, "
+                                "Port: %s" % (client_host, client_port)))
+
+    def reject_unrouted_request(self, client_host, client_port, packet):
+        """Answers a request for a filename that no route matches with the
+        error its conversation would have sent, without creating the
+        conversation or taking up room in the admission controller.
+
+        Args:
+            client_host: A hostname or ip address of the client.
+            client_port: The port from which the client is connecting.
+            packet: The packet that the client sent unpacked.
+
+        Returns:
+            True if the packet was a request and was rejected.
+        """
+        router = self.response_router
+        if isinstance(packet, packets.ReadRequestPacket):
+            if router.find_route(router.read_rules, packet.filename):
+                return False
+            error_packet = packets.ErrorPacket(
+                1, "File not found. Host: %s, Port: %s"
+                % (client_host, client_port))
+        elif isinstance(packet, packets.WriteRequestPacket):
+            if router.find_route(router.write_rules, packet.filename):
+                return False
+            error_packet = packets.ErrorPacket(
+                2, "Access Violation. Host: %s, Port: %s"
+                % (client_host, client_port))
+        else:
+            return False
+        logging.info("%s:%s: No route for %s"
+                     % (client_host, client_port, packet.filename))
+        self.respond_with_packet(client_host, client_port, error_packet)
+        return True
+
+    def admit(self, client_host, client_port):
+        """Asks the admission controller whether a request may start a new
+        conversation, and answers the client with a server busy error if not,
+        unless the controller rejects silently.
+
+        Args:
+            client_host: A hostname or ip address of the client.
+            client_port: The port from which the client is connecting.
+
+        Returns:
+            True if the request may start a new conversation.
+        """
+        if not self.admission_controller:
+            return True
+        if self.admission_controller.admit(client_host, client_port):
+            return True
+        if not self.admission_controller.reject_silently:
+            self.respond_with_packet(
+                client_host, client_port,
+                packets.ErrorPacket(0, "Server busy. Host: %s, Port: %s"
+                                    % (client_host, client_port)))
+        return False
+
+    def respond_with_packet(self, client_host, client_port, packet,
+                            sock=None):
         """Given client address information and a packet, packs the packet and
         sends it to the client.
 
@@ -96,7 +383,369 @@ class Reactor(object):
             client_port: The port from which the client is connecting.
             packet: The packet to send to the client. If given a NoOpPacket,
                 does not send anything to the client.
+            sock: The socket to send from. If None, the listening socket is
+                used.
         """
         if not isinstance(packet, packets.NoOpPacket):
             logging.debug("    sending: %s" % packet)
-            self.sock.sendto(packet.pack(), (client_host, client_port))
+            sock = sock or self.sock
+            sock.sendto(packet.pack(), (client_host, client_port))
+
+    def open_transfer_socket(self):
+        """Returns a new UDP socket bound to an ephemeral port on the
+        listening socket's address, to serve as a conversation's transfer ID.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((self.sock.getsockname()[0], 0))
+        return sock
+
+    def watch_transfer_socket(self, conversation):
+        """Starts receiving messages on a conversation's own socket. The base
+        Reactor runs a thread per transfer for this.
+
+        Args:
+            conversation: A conversation with its own socket.
+        """
+        thread.start_new_thread(self.serve_transfer_socket, (conversation,))
+
+    def serve_transfer_socket(self, conversation):
+        """Handles messages on a conversation's own socket until the
+        conversation has left the conversation table, then closes the socket.
+
+        Args:
+            conversation: A conversation with its own socket.
+        """
+        sock = conversation.sock
+        sock.settimeout(TRANSFER_SOCKET_CHECK_INTERVAL)
+        try:
+            while not self.is_transfer_finished(conversation):
+                try:
+                    data, addr = sock.recvfrom(MAX_DATAGRAM_SIZE)
+                except socket.timeout:
+                    continue
+                try:
+                    self.handle_transfer_message(conversation, addr, data)
+                except Exception:
+                    logging.exception("%s:%s: Failed to handle message"
+                                      % (addr[0], addr[1]))
+        finally:
+            sock.close()
+
+    def is_transfer_finished(self, conversation):
+        """Returns whether a conversation's own socket is no longer needed,
+        which is once the conversation has left the conversation table and
+        its tombstone has expired. The Performer removes timed out
+        conversations and expired tombstones.
+
+        Args:
+            conversation: A conversation with its own socket.
+        """
+        client_addr = (conversation.client_host, conversation.client_port)
+        return (conversation is not
+                self.conversation_table.get_conversation(*client_addr)
+                and conversation is not
+                self.conversation_table.get_tombstone(*client_addr))
+
+
+class EventLoopReactor(Reactor):
+    """An EventLoopReactor runs the event loop on a readiness based poller
+    (epoll where available) instead of spawning a thread per message. Packet
+    decoding, conversation lookup and state transitions all happen inline on
+    the loop. Application actions should run on the response router's action
+    pool, so that slow actions never stall the loop: the conversation waits
+    on a Deferred and is resumed on the loop once the action completes.
+
+    The reactor can also drive the Performer itself. Without an action pool
+    the whole server then runs on one thread, relying on actions to return
+    Deferreds for anything slow.
+
+    Per transfer sockets are watched by the same loop.
+
+    Datagrams are received in batches of up to batch_size per system call.
+    Responses are queued per socket and sent in batches once the messages
+    received in one batch, or in one pass of the loop, have been handled.
+    """
+    def __init__(self, sock, response_router, conversation_table,
+                 per_transfer_sockets=False, performer=None,
+                 housekeeping_interval=1, batch_size=1,
+                 admission_controller=None, rate_limiter=None,
+                 max_block_size=packets.MAX_BLOCK_SIZE,
+                 max_window_size=packets.MAX_WINDOW_SIZE, block_rollover=0):
+        """
+        Args:
+            sock: A socket to listen for messages on.
+            response_router: A response router object used to hook application
+                level actions into conversations.
+            conversation_table: A conversation table object to poll and
+                store conversations to.
+            per_transfer_sockets: Whether each conversation is answered from
+                its own ephemeral socket rather than the listening socket.
+            performer: A Performer to run from the event loop. If None, the
+                Performer is expected to run on its own thread.
+            housekeeping_interval: How many seconds to wait between Performer
+                passes and checks for finished transfers.
+            batch_size: The maximum amount of datagrams to receive or send
+                per system call. 1 uses a system call per datagram.
+            admission_controller: An AdmissionController deciding whether
+                requests may start new conversations. If None, every request
+                does.
+            rate_limiter: A RateLimiter deciding how long to defer DATA
+                packets by. If None, packets are never deferred.
+            max_block_size: The largest block size that clients may negotiate
+                with the blksize option.
+            max_window_size: The largest window size that clients may
+                negotiate with the windowsize option.
+            block_rollover: The block number that follows 65535 in transfers
+                of more than 65535 blocks, 0 or 1.
+        """
+        Reactor.__init__(self, sock, response_router, conversation_table,
+                         per_transfer_sockets, admission_controller,
+                         rate_limiter, max_block_size, max_window_size,
+                         block_rollover)
+        self.performer = performer
+        self.housekeeping_interval = housekeeping_interval
+        self.next_housekeeping = 0
+        self.poller = Poller()
+        self.readers = {}
+        self.transfer_conversations = {}
+        self.resumed_conversations = collections.deque()
+        self.batch_io = BatchIO(batch_size, MAX_DATAGRAM_SIZE)
+        self.outgoing = collections.OrderedDict()
+        self.scheduler = Scheduler()
+        self.wake_reader, self.wake_writer = os.pipe()
+        for fileno in (self.wake_reader, self.wake_writer):
+            flags = fcntl.fcntl(fileno, fcntl.F_GETFL)
+            fcntl.fcntl(fileno, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.add_reader(self.wake_reader, self._handle_wake)
+
+    def run(self):
+        """Runs the event loop, listening on the socket given by this
+        reactor. The socket should already be bound. This function invocation
+        will never return.
+        """
+        self.sock.setblocking(0)
+        self.add_reader(self.sock.fileno(), self.drain_socket)
+        while True:
+            self.run_once(self.housekeeping_interval)
+
+    def run_once(self, timeout=None):
+        """Waits for any registered file descriptor to become readable and
+        runs the callbacks of those that are, along with any scheduled
+        functions that are due, then sends the queued responses. Runs the
+        Performer and closes the sockets of finished transfers if that is due.
+
+        Args:
+            timeout: The maximum amount of seconds to wait. None waits
+                indefinitely. Waits less if a scheduled function is due
+                sooner.
+        """
+        next_call = self.scheduler.time_until_next()
+        if next_call is not None and (timeout is None or next_call < timeout):
+            timeout = next_call
+        for fileno, _ in self.poller.poll(timeout):
+            callback = self.readers.get(fileno)
+            if not callback:
+                continue
+            try:
+                callback()
+            except Exception:
+                logging.exception("Failed to handle readable file "
+                                  "descriptor %s" % fileno)
+        self.scheduler.run_due()
+        self.flush_outgoing()
+        if monotonic() >= self.next_housekeeping:
+            if self.performer:
+                self.performer.perform_tasks()
+            self.close_finished_transfers()
+            self.next_housekeeping = monotonic() + self.housekeeping_interval
+
+    def add_reader(self, fileno, callback):
+        """Runs a callback on the event loop whenever the given file
+        descriptor is readable. Applications serving from a single thread can
+        use this to multiplex their own non-blocking I/O, such as backend
+        lookups that complete Deferreds, onto the same loop.
+
+        Args:
+            fileno: A file descriptor.
+            callback: A function taking no arguments.
+        """
+        self.readers[fileno] = callback
+        self.poller.register(fileno)
+
+    def remove_reader(self, fileno):
+        """Stops watching a file descriptor registered with add_reader."""
+        if self.readers.pop(fileno, None):
+            self.poller.unregister(fileno)
+
+    def drain_socket(self, conversation=None):
+        """Handles messages from a socket, a batch at a time, until it would
+        block. The responses to each batch are sent before the next batch is
+        received.
+
+        Args:
+            conversation: The conversation whose own socket to read from. If
+                None, reads from the listening socket.
+        """
+        sock = conversation.sock if conversation else self.sock
+        while True:
+            datagrams = self.batch_io.recv(sock)
+            if not datagrams:
+                return
+            for data, addr in datagrams:
+                try:
+                    if conversation:
+                        self.handle_transfer_message(conversation, addr, data)
+                    else:
+                        self.handle_message(sock, addr, data)
+                except Exception:
+                    logging.exception("%s:%s: Failed to handle message"
+                                      % (addr[0], addr[1]))
+            self.flush_outgoing()
+
+    def respond_with_packet(self, client_host, client_port, packet,
+                            sock=None):
+        """Given client address information and a packet, packs the packet and
+        queues it to be sent to the client by flush_outgoing.
+
+        Args:
+            client_host: A hostname or ip address of the client.
+            client_port: The port from which the client is connecting.
+            packet: The packet to send to the client. If given a NoOpPacket,
+                does not send anything to the client.
+            sock: The socket to send from. If None, the listening socket is
+                used.
+        """
+        if not isinstance(packet, packets.NoOpPacket):
+            logging.debug("    queueing: %s" % packet)
+            sock = sock or self.sock
+            self.outgoing.setdefault(sock, []).append(
+                (packets.pack_segments(packet), (client_host, client_port)))
+
+    def flush_outgoing(self):
+        """Sends every queued response, batched per socket."""
+        while self.outgoing:
+            sock, datagrams = self.outgoing.popitem(last=False)
+            try:
+                self.batch_io.send(sock, datagrams)
+            except socket.error:
+                logging.exception("Failed to send %s datagrams"
+                                  % len(datagrams))
+
+    def watch_transfer_socket(self, conversation):
+        """Starts receiving messages on a conversation's own socket from the
+        event loop.
+
+        Args:
+            conversation: A conversation with its own socket.
+        """
+        fileno = conversation.sock.fileno()
+        conversation.sock.setblocking(0)
+        self.transfer_conversations[fileno] = conversation
+        self.add_reader(fileno, lambda: self.drain_socket(conversation))
+
+    def send_later(self, delay, conversation, packet):
+        """Sends a conversation's packet after a delay, and restarts the
+        conversation's resend timeout once it is sent. The packet is sent
+        from the event loop.
+
+        Args:
+            delay: How many seconds to wait before sending.
+            conversation: The conversation that produced the packet.
+            packet: The packet to send to the client.
+        """
+        self.scheduler.call_later(delay, self.send_deferred_packet,
+                                  conversation, packet)
+
+    def close_finished_transfers(self):
+        """Stops watching and closes the sockets of finished transfers."""
+        for fileno, conversation in self.transfer_conversations.items():
+            if self.is_transfer_finished(conversation):
+                self.remove_reader(fileno)
+                del self.transfer_conversations[fileno]
+                conversation.sock.close()
+
+    def resume_conversation(self, conversation):
+        """Queues a conversation whose Deferred has completed to be resumed on
+        the event loop, and wakes the loop up. Safe to call from any thread.
+
+        Args:
+            conversation: A PENDING conversation.
+        """
+        self.resumed_conversations.append(conversation)
+        try:
+            os.write(self.wake_writer, "\x00")
+        except OSError as ex:
+            # A full pipe already guarantees that the loop will wake up
+            if ex.errno != errno.EAGAIN:
+                raise
+
+    def _handle_wake(self):
+        """Empties the wake up pipe and resumes every queued conversation."""
+        try:
+            while os.read(self.wake_reader, 4096):
+                pass
+        except OSError as ex:
+            if ex.errno != errno.EAGAIN:
+                raise
+        while self.resumed_conversations:
+            conversation = self.resumed_conversations.popleft()
+            try:
+                Reactor.resume_conversation(self, conversation)
+            except Exception:
+                logging.exception("%s:%s: Failed to resume conversation"
+                                  % (conversation.client_host,
+                                     conversation.client_port))
+
+
+class Poller(object):
+    """A thin wrapper that offers the same interface over epoll and poll, the
+    readiness based polling mechanisms offered by the select module.
+    Timeouts are always given in seconds.
+    """
+    def __init__(self):
+        if hasattr(select, "epoll"):
+            self.poller = select.epoll()
+            self.read_event = select.EPOLLIN
+            self.timeout_scale = 1
+        else:
+            self.poller = select.poll()
+            self.read_event = select.POLLIN
+            self.timeout_scale = 1000
+
+    def register(self, fileno):
+        """Starts watching the given file descriptor for readability."""
+        self.poller.register(fileno, self.read_event)
+
+    def unregister(self, fileno):
+        """Stops watching the given file descriptor."""
+        self.poller.unregister(fileno)
+
+    def poll(self, timeout=None):
+        """Waits until at least one watched file descriptor is readable.
+
+        Args:
+            timeout: The maximum amount of seconds to wait. None waits
+                indefinitely.
+
+        Returns:
+            A list of (file descriptor, event mask) tuples.
+        """
+        deadline = None if timeout is None else monotonic() + timeout
+        while True:
+            try:
+                return self.poller.poll(self._scale_timeout(timeout))
+            except (IOError, OSError, select.error) as ex:
+                # Waiting is interrupted by signals, and goes on for the rest
+                # of the timeout
+                if (getattr(ex, "errno", None) or ex.args[0]) != errno.EINTR:
+                    raise
+            if deadline is not None:
+                timeout = max(0, deadline - monotonic())
+
+    def _scale_timeout(self, timeout):
+        """Converts a timeout in seconds to what the poller takes."""
+        if timeout is None:
+            return -1
+        # Round up to whole milliseconds, so that waiting for a deadline
+        # never wakes up just before it
+        return math.ceil(timeout * 1000) / 1000.0 * self.timeout_scale
@@ -0,0 +1,106 @@
+import collections
+import threading
+
+from clock import monotonic
+from utility import lock
+
+
+class ResponseCache(object):
+    """A ResponseCache keeps the results of read actions for routes that ask
+    for caching, so that a file requested by many clients at once is produced
+    by its action only once per time to live.
+
+    Entries are evicted least recently used first once the cached data
+    outgrows a budget in bytes. Cached results are shared, not copied: every
+    conversation served from an entry reads from the same string or mapped
+    file.
+
+    Properties:
+        max_bytes: The budget for the cached data, in bytes.
+        size: The bytes of data currently cached.
+        hits: How many lookups found a live entry.
+        misses: How many lookups found none.
+    """
+    def __init__(self, max_bytes):
+        """
+        Args:
+            max_bytes: The budget for the cached data, in bytes. 0 disables
+                the cache.
+        """
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        # Maps keys to (result, size, expiry) tuples, least recently used
+        # first
+        self.entries = collections.OrderedDict()
+
+    @lock
+    def get(self, key, now=None):
+        """Returns the cached result for a key, or None if there is no live
+        entry for it.
+
+        Args:
+            key: The cache key of the request.
+            now: The current time on the monotonic clock. Read from the clock
+                if not given.
+        """
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        result, size, expiry = entry
+        if expiry <= (monotonic() if now is None else now):
+            self.size -= size
+            self.misses += 1
+            return None
+        self.entries[key] = entry
+        self.hits += 1
+        return result
+
+    @lock
+    def put(self, key, result, size, ttl, now=None):
+        """Caches the result of a read action, evicting the least recently
+        used entries as needed to stay within budget. Results larger than the
+        whole budget are not cached.
+
+        Args:
+            key: The cache key of the request.
+            result: What the read action returned.
+            size: The bytes of data the result holds.
+            ttl: How many seconds the entry lives.
+            now: The current time on the monotonic clock. Read from the clock
+                if not given.
+        """
+        if size > self.max_bytes:
+            return
+        self._remove(key)
+        expiry = (monotonic() if now is None else now) + ttl
+        self.entries[key] = (result, size, expiry)
+        self.size += size
+        while self.size > self.max_bytes:
+            _, (_, evicted_size, _) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+
+    @lock
+    def invalidate(self, key):
+        """Drops the entry for a key, if there is one. Conversations already
+        served from it keep their data.
+
+        Args:
+            key: The cache key to drop.
+        """
+        self._remove(key)
+
+    @lock
+    def clear(self):
+        """Drops every entry."""
+        self.entries.clear()
+        self.size = 0
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
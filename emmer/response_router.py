@@ -1,4 +1,23 @@
+import functools
+import mmap
+import os
 import re
+import sre_constants
+import sre_parse
+import tempfile
+import threading
+import weakref
+
+from deferred import Deferred
+from single_flight import SingleFlight
+
+# How many filenames that match no rule a RouteIndex remembers
+MAX_UNMATCHED_FILENAMES = 4096
+
+# The files currently mapped by map_file, keyed on their identity and
+# version. Mappings are forgotten once no transfer uses them.
+_mapped_files = weakref.WeakValueDictionary()
+_mapped_files_lock = threading.Lock()
 
 
 class ResponseRouter(object):
@@ -6,10 +25,12 @@ class ResponseRouter(object):
     routes.
 
     For read requests and write requests, ResponseRouter maintains two lists of
-    rules, where each rule is a tuple is of the form(filename pattern, action).
-    When a request comes in, the filename given is checked against the list of
-    filename regex patterns, and the first rule that matches invokes the
-    corresponding action.
+    rules, where each rule is a Route holding a filename pattern, an action
+    and the route's options. When a request comes in, the filename given is
+    checked against the list of filename regex patterns, and the first rule
+    that matches invokes the corresponding action. Patterns are compiled when
+    their rule is added, and indexed so that a request is only checked
+    against the rules that could match it.
 
     actions are application level functions that take the following argument:
         client_host: The ip or hostname of the client.
@@ -17,16 +38,62 @@ class ResponseRouter(object):
         filename: The filename included in the client request.
 
     Additionally, a write request takes an additional argument:
-        data: The data sent from the client in the tftp conversation.
+        data: The data sent from the client in the tftp conversation. For
+            routes that spool their uploads, a file object holding the data
+            instead.
+
+    Write routes may instead be given a sink factory, which takes the same
+    arguments as a read action and returns a write sink: an object whose
+    write method is called with every block as it arrives, whose close
+    method is called once the upload is complete, and whose abort method is
+    called if the upload fails. Sink factories and sinks run on the thread
+    that handles the request, not on the action pool.
 
     In the case of read requests, actions should return string data that will
-    be served directly back to clients.
+    be served directly back to clients. Large files should rather be returned
+    as a stream, which is read block by block as the transfer proceeds: a
+    file object, an iterator of string chunks, or a function that takes an
+    offset and a length and returns at most that many bytes from the offset.
+    Static files are best returned as map_file(path), which serves them from
+    a memory mapping shared by all transfers of the file.
+
+    Read routes may ask for their results to be cached for a time to live.
+    The string or mapped file that an action returns is then kept in the
+    ResponseCache, and requests with the same cache key are served from it
+    without running the action again. Cache keys are the requested filename,
+    or whatever the route's cache key function returns for the request.
+
+    Read routes may also coalesce concurrent requests with the same key: while
+    the action runs for one request, the others wait on its result instead of
+    running the action again, and fail with it if it fails.
+
+    Actions that wait on slow backends may instead return a Deferred and
+    complete it later, so that no thread is held while the result is produced.
+
+    If the ResponseRouter is given an action pool, every action runs on that
+    pool instead of on the calling thread, and its result is handed back as a
+    Deferred. This bounds the amount of actions running at once.
     """
-    def __init__(self):
-        self.read_rules = []
-        self.write_rules = []
+    def __init__(self, action_pool=None, spool_size=1 << 20,
+                 response_cache=None):
+        """
+        Args:
+            action_pool: A WorkerPool to run actions on. If None, actions run
+                on the thread that handles the request.
+            spool_size: How many bytes of a spooled upload are kept in memory
+                before it is moved to a temporary file.
+            response_cache: The ResponseCache for routes that cache their
+                results. If None, no results are cached.
+        """
+        self.read_rules = RouteIndex()
+        self.write_rules = RouteIndex()
+        self.action_pool = action_pool
+        self.spool_size = spool_size
+        self.response_cache = response_cache
+        self.single_flight = SingleFlight()
 
-    def append_read_rule(self, filename_pattern, action):
+    def append_read_rule(self, filename_pattern, action, rate_limit=None,
+                         cache_ttl=None, cache_key=None, coalesce=False):
         """Adds a rule associating a filename pattern with an action for read
         requests. The action given will execute when a read request is received
         but before any responses are given.
@@ -36,10 +103,24 @@ class ResponseRouter(object):
                 filenames against.
             action: A function to invoke when a later read request arrives
                 matching the given filename_pattern.
+            rate_limit: A RateLimit for the data sent to each client host by
+                this route, overriding the server's per host limit.
+            cache_ttl: How many seconds the action's results are cached for.
+                None or 0 does not cache them.
+            cache_key: A function of the client host, the client port and the
+                filename that returns the key a request is cached and
+                coalesced by, or None to neither cache nor coalesce it. If
+                not given, the filename is the key.
+            coalesce: Whether requests arriving while the action runs for a
+                request with the same key wait on its result rather than
+                running the action again.
         """
-        self.read_rules.append((filename_pattern, action))
+        self.read_rules.append(Route(filename_pattern, action, rate_limit,
+                                     cache_ttl=cache_ttl,
+                                     cache_key=cache_key,
+                                     coalesce=coalesce))
 
-    def append_write_rule(self, filename_pattern, action):
+    def append_write_rule(self, filename_pattern, action, spool=False):
         """Adds a rule associating a filename pattern with an action for write
         requests. The action given will execute when a write request is
         completed and all data received.
@@ -49,8 +130,25 @@ class ResponseRouter(object):
                 filenames against.
             action: A function to invoke when a later read request arrives
                 matching the given filename_pattern.
+            spool: Whether uploads are spooled to a temporary file once they
+                outgrow the spool size, and handed to the action as a file
+                object rather than as a string.
         """
-        self.write_rules.append((filename_pattern, action))
+        self.write_rules.append(Route(filename_pattern, action, spool=spool))
+
+    def append_write_sink_rule(self, filename_pattern, sink_factory):
+        """Adds a rule associating a filename pattern with a sink factory for
+        write requests. The sink factory runs when a write request arrives,
+        and the sink it returns receives the upload block by block.
+
+        Args:
+            filename_pattern: A string pattern to match future write request
+                filenames against.
+            sink_factory: A function of the client host, the client port and
+                the filename that returns a write sink.
+        """
+        self.write_rules.append(Route(filename_pattern, sink_factory,
+                                      sink=True))
 
     def initialize_read(self, filename, client_host, client_port):
         """For a read request, finds the appropriate action and invokes it.
@@ -62,13 +160,133 @@ class ResponseRouter(object):
 
         Returns:
             A ReadBuffer containing the file contents to return. If there is no
-            corresponding action, returns None.
+            corresponding action, returns None. If the action returned a
+            Deferred or ran on the action pool, returns a Deferred that
+            resolves to the ReadBuffer.
+
+        Raises:
+            WorkerPoolFull: The action pool has no room for the action.
         """
-        action = self.find_action(self.read_rules, filename)
-        if action:
-            return ReadBuffer(action(client_host, client_port, filename))
+        route = self.find_route(self.read_rules, filename)
+        if not route:
+            return None
+        key = self.find_request_key(route, filename, client_host,
+                                    client_port)
+        cache_key = key if self.is_cached(route) else None
+        if cache_key is not None:
+            data = self.response_cache.get(cache_key)
+            if data is not None:
+                return route.create_read_buffer(data)
+        request = (route, cache_key, client_host, client_port, filename)
+        if key is not None and route.coalesce:
+            data, coalesced = self.single_flight.run(key, self.run_read_action,
+                                                     *request)
+            if coalesced:
+                data = data.then(functools.partial(self.share_result,
+                                                   *request))
         else:
+            data = self.run_read_action(*request)
+        if isinstance(data, Deferred):
+            return data.then(route.create_read_buffer)
+        return route.create_read_buffer(data)
+
+    def find_request_key(self, route, filename, client_host, client_port):
+        """Returns the key that a read request is cached and coalesced by, or
+        None if the request is neither cached nor coalesced.
+
+        Args:
+            route: The Route that matched the request.
+            filename: The filename included in the client's request.
+            client_host: The host of the client connecting.
+            client_port: The port of the client connecting.
+        """
+        if not self.is_cached(route) and not route.coalesce:
             return None
+        if route.cache_key:
+            return route.cache_key(client_host, client_port, filename)
+        return filename
+
+    def is_cached(self, route):
+        """Returns whether the results of a read route are cached."""
+        return bool(route.cache_ttl) and self.response_cache is not None
+
+    def run_read_action(self, route, cache_key, client_host, client_port,
+                        filename):
+        """Runs the action of a read route, and caches its result.
+
+        Args:
+            route: The Route that matched the request.
+            cache_key: The cache key of the request, or None if its result is
+                not to be cached.
+            client_host: The host of the client connecting.
+            client_port: The port of the client connecting.
+            filename: The filename included in the client's request.
+
+        Returns:
+            The result of the action, or a Deferred of it.
+
+        Raises:
+            WorkerPoolFull: The action pool has no room for the action.
+        """
+        data = self.invoke_action(route.action, client_host, client_port,
+                                  filename)
+        if cache_key is not None:
+            store = functools.partial(self.cache_result, cache_key,
+                                      route.cache_ttl)
+            if isinstance(data, Deferred):
+                return data.then(store)
+            store(data)
+        return data
+
+    def share_result(self, route, cache_key, client_host, client_port,
+                     filename, data):
+        """Returns the result of a read action run for another request, for a
+        request that was coalesced with it. A stream can be read by only one
+        transfer, so the action is run again for a stream.
+
+        Args:
+            route: The Route that matched the request.
+            cache_key: The cache key of the request, or None.
+            client_host: The host of the client connecting.
+            client_port: The port of the client connecting.
+            filename: The filename included in the client's request.
+            data: The result of the action run for the other request.
+        """
+        if is_shareable(data):
+            return data
+        return self.invoke_action(route.action, client_host, client_port,
+                                  filename)
+
+    def cache_result(self, key, ttl, data):
+        """Caches the result of a read action, if it is a string or a mapped
+        file. Streams can be read only once, and are never cached.
+
+        Args:
+            key: The cache key of the request.
+            ttl: How many seconds the result is cached for.
+            data: The result of the read action.
+
+        Returns:
+            The result of the read action.
+        """
+        if isinstance(data, MappedFile):
+            self.response_cache.put(key, data, len(data.data), ttl)
+        elif isinstance(data, basestring):
+            self.response_cache.put(key, data, len(data), ttl)
+        return data
+
+    def invalidate_cache(self, key=None):
+        """Drops a cached read action result, or all of them.
+
+        Args:
+            key: The cache key to drop. If None, the whole cache is dropped.
+        """
+        if self.response_cache is None:
+            return
+        if key is None:
+            self.response_cache.clear()
+        else:
+            self.response_cache.invalidate(key)
 
     def initialize_write(self, filename, client_host, client_port):
         """For a write request, finds the appropriate action and returns it.
@@ -82,9 +300,42 @@ class ResponseRouter(object):
 
         Returns:
             An action that is to be run at the end of a write request file
-            transfer. If there is no corresponding action, returns None.
+            transfer. If there is no corresponding action, returns None. With
+            an action pool, the action returned submits the original action
+            to the pool and returns a Deferred. For sink routes and routes
+            that spool their uploads, returns a write sink instead.
         """
-        return self.find_action(self.write_rules, filename)
+        route = self.find_route(self.write_rules, filename)
+        if not route:
+            return None
+        if route.sink:
+            return route.action(client_host, client_port, filename)
+        if route.spool:
+            return SpoolingWriteSink(
+                functools.partial(self.invoke_action, route.action,
+                                  client_host, client_port, filename),
+                self.spool_size)
+        if self.action_pool:
+            return functools.partial(self.invoke_action, route.action)
+        return route.action
+
+    def invoke_action(self, action, *args):
+        """Runs an action, on the action pool if there is one.
+
+        Args:
+            action: The action to run.
+            args: The arguments to run the action with.
+
+        Returns:
+            The result of the action, or a Deferred for it if the action ran on
+            the action pool.
+
+        Raises:
+            WorkerPoolFull: The action pool has no room for the action.
+        """
+        if self.action_pool:
+            return self.action_pool.defer(action, *args)
+        return action(*args)
 
     def find_action(self, rules, filename):
         """Given a list of rules and a filename to match against them, returns
@@ -92,59 +343,530 @@ class ResponseRouter(object):
         to the first rule that matches the filename given.
 
         Args:
-            rules: A list of tuples, where each tuple is (filename pattern,
-                action).
+            rules: A RouteIndex.
             filename: A filename to match against the filename regex patterns.
 
         Returns:
             An action corresponding to the first rule that matches the filename
             given. If no rules match, returns None.
         """
-        for (filename_pattern, action) in rules:
-            if re.match(filename_pattern, filename):
-                return action
+        route = self.find_route(rules, filename)
+        if route:
+            return route.action
         return None
 
+    def find_route(self, rules, filename):
+        """Given a list of rules and a filename to match against them, returns
+        the first rule that matches the filename given.
+
+        Args:
+            rules: A RouteIndex.
+            filename: A filename to match against the filename regex patterns.
+
+        Returns:
+            A Route. If no rules match, returns None.
+        """
+        return rules.find(filename)
+
+
+class RouteIndex(object):
+    """A RouteIndex holds the rules of the ResponseRouter in the order they
+    were added, and finds the first one to match a filename without trying
+    every rule.
+
+    Rules are indexed in a trie by the start of their pattern that every
+    matching filename must begin with: its literal characters, and the
+    single character wildcards among them, such as the unescaped dots of an
+    IP address. Finding a filename walks the trie along the filename, and
+    only the patterns of the rules met on the way are matched against it.
+
+    Filenames that match no rule, such as those asked for by scanners, are
+    remembered so that asking again costs a single set lookup. They are
+    forgotten whenever a rule is added.
+    """
+    def __init__(self):
+        self.routes = []
+        self.unmatched = set()
+        # Nodes map characters, or WILDCARD, to their children. The rules
+        # whose prefix ends at a node are listed under None, as (order, Route)
+        # tuples.
+        self.trie = {}
+
+    def append(self, route):
+        """Adds a rule after all of the rules already in the index.
+
+        Args:
+            route: The Route to add.
+        """
+        node = self.trie
+        for char in route.prefix:
+            node = node.setdefault(char, {})
+        node.setdefault(None, []).append((len(self.routes), route))
+        self.routes.append(route)
+        self.unmatched = set()
+
+    def find(self, filename):
+        """Returns the first rule whose pattern matches a filename, or None
+        if none does.
+
+        Args:
+            filename: A filename to match against the filename patterns.
+        """
+        if filename in self.unmatched:
+            return None
+        candidates = []
+        nodes = [self.trie]
+        for char in filename:
+            children = []
+            for node in nodes:
+                if None in node:
+                    candidates.append(node[None])
+                child = node.get(char)
+                if child is not None:
+                    children.append(child)
+                child = node.get(WILDCARD)
+                if child is not None:
+                    children.append(child)
+            nodes = children
+            if not nodes:
+                break
+        for node in nodes:
+            if None in node:
+                candidates.append(node[None])
+        # Each list is in order, so only its first match can be the first
+        # match overall
+        first = None
+        for routes in candidates:
+            for order, route in routes:
+                if first is not None and order >= first[0]:
+                    break
+                if route.regex.match(filename):
+                    first = (order, route)
+                    break
+        if first is None:
+            if len(self.unmatched) >= MAX_UNMATCHED_FILENAMES:
+                # Scanners ask for endless distinct filenames; starting over
+                # keeps the set bounded without the cost of an LRU
+                self.unmatched = set()
+            self.unmatched.add(filename)
+            return None
+        return first[1]
+
+    def __iter__(self):
+        return iter(self.routes)
+
+    def __len__(self):
+        return len(self.routes)
+
+
+# The trie key of a character that a pattern's prefix does not pin down
+WILDCARD = ""
+
+# The parsed regex elements that match any one of several characters
+_WILDCARD_OPS = (sre_constants.ANY, sre_constants.IN, sre_constants.CATEGORY,
+                 sre_constants.NOT_LITERAL)
+
+
+def pattern_prefix(regex):
+    """Returns the prefix that every filename matched by a compiled pattern
+    begins with, as a list of characters and of WILDCARD for characters that
+    may vary. Patterns that ignore case have no prefix.
+
+    Args:
+        regex: The compiled pattern.
+    """
+    if regex.flags & (re.IGNORECASE | re.LOCALE):
+        return []
+    literal = unichr if isinstance(regex.pattern, unicode) else chr
+    prefix = []
+    for op, argument in sre_parse.parse(regex.pattern, regex.flags):
+        if op == sre_constants.LITERAL:
+            prefix.append(literal(argument))
+        elif op in _WILDCARD_OPS:
+            prefix.append(WILDCARD)
+        elif not (op == sre_constants.AT and not prefix
+                  and argument == sre_constants.AT_BEGINNING):
+            break
+    return prefix
+
+
+def is_shareable(data):
+    """Returns whether the result of a read action can be served to many
+    transfers: whether it is a string or a mapped file rather than a stream.
+    """
+    return isinstance(data, (basestring, MappedFile))
+
+
+class Route(object):
+    """A Route is a rule of the ResponseRouter, associating a filename
+    pattern with an action and the options that the action was registered
+    with.
+    """
+    def __init__(self, filename_pattern, action, rate_limit=None,
+                 spool=False, sink=False, cache_ttl=None, cache_key=None,
+                 coalesce=False):
+        """
+        Args:
+            filename_pattern: A string pattern to match request filenames
+                against.
+            action: The function to invoke for matching requests.
+            rate_limit: A RateLimit for the data sent to each client host, or
+                None to use the server's.
+            spool: Whether uploads are spooled and handed to the action as a
+                file object.
+            sink: Whether the action is a sink factory.
+            cache_ttl: How many seconds the action's results are cached for.
+            cache_key: A function returning the key a request is cached and
+                coalesced by, or None to key requests on the filename.
+            coalesce: Whether concurrent requests with the same key share a
+                single run of the action.
+        """
+        self.filename_pattern = filename_pattern
+        self.regex = re.compile(filename_pattern)
+        self.prefix = pattern_prefix(self.regex)
+        self.action = action
+        self.rate_limit = rate_limit
+        self.spool = spool
+        self.sink = sink
+        self.cache_ttl = cache_ttl
+        self.cache_key = cache_key
+        self.coalesce = coalesce
+
+    def create_read_buffer(self, data):
+        """Returns a ReadBuffer over the data returned by a read action, or a
+        MappedReadBuffer or a StreamReadBuffer if the action returned a
+        mapped file or a stream, carrying this route's options.
+        """
+        if isinstance(data, MappedFile):
+            read_buffer = MappedReadBuffer(data)
+        elif isinstance(data, basestring):
+            read_buffer = ReadBuffer(data)
+        else:
+            read_buffer = StreamReadBuffer(data)
+        read_buffer.rate_limit = self.rate_limit
+        return read_buffer
+
 
 class ReadBuffer(object):
     """A ReadBuffer is used to temporarily store read request data while the
     transfer has not completely succeeded. It offers an interface for
-    retrieving chunks of data in 512 byte chunks based on block number.
+    retrieving chunks of data in 512 byte chunks, or any other negotiated
+    block size, based on block number. Block numbers count from 1 at the
+    start of the transfer without bound, rather than rolling over like the
+    block numbers on the wire.
     """
     def __init__(self, data):
         self.data = data
+        self.rate_limit = None
 
-    def get_block_count(self):
+    def get_block_count(self, block_size=512):
         """Returns the amount of blocks that this ReadBuffer can produce
         This amount is also the largest value that can be passed into
         get_block.
+
+        Args:
+            block_size: The size of the blocks.
         """
-        return (len(self.data) / 512) + 1
+        return (len(self.data) / block_size) + 1
 
-    def get_block(self, block_num):
+    def get_block(self, block_num, block_size=512):
         """Returns the data corresponding to the given block number
 
         Args:
             block_num: The block number of data to request. By the TFTP
             protocol, blocks are consecutive 512 byte sized chunks of data with
             the exception of the final block which may be less than 512 chunks.
+            block_size: The size of the blocks, if the client negotiated a
+            size other than 512 bytes.
+
+        Return:
+            A block_size byte or less chunk of data corresponding to the given
+            block number.
+        """
+        return self.data[(block_num - 1) * block_size:block_num * block_size]
+
+    def release(self, block_num):
+        """Tells the ReadBuffer that the blocks up to the given block number
+        were acknowledged. The data of a ReadBuffer is a single string, so
+        nothing is released before the transfer ends.
+
+        Args:
+            block_num: The most recently acknowledged block number.
+        """
+        pass
+
+    def close(self):
+        """Releases the ReadBuffer's resources once the transfer is over."""
+        pass
+
+
+def map_file(path):
+    """Maps a file into memory for a read action to return. All transfers of
+    the same file share a single read only mapping, which lasts as long as
+    any of them. A file that was modified or replaced since it was mapped is
+    mapped anew. Files must not be truncated while they are served; replace
+    them by renaming a new file over them instead.
+
+    Args:
+        path: The path of the file.
+
+    Returns:
+        A MappedFile.
+
+    Raises:
+        IOError: The file cannot be opened.
+    """
+    file_object = open(path, "rb")
+    try:
+        stat = os.fstat(file_object.fileno())
+        key = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime)
+        _mapped_files_lock.acquire()
+        try:
+            mapped_file = _mapped_files.get(key)
+            if mapped_file is None:
+                mapped_file = MappedFile(file_object, stat.st_size)
+                _mapped_files[key] = mapped_file
+        finally:
+            _mapped_files_lock.release()
+    finally:
+        file_object.close()
+    return mapped_file
+
+
+class MappedFile(object):
+    """A MappedFile is a read only memory mapping of a whole file, as
+    returned by map_file.
+
+    Properties:
+        data: The mapping, or an empty string for an empty file, which cannot
+            be mapped.
+    """
+    def __init__(self, file_object, size):
+        """
+        Args:
+            file_object: The open file to map. It may be closed afterwards.
+            size: The size of the file.
+        """
+        if size:
+            self.data = mmap.mmap(file_object.fileno(), size,
+                                  access=mmap.ACCESS_READ)
+        else:
+            self.data = ""
+
+
+class MappedReadBuffer(ReadBuffer):
+    """A MappedReadBuffer serves read request data from a MappedFile. Blocks
+    are buffers into the mapping rather than copies of its contents.
+    """
+    def __init__(self, mapped_file):
+        ReadBuffer.__init__(self, mapped_file.data)
+        self.mapped_file = mapped_file
+
+    def get_block(self, block_num, block_size=512):
+        """Returns the data corresponding to the given block number, as a
+        buffer into the mapping.
+
+        Args:
+            block_num: The block number of data to request.
+            block_size: The size of the blocks.
+        """
+        return buffer(self.data, (block_num - 1) * block_size, block_size)
+
+
+class StreamReadBuffer(object):
+    """A StreamReadBuffer serves read request data that a read action returned
+    as a stream rather than a string: a file object, an iterator of string
+    chunks, or a function taking an offset and a length and returning at most
+    that many bytes from the offset, and fewer only at the end of the data.
+
+    Blocks are read from the stream when the transfer first asks for them,
+    and forgotten once the client acknowledged them, so only the blocks of
+    the current window are held in memory. Blocks must be asked for in
+    order, and always with the same block size. The amount of blocks is
+    unknown until the stream runs out.
+    """
+    def __init__(self, source):
+        """
+        Args:
+            source: A file object, an iterable of strings, or a function of
+                an offset and a length.
+        """
+        self.source = source
+        self.rate_limit = None
+        self.blocks = {}
+        self.block_count = None
+        self.first_block_num = 1
+        self.next_block_num = 1
+        self.offset = 0
+        self.chunk = ""
+        self.chunk_offset = 0
+        if callable(getattr(source, "read", None)):
+            self.read = source.read
+        elif callable(source):
+            self.read = self._read_at_offset
+        else:
+            self.chunks = iter(source)
+            self.read = self._read_chunks
+
+    def get_block_count(self, block_size=512):
+        """Returns the amount of blocks that this StreamReadBuffer can
+        produce, or None if the stream has not run out yet.
+
+        Args:
+            block_size: The size of the blocks.
+        """
+        return self.block_count
+
+    def get_block(self, block_num, block_size=512):
+        """Returns the data corresponding to the given block number, reading
+        it and any blocks before it from the stream if they were not read
+        yet.
+
+        Args:
+            block_num: The block number of data to request. Must not have
+                been released.
+            block_size: The size of the blocks.
 
         Return:
-            A 512 byte or less chunk of data corresponding to the given block
-            number.
+            A block_size byte or less chunk of data corresponding to the given
+            block number.
         """
-        return self.data[(block_num - 1) * 512:block_num * 512]
+        assert block_num >= self.first_block_num
+        while self.block_count is None and block_num >= self.next_block_num:
+            data = self._read_block(block_size)
+            self.blocks[self.next_block_num] = data
+            if len(data) < block_size:
+                self.block_count = self.next_block_num
+            self.next_block_num += 1
+        return self.blocks.get(block_num, "")
+
+    def release(self, block_num):
+        """Forgets the blocks up to the given block number, which the client
+        acknowledged.
+
+        Args:
+            block_num: The most recently acknowledged block number.
+        """
+        while self.first_block_num <= block_num:
+            self.blocks.pop(self.first_block_num, None)
+            self.first_block_num += 1
+
+    def close(self):
+        """Closes the stream, if it can be closed, once the transfer is
+        over.
+        """
+        close = getattr(self.source, "close", None)
+        if callable(close):
+            close()
+
+    def _read_block(self, block_size):
+        """Reads the next block from the stream, which is block_size bytes
+        long unless the stream runs out.
+        """
+        pieces = []
+        remaining = block_size
+        while remaining > 0:
+            piece = self.read(remaining)
+            if not piece:
+                break
+            pieces.append(piece)
+            remaining -= len(piece)
+            self.offset += len(piece)
+        return "".join(pieces)
+
+    def _read_at_offset(self, length):
+        """Reads from a function of an offset and a length."""
+        return self.source(self.offset, length)
+
+    def _read_chunks(self, length):
+        """Reads from an iterator of chunks, keeping what is left of the
+        current chunk for the next read.
+        """
+        # Empty chunks do not mean the end of the iterator, so skip them
+        while self.chunk_offset >= len(self.chunk):
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return ""
+            self.chunk = chunk
+            self.chunk_offset = 0
+        piece = self.chunk[self.chunk_offset:self.chunk_offset + length]
+        self.chunk_offset += len(piece)
+        return piece
 
 
 class WriteBuffer(object):
     """A WriteBuffer is used to temporarily store write request data while the
-    transfer has not completely succeeded.
+    transfer has not completely succeeded. Blocks are kept apart until the
+    data is asked for, so that receiving them takes linear time.
 
     Retrieve the data from the `data` property.
     """
     def __init__(self):
-        self.data = ""
+        self.chunks = []
 
     def receive_data(self, data):
         """Write some more data to the WriteBuffer """
-        self.data += data
+        self.chunks.append(data)
+
+    @property
+    def data(self):
+        """Returns all data received so far."""
+        if len(self.chunks) > 1:
+            self.chunks = ["".join(self.chunks)]
+        if self.chunks:
+            return self.chunks[0]
+        return ""
+
+    @data.setter
+    def data(self, data):
+        """Replaces all data received so far."""
+        self.chunks = [data]
+
+
+class SpoolingWriteSink(object):
+    """A SpoolingWriteSink is the write sink of routes that spool their
+    uploads. It keeps an upload in memory until it outgrows the spool size,
+    and in a temporary file from then on. Once the upload is complete, the
+    action receives the spool as a file object, rewound to its start. The
+    spool is deleted once the action is done, or if the upload fails.
+
+    Like every write sink, it is written to on the thread that handles the
+    transfer, which is the event loop for an EventLoopReactor. Writes to a
+    spool that has moved to disk block that thread, while the action itself
+    runs on the action pool if there is one.
+    """
+    def __init__(self, action, spool_size):
+        """
+        Args:
+            action: A function of the spool to run once the upload is
+                complete. It may return a Deferred.
+            spool_size: How many bytes are kept in memory.
+        """
+        self.action = action
+        self.spool = tempfile.SpooledTemporaryFile(spool_size)
+
+    def write(self, data):
+        """Adds a block of the upload to the spool."""
+        self.spool.write(data)
+
+    def close(self):
+        """Runs the action with the spool.
+
+        Returns:
+            The result of the action.
+        """
+        self.spool.seek(0)
+        try:
+            result = self.action(self.spool)
+        except Exception:
+            self.spool.close()
+            raise
+        if isinstance(result, Deferred):
+            result.add_callback(lambda deferred: self.spool.close())
+        else:
+            self.spool.close()
+        return result
+
+    def abort(self):
+        """Deletes the spool of a failed upload."""
+        self.spool.close()
@@ -0,0 +1,72 @@
+# Gains of the smoothed round trip time and of its variance, from RFC 6298
+RTT_GAIN = 0.125
+VARIANCE_GAIN = 0.25
+
+# The clock granularity in seconds, the least that the variance term may add
+# to a retransmission timeout
+CLOCK_GRANULARITY = 0.01
+
+
+class RTTEstimator(object):
+    """An RTTEstimator measures the round trip time of a conversation and
+    derives a retransmission timeout from it, as RFC 6298 describes for TCP.
+
+    Samples must only be taken for packets that were sent once (Karn's
+    algorithm), since the answer to a retransmitted packet may belong to any
+    of its copies. Every retransmission doubles the timeout, and the doubling
+    holds until the next valid sample.
+
+    Properties:
+        smoothed_rtt: The smoothed round trip time in seconds. None until the
+            first sample.
+        rtt_variance: The smoothed variation of the round trip time.
+        backoff: How many times the timeout has been doubled since the last
+            sample.
+    """
+    __slots__ = ("smoothed_rtt", "rtt_variance", "backoff")
+
+    def __init__(self):
+        self.smoothed_rtt = None
+        self.rtt_variance = None
+        self.backoff = 0
+
+    def sample(self, rtt):
+        """Updates the estimate with a measured round trip time, and resets
+        the backoff.
+
+        Args:
+            rtt: The seconds between sending a packet and receiving its
+                answer.
+        """
+        if self.smoothed_rtt is None:
+            self.smoothed_rtt = rtt
+            self.rtt_variance = rtt / 2.0
+        else:
+            self.rtt_variance = ((1 - VARIANCE_GAIN) * self.rtt_variance
+                                 + VARIANCE_GAIN
+                                 * abs(self.smoothed_rtt - rtt))
+            self.smoothed_rtt = ((1 - RTT_GAIN) * self.smoothed_rtt
+                                 + RTT_GAIN * rtt)
+        self.backoff = 0
+
+    def back_off(self):
+        """Doubles the timeout, for when the most recent packet had to be
+        retransmitted.
+        """
+        self.backoff += 1
+
+    def timeout(self, initial_timeout, min_timeout, max_timeout):
+        """Returns the retransmission timeout in seconds.
+
+        Args:
+            initial_timeout: The timeout to use before the first sample.
+            min_timeout: The least timeout to return.
+            max_timeout: The largest timeout to return, backoff included.
+        """
+        if self.smoothed_rtt is None:
+            timeout = initial_timeout
+        else:
+            timeout = self.smoothed_rtt + max(CLOCK_GRANULARITY,
+                                              4 * self.rtt_variance)
+        timeout = max(timeout, min_timeout) * 2 ** self.backoff
+        return min(timeout, max_timeout)
@@ -0,0 +1,133 @@
+import heapq
+import itertools
+import logging
+
+from clock import monotonic
+
+
+class Scheduler(object):
+    """A Scheduler keeps functions to run at a later time, for an event loop
+    that runs the ones that are due on every pass. It is not thread safe and
+    should only be used from the event loop's thread.
+    """
+    def __init__(self):
+        self.calls = []
+        self.sequence = itertools.count()
+
+    def __len__(self):
+        return len(self.calls)
+
+    def call_later(self, delay, function, *args):
+        """Schedules a function to run after a delay. Functions due at the
+        same time run in the order they were scheduled.
+
+        Args:
+            delay: How many seconds to wait before running the function.
+            function: The function to run.
+            args: The arguments to run the function with.
+        """
+        heapq.heappush(self.calls, (monotonic() + delay,
+                                    next(self.sequence), function, args))
+
+    def time_until_next(self):
+        """Returns how many seconds remain until the next scheduled function
+        is due, 0 if one is overdue, or None if nothing is scheduled.
+        """
+        if not self.calls:
+            return None
+        return max(0, self.calls[0][0] - monotonic())
+
+    def run_due(self):
+        """Runs every scheduled function that is due."""
+        now = monotonic()
+        while self.calls and self.calls[0][0] <= now:
+            _, _, function, args = heapq.heappop(self.calls)
+            try:
+                function(*args)
+            except Exception:
+                logging.exception("Scheduled call %s failed" % function)
+
+
+class TimerHeap(object):
+    """A TimerHeap keeps a deadline for each of a set of keys, and hands out
+    the keys whose deadlines have passed, touching no other key. Setting a
+    key's deadline is logarithmic in the amount of keys, and replaces any
+    deadline the key had; replaced entries are skipped once they surface.
+
+    Deadlines are in seconds on the monotonic clock. A TimerHeap is not
+    thread safe.
+    """
+    def __init__(self):
+        self.deadlines = {}
+        self.heap = []
+        self.sequence = itertools.count()
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def __contains__(self, key):
+        return key in self.deadlines
+
+    def schedule(self, key, deadline):
+        """Sets the deadline of a key.
+
+        Args:
+            key: A hashable key.
+            deadline: The time on the monotonic clock when the key is due.
+        """
+        self.deadlines[key] = deadline
+        heapq.heappush(self.heap, (deadline, next(self.sequence), key))
+        if len(self.heap) > 2 * len(self.deadlines) + 64:
+            self._compact()
+
+    def cancel(self, key):
+        """Forgets the deadline of a key, if it has one."""
+        self.deadlines.pop(key, None)
+
+    def next_deadline(self):
+        """Returns the earliest deadline, or None if no key has one."""
+        self._skip_replaced()
+        if not self.heap:
+            return None
+        return self.heap[0][0]
+
+    def pop_due(self, now=None):
+        """Removes and returns the keys whose deadlines have passed, earliest
+        first.
+
+        Args:
+            now: The current time on the monotonic clock. If None, the clock
+                is read.
+
+        Returns:
+            A list of keys.
+        """
+        if now is None:
+            now = monotonic()
+        due = []
+        while True:
+            self._skip_replaced()
+            if not self.heap or self.heap[0][0] > now:
+                return due
+            _, _, key = heapq.heappop(self.heap)
+            del self.deadlines[key]
+            due.append(key)
+
+    def _skip_replaced(self):
+        """Pops the entries at the top of the heap that no longer hold their
+        key's deadline.
+        """
+        while self.heap:
+            deadline, _, key = self.heap[0]
+            if self.deadlines.get(key) == deadline:
+                return
+            heapq.heappop(self.heap)
+
+    def _compact(self):
+        """Rebuilds the heap from the current deadlines, dropping the entries
+        that were replaced, so that frequently rescheduled keys do not grow
+        it without bound.
+        """
+        self.heap = [(deadline, next(self.sequence), key)
+                     for key, deadline in self.deadlines.iteritems()]
+        heapq.heapify(self.heap)
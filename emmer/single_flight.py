@@ -0,0 +1,84 @@
+import threading
+
+from deferred import Deferred
+
+
+class SingleFlight(object):
+    """A SingleFlight coalesces concurrent calls that share a key, such as
+    hundreds of read requests for the same boot image arriving at once. The
+    first call runs the function; calls with the same key that arrive while
+    it is in flight do not run it again, and are given a Deferred of its
+    outcome instead. A failure reaches every coalesced call.
+
+    A call is in flight until its function returns or, if the function
+    returned a Deferred, until that Deferred completes.
+
+    Properties:
+        calls: How many times a function was run.
+        coalesced: How many calls were saved by waiting on a call in flight.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Maps keys to the Deferred shared by the calls waiting on them
+        self.in_flight = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def run(self, key, function, *args):
+        """Runs a function, unless a call with the same key is in flight.
+
+        Args:
+            key: The key that identifies equivalent calls.
+            function: The function to run.
+            args: The arguments to run the function with.
+
+        Returns:
+            A (result, coalesced) tuple. If no call with the key was in
+            flight, the result of the function and False. Otherwise, a
+            Deferred of the outcome of the call in flight and True.
+
+        Raises:
+            Whatever the function raises. Coalesced calls fail with it as
+            well.
+        """
+        self.lock.acquire()
+        shared = self.in_flight.get(key)
+        if shared is not None:
+            self.coalesced += 1
+            self.lock.release()
+            return shared, True
+        shared = Deferred()
+        self.in_flight[key] = shared
+        self.calls += 1
+        self.lock.release()
+        try:
+            result = function(*args)
+        except Exception as ex:
+            self._land(key)
+            shared.fail(ex)
+            raise
+        if isinstance(result, Deferred):
+            result.add_callback(lambda deferred: self._settle(key, shared,
+                                                              deferred))
+        else:
+            self._land(key)
+            shared.resolve(result)
+        return result, False
+
+    def _settle(self, key, shared, deferred):
+        """Hands the outcome of a Deferred returned by a function in flight
+        to the calls waiting on it.
+        """
+        self._land(key)
+        if deferred.error is not None:
+            shared.fail(deferred.error)
+        else:
+            shared.resolve(deferred.result)
+
+    def _land(self, key):
+        """Marks the call with the given key as no longer in flight, so that
+        later calls run the function again.
+        """
+        self.lock.acquire()
+        self.in_flight.pop(key, None)
+        self.lock.release()
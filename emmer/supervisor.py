@@ -0,0 +1,94 @@
+import logging
+import os
+import signal
+import time
+
+
+class Supervisor(object):
+    """A Supervisor forks a fixed amount of worker processes and keeps them
+    running, restarting any worker that dies.
+
+    A client of this module should call the run function in order to
+    permanently supervise the workers.
+    """
+    def __init__(self, worker_count, run_worker, restart_delay=1):
+        """
+        Args:
+            worker_count: The amount of worker processes to keep running.
+            run_worker: The function that a worker process runs. It takes no
+                arguments and is not expected to return.
+            restart_delay: How many seconds to wait before restarting a worker
+                that died, so that a worker failing on startup does not spin.
+        """
+        self.worker_count = worker_count
+        self.run_worker = run_worker
+        self.restart_delay = restart_delay
+        self.workers = set()
+
+    def run(self):
+        """Starts the workers and restarts them as they die. Terminates the
+        workers when the supervising process is asked to terminate. This
+        function invocation will never return.
+        """
+        signal.signal(signal.SIGTERM, self._handle_termination)
+        try:
+            self.spawn_workers()
+            while True:
+                self.wait_and_restart()
+        except KeyboardInterrupt:
+            self.stop()
+            raise
+
+    def spawn_workers(self):
+        """Forks worker processes until worker_count of them are running."""
+        while len(self.workers) < self.worker_count:
+            self.spawn_worker()
+
+    def spawn_worker(self):
+        """Forks a single worker process.
+
+        Returns:
+            The process id of the new worker.
+        """
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            try:
+                self.run_worker()
+            except BaseException:
+                logging.exception("Worker %s failed" % os.getpid())
+            finally:
+                os._exit(1)
+        self.workers.add(pid)
+        logging.info("Started worker %s" % pid)
+        return pid
+
+    def wait_and_restart(self):
+        """Waits for a worker to die and replaces it."""
+        pid, status = os.wait()
+        if pid not in self.workers:
+            return
+        self.workers.remove(pid)
+        logging.warn("Worker %s died with status %s, restarting"
+                     % (pid, status))
+        time.sleep(self.restart_delay)
+        self.spawn_workers()
+
+    def stop(self):
+        """Terminates every worker and waits for them to exit."""
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in self.workers:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        self.workers = set()
+
+    def _handle_termination(self, signum, frame):
+        """Terminates the workers along with the supervising process."""
+        self.stop()
+        os._exit(0)
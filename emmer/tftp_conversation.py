@@ -1,16 +1,19 @@
 import logging
-import calendar
 import threading
-import time
 
 import packets
+from clock import monotonic
+from deferred import Deferred
 from response_router import WriteBuffer
+from rtt import RTTEstimator
 from utility import lock
+from worker_pool import WorkerPoolFull
 
 UNINITIALIZED = 0
 WRITING = 1
 READING = 2
 COMPLETED = 3
+PENDING = 4
 
 
 class TFTPConversation(object):
@@ -20,13 +23,53 @@ class TFTPConversation(object):
 
     Properties:
         current_block_num: Equivalent to the block number that is attached to
-            the packet most recently sent out by the conversation.
+            the packet most recently sent out by the conversation, counted
+            from the start of the transfer. It keeps counting past the
+            largest block number that fits in a packet, where the numbers on
+            the wire roll over.
+        acked_block_num: When reading, the highest block number that the
+            client acknowledged, counted like current_block_num.
         cached_packet: The most recently sent non error packet from this
-            conversation. Use for retries.
-        time_of_last_interaction: The seconds since epoch of the most recently
-            received legal packet. Use for timeouts.
+            conversation, or the list of DATA packets of the most recently
+            sent window. Use for retries.
+        time_of_last_interaction: The time on the monotonic clock of the most
+            recently received legal packet, or of the most recent resend. Use
+            for timeouts.
+        rtt_estimator: An RTTEstimator measuring the time between sending a
+            packet and the client answering it. Use for timeouts.
+        timeout: The retransmission timeout in seconds that the client asked
+            for with the timeout option. None if it did not.
+        pending_action: The Deferred returned by a read action that has not
+            completed yet. Set while the conversation is PENDING.
+        sock: The conversation's own socket when the server uses per transfer
+            sockets. None if the conversation is served from the listening
+            socket.
+        rate_limit: The RateLimit of the read route serving the conversation,
+            if the route overrides the server's per host limit.
+        block_size: The size of DATA blocks, 512 unless the client negotiated
+            another with the blksize option.
+        window_size: The amount of DATA blocks sent before waiting for an
+            acknowledgement, 1 unless the client negotiated another with the
+            windowsize option.
+        accepted_options: The options of the request that the server
+            acknowledged with an OACK. None if it accepted none.
+        block_rollover: The block number that follows the largest one on the
+            wire, 0 or 1.
     """
-    def __init__(self, client_host, client_port, response_router):
+    # A server tracks up to hundreds of thousands of conversations, so they
+    # do without a __dict__
+    __slots__ = ("accepted_options", "acked_block_num", "block_rollover",
+                 "block_size", "cached_packet", "client_host", "client_port",
+                 "current_block_num", "filename", "lock", "max_block_size",
+                 "max_window_size", "mode", "pending_action", "rate_limit",
+                 "read_buffer", "response_router", "retries_made",
+                 "rtt_estimator", "sock", "state", "time_of_last_interaction",
+                 "timeout", "window_size", "write_action", "write_buffer",
+                 "write_sink")
+
+    def __init__(self, client_host, client_port, response_router,
+                 max_block_size=packets.MAX_BLOCK_SIZE,
+                 max_window_size=packets.MAX_WINDOW_SIZE, block_rollover=0):
         """Initializes a TFTPConversation with the given client.
 
         Args:
@@ -34,15 +77,37 @@ class TFTPConversation(object):
             client port: The port that the clietn is connecting from
             response_router: A response router to handle reads/writes to the
                 tftp server.
+            max_block_size: The largest block size that the blksize option
+                may negotiate.
+            max_window_size: The largest window size that the windowsize
+                option may negotiate.
+            block_rollover: The block number that follows the largest one
+                that fits in a packet, 0 or 1. Clients disagree on it, so it
+                is up to the server's configuration.
         """
+        self.accepted_options = None
+        self.acked_block_num = 0
+        self.block_rollover = block_rollover
+        self.block_size = packets.DEFAULT_BLOCK_SIZE
         self.cached_packet = None
         self.client_host = client_host
         self.client_port = client_port
         self.lock = threading.Lock()
+        self.max_block_size = max_block_size
+        self.max_window_size = max_window_size
+        self.pending_action = None
+        self.rate_limit = None
+        self.read_buffer = None
         self.response_router = response_router
         self.retries_made = 0
+        self.sock = None
         self.state = UNINITIALIZED
-        self.time_of_last_interaction = calendar.timegm(time.gmtime())
+        self.rtt_estimator = RTTEstimator()
+        self.time_of_last_interaction = monotonic()
+        self.timeout = None
+        self.window_size = packets.DEFAULT_WINDOW_SIZE
+        self.write_buffer = None
+        self.write_sink = None
 
     @lock
     def handle_packet(self, packet):
@@ -50,30 +115,76 @@ class TFTPConversation(object):
         depending on that packet. Resets the time of last interaction and the
         retries made count. Caches the output packet in case it needs to be
         resent, unless the output packet is an ErrorPacket. In that case, it
-        maintains whatever previously was in the cache.
+        maintains whatever previously was in the cache. Packets that are
+        ignored, such as duplicates, leave the cache and timing untouched.
+
+        A packet that answers the cached packet is a round trip time sample,
+        unless the cached packet had to be resent.
+
+        Args:
+            packet: A packet object that has already been unpacked.
+
+        Returns:
+            a packet object with which to send back to the client, or a list
+            of DataPackets when a window of several blocks is due. Once the
+            conversation has ended, returns a NoOpPacket unless the packet
+            repeats the final DATA packet.
+        """
+        return self._handle_packet(packet)
+
+    @lock
+    def advance(self, packet):
+        """Takes a packet from the client like handle_packet does, and also
+        captures the Deferred that the packet left the conversation waiting
+        on. It is captured while the conversation is still locked, since the
+        Performer may give up on the conversation and clear it right after.
 
         Args:
             packet: A packet object that has already been unpacked.
 
         Returns:
-            a packet object with which to send back to the client. Returns a
-            NoOpPacket if the conversation has ended.
+            A tuple of (output packet, Deferred). The Deferred is None unless
+            the packet moved the conversation to PENDING.
         """
+        previous_state = self.state
+        output_packet = self._handle_packet(packet)
+        if previous_state != PENDING and self.state == PENDING:
+            return output_packet, self.pending_action
+        return output_packet, None
+
+    def _handle_packet(self, packet):
+        """See handle_packet. Must be called with the conversation locked."""
+        previous_state = self.state
         if self.state == UNINITIALIZED:
             output_packet = self._handle_initial_packet(packet)
+        elif (isinstance(packet, packets.ErrorPacket)
+                and self.state in (READING, WRITING, PENDING)):
+            output_packet = self._handle_error_packet(packet)
         elif self.state == READING:
             output_packet = self._handle_read_packet(packet)
         elif self.state == WRITING:
             output_packet = self._handle_write_packet(packet)
+        elif self.state == PENDING:
+            # The client is retransmitting its request while the read action
+            # is still outstanding, which the reactor routes here. resume
+            # sends the first block once ready.
+            output_packet = packets.NoOpPacket()
         else:
-            # TODO: Replace with a more appropriate exception type?
-            raise Exception("Illegal State of TFTPConversation")
+            output_packet = self._handle_late_packet(packet)
 
         # Only cache the packet and mark this packet as an interaction with
-        # regards to timeouts if this did not result in an ErrorPacket
-        if not isinstance(output_packet, packets.ErrorPacket):
-            self.cached_packet = output_packet
-            self._reset_retry_and_time_data()
+        # regards to timeouts if this did not result in an ErrorPacket, and
+        # the packet was not ignored
+        if isinstance(output_packet, packets.ErrorPacket):
+            return output_packet
+        if (isinstance(output_packet, packets.NoOpPacket)
+                and self.state == previous_state):
+            return output_packet
+        now = monotonic()
+        if previous_state in (READING, WRITING) and self.retries_made == 0:
+            self.rtt_estimator.sample(now - self.time_of_last_interaction)
+        self.cached_packet = output_packet
+        self._reset_retry_and_time_data(now)
         return output_packet
 
     def _handle_initial_packet(self, packet):
@@ -93,10 +204,72 @@ class TFTPConversation(object):
         if isinstance(packet, packets.WriteRequestPacket):
             return self._handle_initial_write_packet(packet)
         else:
-            self.state = COMPLETED
+            self._complete()
             return packets.ErrorPacket(5, "Unknown transfer tid."
                 "Host: %s, Port: %s" % (self.client_host, self.client_port))
 
+    def _handle_error_packet(self, packet):
+        """Ends the conversation after the client aborted the transfer, for
+        instance by refusing the options in an OACK.
+
+        Args:
+            packet: An unpacked ErrorPacket.
+
+        Returns:
+            A NoOpPacket, as errors are not acknowledged.
+        """
+        self._complete()
+        self.log("ERROR", "Client aborted transfer: %s" % packet.error_message)
+        return packets.NoOpPacket()
+
+    def _negotiate_options(self, requested_options, reading=False):
+        """Decides which of the options of a request to accept, as described
+        by RFC 2347. blksize (RFC 2348) and timeout (RFC 2349) are
+        supported, and windowsize (RFC 7440) for reads only; any other option
+        is ignored. Sets the conversation's block size, timeout, window size
+        and accepted options.
+
+        Args:
+            requested_options: The options dictionary of the request.
+            reading: Whether the request is a read request.
+        """
+        accepted_options = {}
+        for name, value in requested_options.iteritems():
+            name = name.lower()
+            if name == "blksize":
+                block_size = self._parse_option(value, packets.MIN_BLOCK_SIZE)
+                if block_size is None:
+                    continue
+                self.block_size = min(block_size, self.max_block_size)
+                accepted_options["blksize"] = str(self.block_size)
+            elif name == "timeout":
+                timeout = self._parse_option(value, packets.MIN_TIMEOUT)
+                if timeout is None or timeout > packets.MAX_TIMEOUT:
+                    continue
+                self.timeout = timeout
+                accepted_options["timeout"] = str(self.timeout)
+            elif name == "windowsize" and reading:
+                window_size = self._parse_option(value,
+                                                 packets.MIN_WINDOW_SIZE)
+                if window_size is None:
+                    continue
+                self.window_size = min(window_size, self.max_window_size)
+                accepted_options["windowsize"] = str(self.window_size)
+        if accepted_options:
+            self.accepted_options = accepted_options
+
+    def _parse_option(self, value, minimum):
+        """Returns the integer value of an option, or None if the value is
+        not an integer of at least the given minimum.
+        """
+        try:
+            value = int(value)
+        except ValueError:
+            return None
+        if value < minimum:
+            return None
+        return value
+
     def _handle_initial_read_packet(self, packet):
         """Check if there is an application action to respond to this
         request If so, then send the first block and move the state to
@@ -109,24 +282,96 @@ class TFTPConversation(object):
         Returns:
             A Data packet if the request's filename matches any possible read
             rule. The data packet includes the first block of data from the
-            output of the read action. Otherwise, an ErrorPacket with a file
-            not found error code and message.
+            output of the read action, unless options were negotiated, in
+            which case an OACK is returned and the first block follows its
+            acknowledgement. Otherwise, an ErrorPacket with a file not found
+            error code and message. If the read action returned a Deferred,
+            moves the state to PENDING and returns a NoOpPacket. If there is
+            no room to run the read action, an ErrorPacket saying that the
+            server is busy.
         """
         assert isinstance(packet, packets.ReadRequestPacket)
         self.filename = packet.filename
         self.mode = packet.mode
-        self.read_buffer = self.response_router.initialize_read(
-            self.filename, self.client_host, self.client_port)
+        self._negotiate_options(packet.options, reading=True)
+        try:
+            read_buffer = self.response_router.initialize_read(
+                self.filename, self.client_host, self.client_port)
+        except WorkerPoolFull:
+            self._complete()
+            return self._server_busy("READREQUEST")
+        if isinstance(read_buffer, Deferred):
+            self.state = PENDING
+            self.pending_action = read_buffer
+            return packets.NoOpPacket()
+        return self._begin_reading(read_buffer)
+
+    def _begin_reading(self, read_buffer):
+        """Starts serving the given read buffer by moving the state to READING
+        and producing the first block. If there is no read buffer, moves the
+        state to COMPLETED instead.
+
+        Args:
+            read_buffer: The ReadBuffer produced by the read action, or None
+                if no action matched the request.
+
+        Returns:
+            A DataPacket with the first block of data, an OACK if options were
+            negotiated, or an ErrorPacket with a file not found error code and
+            message. An ErrorPacket as well if the first block cannot be
+            read.
+        """
+        self.read_buffer = read_buffer
         if self.read_buffer:
             self.state = READING
-            data = self.read_buffer.get_block(1)
-            self.current_block_num = 1
-            return packets.DataPacket(1, data)
+            self.rate_limit = self.read_buffer.rate_limit
+            if self.accepted_options:
+                # The client acknowledges the OACK with block number 0, so the
+                # OACK stands in for a block before the first one
+                self.current_block_num = 0
+                self.acked_block_num = -1
+                return packets.OptionAcknowledgementPacket(
+                    self.accepted_options)
+            return self._next_window()
         else:
             self.log("READREQUEST", "File not found")
-            self.state = COMPLETED
+            self._complete()
             return packets.ErrorPacket(1, "File not found. Host: %s, Port: %s"
                 % (self.client_host, self.client_port))
+
+    @lock
+    def resume(self):
+        """Continues a PENDING conversation once its read action has
+        completed, moving the state to READING, or to COMPLETED if the action
+        failed. Caches the output packet like handle_packet does.
+
+        If the action could not run because the action pool was full, as
+        happens to a request coalesced with one that found it full, the
+        client is told that the server is busy.
+
+        Returns:
+            The packet to send to the client. A NoOpPacket if the conversation
+            is not PENDING.
+        """
+        if self.state != PENDING:
+            return packets.NoOpPacket()
+        deferred = self.pending_action
+        self.pending_action = None
+        if isinstance(deferred.error, WorkerPoolFull):
+            self._complete()
+            return self._server_busy("READREQUEST")
+        if deferred.error is not None:
+            self.log("READREQUEST", "Action failed: %s" % deferred.error)
+            self._complete()
+            return packets.ErrorPacket(
+                0, "Read action failed. Host: %s, Port: %s"
+                % (self.client_host, self.client_port))
+        output_packet = self._begin_reading(deferred.result)
+        if not isinstance(output_packet, packets.ErrorPacket):
+            self.cached_packet = output_packet
+            self._reset_retry_and_time_data()
+        return output_packet
+
     def _handle_initial_write_packet(self, packet):
 
         """ Check if there is an application action to receive this message.
@@ -138,21 +383,30 @@ class TFTPConversation(object):
 
         Returns:
             An Acknowledgement packet if the request's filename matches any
-            possible write rule. Otherwise, an ErrorPacket with an access
-            violation code and message.
+            possible write rule, or an OACK if options were negotiated.
+            Otherwise, an ErrorPacket with an access violation code and
+            message.
         """
         assert isinstance(packet, packets.WriteRequestPacket)
         self.filename = packet.filename
         self.mode = packet.mode
+        self._negotiate_options(packet.options)
         self.current_block_num = 0
         self.write_action = self.response_router.initialize_write(
             self.filename, self.client_host, self.client_port)
-        if self.write_action:
+        if callable(getattr(self.write_action, "write", None)):
+            self.write_sink = self.write_action
+            self.write_action = None
+        if self.write_action or self.write_sink:
             self.state = WRITING
-            self.write_buffer = WriteBuffer()
+            if self.write_action:
+                self.write_buffer = WriteBuffer()
+            if self.accepted_options:
+                return packets.OptionAcknowledgementPacket(
+                    self.accepted_options)
             return packets.AcknowledgementPacket(0)
         else:
-            self.state = COMPLETED
+            self._complete()
             self.log("WRITEREQUEST", "Access Violation")
             return packets.ErrorPacket(2, "Access Violation. Host: %s, Port: %s"
                 % (self.client_host, self.client_port))
@@ -160,87 +414,254 @@ class TFTPConversation(object):
     def _handle_read_packet(self, packet):
         """Takes a packet from the client and advances the state machine
         depending on that packet. This should only be invoked from the READING
-        state. Returns an appropriate DataPacket containing the next block of
-        data.
+        state. Returns the next window of DataPackets, starting right after
+        the acknowledged block.
+
+        As RFC 7440 describes, the client acknowledges the last block of a
+        window, or the last block it received in order if some of the window
+        went missing. Either way the next window starts after the
+        acknowledged block. Acknowledgements of blocks that were already
+        acknowledged, or that were never sent, are ignored. Block numbers
+        on the wire roll over, so acknowledgements are matched to the latest
+        block sent with the same number.
 
         Args:
             packet: A packet object that has already been unpacked.
 
         Returns:
-            a packet object with which to send back to the client.
+            a packet object with which to send back to the client, or a list
+            of DataPackets if the window holds several blocks.
         """
         assert self.state == READING
         if not isinstance(packet, packets.AcknowledgementPacket):
             return packets.ErrorPacket(0, "Illegal packet type given"
                   " current state of conversation.  Host: %s, Port: %s."
                   % (self.client_host, self.client_port))
-        if self.current_block_num != packet.block_num:
+        block_num = packets.unwrap_block_number(packet.block_num,
+                                                self.current_block_num,
+                                                self.block_rollover)
+        if not self.acked_block_num < block_num <= self.current_block_num:
             return packets.NoOpPacket()
 
-        previous_block_num = packet.block_num
-        if previous_block_num == self.read_buffer.get_block_count():
-            self.state = COMPLETED
+        self.acked_block_num = block_num
+        self.read_buffer.release(self.acked_block_num)
+        block_count = self.read_buffer.get_block_count(self.block_size)
+        if self.acked_block_num == block_count:
+            self._complete()
             self.log("READREQUEST", "Success")
             return packets.NoOpPacket()
         else:
-            self.current_block_num += 1
-            data = self.read_buffer.get_block(self.current_block_num)
-            return packets.DataPacket(self.current_block_num, data)
+            return self._next_window()
+
+    def _next_window(self):
+        """Produces the DataPackets of up to window_size blocks following the
+        most recently acknowledged block. The window ends early at the last
+        block, the first one shorter than the block size, so the amount of
+        blocks need not be known in advance.
+
+        Returns:
+            A DataPacket if the window holds a single block, otherwise a list
+            of DataPackets. If the read buffer fails to produce a block, moves
+            the state to COMPLETED and returns an ErrorPacket.
+        """
+        window = []
+        try:
+            for block_num in xrange(self.acked_block_num + 1,
+                                    self.acked_block_num + self.window_size
+                                    + 1):
+                data = self.read_buffer.get_block(block_num, self.block_size)
+                window.append(packets.DataPacket(
+                    packets.wrap_block_number(block_num, self.block_rollover),
+                    data))
+                if len(data) < self.block_size:
+                    break
+        except Exception as ex:
+            self.log("READREQUEST", "Reading failed: %s" % ex)
+            self._complete()
+            return packets.ErrorPacket(
+                0, "Read action failed. Host: %s, Port: %s"
+                % (self.client_host, self.client_port))
+        self.current_block_num = block_num
+        if len(window) == 1:
+            return window[0]
+        return window
 
     def _handle_write_packet(self, packet):
         """Takes a packet from the client and advances the state machine
         depending on that packet. This should only be invoked from the WRITING
         state. If given the last packet in a data transfer (bytes of data is
-        less than 512), then invokes the application level action with all of
-        the data from the conversation.
+        less than the block size), then invokes the application level action
+        with all of the data from the conversation. With a write sink, every
+        block goes to the sink as it arrives, and the sink is closed after the
+        last one.
 
         Args:
             packet: A packet object that has already been unpacked.
 
         Returns:
             An appropriate AcknowledgementPacket containing a matching block
-            number.
+            number. If there is no room to run the write action, an
+            ErrorPacket saying that the server is busy. If the write action
+            or the write sink fails, an ErrorPacket saying so.
         """
         assert self.state == WRITING
         if not isinstance(packet, packets.DataPacket):
             return packets.ErrorPacket(0, "Illegal packet type given"
                                           " current state of conversation")
         # Add one because acknowledgements are always behind one block number
-        if self.current_block_num + 1 != packet.block_num:
+        block_num = packets.wrap_block_number(self.current_block_num + 1,
+                                              self.block_rollover)
+        if block_num != packet.block_num:
             return packets.NoOpPacket()
 
-        block_num = packet.block_num
-        self.write_buffer.receive_data(packet.data)
-        if len(packet.data) < 512:
-            self.state = COMPLETED
+        if self.write_sink:
+            try:
+                self.write_sink.write(packet.data)
+            except Exception as ex:
+                return self._write_failed(ex)
+        else:
+            self.write_buffer.receive_data(packet.data)
+        if len(packet.data) < self.block_size:
+            try:
+                result = self._finish_writing()
+            except WorkerPoolFull:
+                return self._server_busy("WRITEREQUEST")
+            except Exception as ex:
+                return self._write_failed(ex)
             self.log("WRITEREQUEST", "Success")
-            self.write_action(self.client_host, self.client_port,
-                              self.filename, self.write_buffer.data)
+            if isinstance(result, Deferred):
+                result.add_callback(self._log_deferred_write)
         self.current_block_num += 1
         return packets.AcknowledgementPacket(block_num)
 
+    def _finish_writing(self):
+        """Moves the state to COMPLETED and hands the upload over, by
+        running the write action with all of the data or by closing the
+        write sink.
+
+        Returns:
+            The result of the write action, or of closing the write sink.
+        """
+        if self.write_sink:
+            write_sink = self.write_sink
+            # A sink that is closed must not be aborted as well
+            self.write_sink = None
+            self._complete()
+            return write_sink.close()
+        data = self.write_buffer.data
+        self._complete()
+        return self.write_action(self.client_host, self.client_port,
+                                 self.filename, data)
+
+    def _write_failed(self, error):
+        """Moves the state to COMPLETED after the write action or the write
+        sink failed, and returns an ErrorPacket saying so.
+
+        Args:
+            error: The exception raised by the action or the sink.
+        """
+        self.log("WRITEREQUEST", "Action failed: %s" % error)
+        self._complete()
+        return packets.ErrorPacket(0, "Write action failed. Host: %s, Port: %s"
+            % (self.client_host, self.client_port))
+
+    def _handle_late_packet(self, packet):
+        """Takes a packet that arrived after the conversation completed. A
+        writing client whose acknowledgement of the final DATA packet was lost
+        sends that packet again, and gets the acknowledgement again.
+        Everything else is ignored.
+
+        Args:
+            packet: A packet object that has already been unpacked.
+
+        Returns:
+            The cached AcknowledgementPacket if the packet repeats the final
+            DATA packet, otherwise a NoOpPacket.
+        """
+        if (isinstance(packet, packets.DataPacket)
+                and isinstance(self.cached_packet,
+                               packets.AcknowledgementPacket)
+                and packet.block_num == self.cached_packet.block_num):
+            return self.cached_packet
+        return packets.NoOpPacket()
+
+    def _complete(self):
+        """Moves the state to COMPLETED and releases the buffers, so that a
+        finished conversation that lingers as a tombstone holds on to no
+        file data. A write sink that is still open belongs to an upload that
+        failed, and is aborted.
+        """
+        self.state = COMPLETED
+        if self.read_buffer:
+            self.read_buffer.close()
+        if self.write_sink:
+            try:
+                self.write_sink.abort()
+            except Exception as ex:
+                self.log("WRITEREQUEST", "Aborting failed: %s" % ex)
+        self.read_buffer = None
+        self.write_buffer = None
+        self.write_sink = None
+        self.pending_action = None
+
+    @lock
+    def give_up(self):
+        """Moves the state to COMPLETED once the client stopped answering,
+        releasing the buffers and aborting an unfinished upload.
+        """
+        if self.state == WRITING:
+            self.log("WRITEREQUEST", "Timed out")
+        elif self.state != COMPLETED:
+            self.log("READREQUEST", "Timed out")
+        self._complete()
+
+    def _server_busy(self, request_type):
+        """Returns an ErrorPacket for a request whose action could not be run
+        because the action pool is full.
+
+        Args:
+            request_type: READREQUEST or WRITEREQUEST, used for logging.
+        """
+        self.log(request_type, "Server busy")
+        return packets.ErrorPacket(0, "Server busy. Host: %s, Port: %s"
+            % (self.client_host, self.client_port))
+
+    def _log_deferred_write(self, deferred):
+        """Logs the outcome of a write action that returned a Deferred."""
+        if deferred.error is not None:
+            self.log("WRITEREQUEST", "Action failed: %s" % deferred.error)
+
     def _reset_retry_and_time_data(self, new_time_of_last_interaction=None):
         """Resets the time since last interaction to the new time and sets the
         retries made count to 0.
 
         Args:
             new_time_of_last_interaction: The time to set the
-                time_since_last_interaction to (seconds since epoch). If None
-                passed, then use the current time since epoch.
+                time_since_last_interaction to (on the monotonic clock). If
+                None passed, then use the current time.
         """
         self._update_time_of_last_interaction(new_time_of_last_interaction)
         self.retries_made = 0
 
+    @lock
+    def mark_sent(self):
+        """Restarts the resend timeout, for when the most recent outward
+        packet went out later than it was produced.
+        """
+        self._update_time_of_last_interaction()
+
     @lock
     def mark_retry(self, new_time_of_last_interaction=None):
         """Increases the stored count of sending attempts made with the most
-        recent outward packet.
+        recent outward packet, and backs off the retransmission timeout.
 
         Returns:
-            The packet to send out.
+            The packet to send out, or the list of DataPackets of the window
+            to send out again.
         """
         self._update_time_of_last_interaction(new_time_of_last_interaction)
         self.retries_made += 1
+        self.rtt_estimator.back_off()
         return self.cached_packet
 
     def _update_time_of_last_interaction(self,
@@ -248,12 +669,12 @@ class TFTPConversation(object):
         """Sets the time of the last interaction for this conversation.
 
         Args:
-            new_time_of_last_interaction: An integer representing seconds since
-            epoch to be used as the new time_of_last_intersection. If None is
-            passed, uses the current amount of seconds since epoch.
+            new_time_of_last_interaction: The time on the monotonic clock to
+            be used as the new time_of_last_intersection. If None is passed,
+            uses the current time.
         """
         if not new_time_of_last_interaction:
-            new_time_of_last_interaction = calendar.timegm(time.gmtime())
+            new_time_of_last_interaction = monotonic()
         self.time_of_last_interaction = new_time_of_last_interaction
 
     def log(self, request_type, comment):
@@ -1,11 +1,16 @@
+import functools
+
+
 def lock(function):
     """A decorator to use to lock an instance of a class. The instance must
     have a `lock` instance variable already initialized.
     """
-    def decorator(self, *args):
+    @functools.wraps(function)
+    def decorator(self, *args, **kwargs):
         self.lock.acquire()
-        natural_return_value = function(self, *args)
-        self.lock.release()
-        return natural_return_value
+        try:
+            return function(self, *args, **kwargs)
+        finally:
+            self.lock.release()
 
     return decorator
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+"""
+    batch_io_bench
+
+Measures how many datagrams per second BatchIO moves over loopback at
+different batch sizes. For each batch size, a forked echo server receives and
+sends back datagrams in batches, while the client keeps a fixed amount of
+datagrams in flight, also sending and receiving in batches. A batch size of 1
+uses a recvfrom or sendto call per datagram.
+"""
+import gflags
+import os
+import select
+import signal
+import socket
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from batch_io import BATCH_SYSCALLS_AVAILABLE, BatchIO
+
+FLAGS = gflags.FLAGS
+
+
+def echo(sock, batch_size):
+    """Echoes every datagram back to its sender. Never returns."""
+    batch_io = BatchIO(batch_size)
+    poller = select.epoll()
+    poller.register(sock.fileno(), select.EPOLLIN)
+    while True:
+        poller.poll()
+        while True:
+            datagrams = batch_io.recv(sock)
+            if not datagrams:
+                break
+            batch_io.send(sock, datagrams)
+
+
+def start_server(batch_size):
+    """Forks an echo server process.
+
+    Returns:
+        A tuple of (process id, server address).
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.setblocking(0)
+    pid = os.fork()
+    if pid == 0:
+        try:
+            echo(sock, batch_size)
+        finally:
+            os._exit(0)
+    address = sock.getsockname()
+    sock.close()
+    return pid, address
+
+
+def run_client(address, batch_size, in_flight, payload_size, duration):
+    """Keeps `in_flight` datagrams circulating through the echo server for
+    `duration` seconds.
+
+    Returns:
+        The amount of datagrams echoed back.
+    """
+    batch_io = BatchIO(batch_size)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.setblocking(0)
+    poller = select.epoll()
+    poller.register(sock.fileno(), select.EPOLLIN)
+    datagram = ("X" * payload_size, address)
+    batch_io.send(sock, [datagram] * in_flight)
+
+    received = 0
+    deadline = time.time() + duration
+    last_reply = time.time()
+    while time.time() < deadline:
+        poller.poll(0.1)
+        while True:
+            datagrams = batch_io.recv(sock)
+            if not datagrams:
+                break
+            received += len(datagrams)
+            last_reply = time.time()
+            batch_io.send(sock, [datagram] * len(datagrams))
+        # Top up datagrams lost to full socket buffers
+        if time.time() - last_reply > 0.1:
+            batch_io.send(sock, [datagram] * in_flight)
+            last_reply = time.time()
+    sock.close()
+    poller.close()
+    return received
+
+
+def bench(batch_size):
+    pid, address = start_server(batch_size)
+    time.sleep(0.2)
+    try:
+        received = run_client(address, batch_size, FLAGS.in_flight,
+                              FLAGS.payload_size, FLAGS.duration)
+    finally:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+    return received / FLAGS.duration
+
+
+def main():
+    gflags.DEFINE_list("batch_sizes", ["1", "4", "16", "64"],
+                       "batch sizes to measure", short_name="b")
+    gflags.DEFINE_float("duration", 3.0, "seconds to run each batch size",
+                        short_name="d")
+    gflags.DEFINE_integer("in_flight", 256, "datagrams kept in flight", 1,
+                          short_name="n")
+    gflags.DEFINE_integer("payload_size", 516, "bytes per datagram", 1,
+                          short_name="s")
+    FLAGS(sys.argv)
+
+    if not BATCH_SYSCALLS_AVAILABLE:
+        print "recvmmsg/sendmmsg unavailable, measuring the fallback only"
+    print "%-12s %14s" % ("batch size", "packets/sec")
+    for batch_size in FLAGS.batch_sizes:
+        print "%-12s %14.1f" % (batch_size, bench(int(batch_size)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+"""
+    codec_bench
+
+Measures how long packing and unpacking each kind of packet takes, for the
+packets that make up the bulk of a transfer (DATA and ACK) and for requests,
+errors and option acknowledgements.
+"""
+import gflags
+import os
+import sys
+import timeit
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+import packets
+
+FLAGS = gflags.FLAGS
+
+PACKETS = [
+    ("RRQ", packets.ReadRequestPacket("pxelinux.cfg/01-00-11-22-33-44-55",
+                                      "octet", {"blksize": "1428",
+                                                "tsize": "0"})),
+    ("DATA 512", packets.DataPacket(1234, "x" * 512)),
+    ("DATA 1428", packets.DataPacket(1234, "x" * 1428)),
+    ("ACK", packets.AcknowledgementPacket(1234)),
+    ("ERROR", packets.ErrorPacket(1, "File not found")),
+    ("OACK", packets.OptionAcknowledgementPacket({"blksize": "1428",
+                                                  "tsize": "1048576"})),
+]
+
+
+def measure(function):
+    """Returns the best time of a function call in nanoseconds."""
+    timer = timeit.Timer(function)
+    return min(timer.repeat(FLAGS.repeat, FLAGS.number)) / FLAGS.number * 1e9
+
+
+def main():
+    gflags.DEFINE_integer("number", 100000, "calls per measurement", 1,
+                          short_name="n")
+    gflags.DEFINE_integer("repeat", 5, "measurements, of which the best is "
+                          "reported", 1, short_name="r")
+    FLAGS(sys.argv)
+
+    print "%-10s %10s %12s" % ("packet", "pack (ns)", "unpack (ns)")
+    for name, packet in PACKETS:
+        data = packet.pack()
+        assert packets.unpack_packet(data).pack() == data
+        print "%-10s %10.0f %12.0f" % (
+            name, measure(packet.pack),
+            measure(lambda: packets.unpack_packet(data)))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,130 +2,527 @@
 """
     emmer_bench
 
-Furiously nukes the TFTP server with file requests, abandoning some and being
-illegal in some cases. May or may not later be extended to be more
-customizable.
+Measures the capacity of a TFTP server by loading it with many concurrent
+clients. A single event loop drives every client, each on a socket of its
+own, so that one process keeps tens of thousands of transfers going. Clients
+read and write files of the given sizes, optionally negotiating blksize and
+windowsize, drop packets in either direction at random and resend after a
+timeout like a real client would. A client that finishes a transfer starts
+the next one straight away.
+
+Without a host, a server is forked onto a local port that serves reads of
+bench/<size> with <size> bytes and accepts every write. Any other server
+should route the same filenames, see --filename.
+
+Results are printed as a single JSON object: transfers completed and failed,
+transfers per second, payload throughput, and the p50, p99 and p999 transfer
+latency in milliseconds.
 """
+import errno
 import gflags
+import json
+import math
 import os
 import random
+import resource
+import signal
 import socket
 import sys
-import threading
 import time
 
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
 
+import config
 import packets
+from clock import monotonic
+from conversation_table import ShardedConversationTable
+from performer import Performer
+from reactor import EventLoopReactor, Poller
+from response_router import ResponseRouter
+from scheduler import TimerHeap
 
 FLAGS = gflags.FLAGS
 
-class ProgressState(object):
-    """A shared object that stores the shared state of the script"""
-    def __init__(self, concurrency, host, port, requests, filenames):
-        self.concurrency = concurrency
-        self.host = host
-        self.port = port
-        self.requests = requests
-        self.filenames = filenames
-        self.conversations = self.requests
-        self.lock = threading.Lock()
-        self.threads = []
-
-    def get_filename(self):
-        return random.choice(self.filenames)
+# File descriptors kept free for everything but the client sockets
+RESERVED_FILE_DESCRIPTORS = 64
 
 
-def run_conversation(state, thread_num):
+def serve(sock, batch_size):
+    """Runs a single threaded Emmer server on an already bound socket, the
+    way Emmer.serve does, with the timeouts, tombstones and option limits of
+    the configuration. Never returns.
     """
-    Run a single TFTP conversation against the TFTP server. Acts as a lousy client
-    through the following properties:
-    * Waits between two and six seconds before responding to a received message
-    * Has a chance of dropping the connection after receiving any particular
-      message.
-    * In some cases will stall for twenty seconds before responding to a
-      received message.
+    router = ResponseRouter()
+    payloads = {}
+
+    def read_action(host, port, filename):
+        size = int(filename.rsplit("/", 1)[1])
+        if size not in payloads:
+            payloads[size] = "X" * size
+        return payloads[size]
+
+    router.append_read_rule(r"bench/\d+$", read_action)
+    router.append_write_rule(".*", lambda host, port, filename, data: None)
+    table = ShardedConversationTable(config.CONVERSATION_TABLE_SHARDS,
+                                     config.TOMBSTONE_LIFETIME)
+    performer = Performer(sock, table, config.RESEND_TIMEOUT,
+                          config.RETRIES_BEFORE_GIVEUP, batch_size,
+                          config.MIN_RESEND_TIMEOUT,
+                          config.MAX_RESEND_TIMEOUT)
+    reactor = EventLoopReactor(sock, router, table, performer=performer,
+                               housekeeping_interval=
+                               config.PERFORMER_THREAD_INTERVAL,
+                               batch_size=batch_size,
+                               max_block_size=config.MAX_BLOCK_SIZE,
+                               max_window_size=config.MAX_WINDOW_SIZE,
+                               block_rollover=config.BLOCK_ROLLOVER)
+    reactor.run()
+
+
+def start_server(batch_size):
+    """Forks a server process.
+
+    Returns:
+        A tuple of (process id, server address).
     """
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    port = random.randint(2000, 65535)
+    sock.bind(("127.0.0.1", 0))
+    pid = os.fork()
+    if pid == 0:
+        try:
+            serve(sock, batch_size)
+        finally:
+            os._exit(0)
+    address = sock.getsockname()
+    sock.close()
+    return pid, address
 
-    sock.bind(("0.0.0.0", port))
 
-    packet_data =  packets.ReadRequestPacket(state.get_filename(), "netascii").pack()
-    print state.host, state.port
-    sock.sendto(packet_data, (state.host, state.port))
+def raise_file_limit(needed):
+    """Raises the soft limit on open files to fit the client sockets, as far
+    as the hard limit allows.
 
-    finished = False
-    while not finished:
-        response = sock.recvfrom(1024)
-        packet_data = response[0]
-        response_packet = packets.unpack_packet(packet_data)
-        print "  [thread_num: %s][outward_port: %s] received %s" % (thread_num, port, response_packet)
+    Returns:
+        Whether the limit fits them.
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft >= needed:
+        return True
+    limit = needed
+    if hard != resource.RLIM_INFINITY:
+        limit = min(needed, hard)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard))
+    return hard == resource.RLIM_INFINITY or hard >= needed
 
-        # A data packet of under size 512 is considered a final packet
-        if len(response_packet.data) < 512:
-            finished = True
 
-        # Implement the lousy client properties as described in docstring
-        time.sleep(random.randint(2, 6))
-        if random.randint(0, 8) == 0:
-            finished = True
-        if random.randint(0, 8) == 0:
-            time.sleep(20)
+def percentile(sorted_values, fraction):
+    """Returns the nearest rank percentile of a sorted list, or None if it is
+    empty.
 
-        ack_packet =  packets.AcknowledgementPacket(response_packet.block_num)
-        print "  [%s][%s] sending %s" % (thread_num, port, ack_packet)
-        sock.sendto(ack_packet.pack(), (state.host, state.port))
+    Args:
+        sorted_values: The values, in ascending order.
+        fraction: The percentile as a fraction, such as 0.99 for p99.
+    """
+    if not sorted_values:
+        return None
+    rank = int(math.ceil(fraction * len(sorted_values))) - 1
+    return sorted_values[max(0, min(rank, len(sorted_values) - 1))]
 
-    sock.close()
+
+class Client(object):
+    """A simulated client and the transfer that it is running.
+
+    Properties:
+        sock: The client's socket, reused for every transfer it runs.
+        server_addr: Where packets go. The server's address until it answers
+            a request, then the address it answered from, which differs for
+            servers that answer from per transfer sockets.
+        writing: Whether the transfer is a write rather than a read.
+        size: The size of the file transferred, in bytes.
+        block_num: The blocks received in order when reading, or the blocks
+            acknowledged when writing, counted from the start of the transfer
+            without rolling over.
+        block_size: The block size of the transfer, as negotiated.
+        window_size: The blocks the server sends before waiting for an
+            acknowledgement, as negotiated.
+        unacknowledged: When reading, the blocks received in order since
+            the last acknowledgement.
+        pending_bytes: When writing, the bytes of the block awaiting
+            acknowledgement. None until the server accepts the request.
+        last_packet: The most recently sent packet, packed, for resends.
+            None when the client runs no transfer.
+        retries: Resends of last_packet so far.
+        started: The time on the monotonic clock that the transfer began.
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        self.server_addr = None
+        self.writing = False
+        self.size = 0
+        self.block_num = 0
+        self.block_size = packets.DEFAULT_BLOCK_SIZE
+        self.window_size = packets.DEFAULT_WINDOW_SIZE
+        self.unacknowledged = 0
+        self.pending_bytes = None
+        self.last_packet = None
+        self.retries = 0
+        self.started = 0
 
 
-def run_thread(state, thread_num):
-    """Runs a single request thread. The thread will take one away from the
-    remaining conversations counter and then run a single conversation with the
-    TFTP server until the remaining conversations counter hits zero.
+class LoadGenerator(object):
+    """A LoadGenerator runs the event loop of many simulated clients against
+    a server, and keeps the statistics of their transfers.
     """
-    while state.conversations > 0:
-        state.lock.acquire()
-        if state.conversations > 0:
-            state.conversations -= 1
-            state.lock.release()
-            run_conversation(state, thread_num)
+    def __init__(self, address, clients, file_sizes, write_ratio,
+                 filename_format, block_size, window_size, loss, timeout,
+                 retries):
+        """
+        Args:
+            address: The address of the server.
+            clients: The amount of concurrent clients.
+            file_sizes: The sizes of the files transferred, one of which is
+                picked at random for every transfer.
+            write_ratio: The share of transfers that are writes.
+            filename_format: The filename of a transfer, formatted with its
+                file size.
+            block_size: The blksize option requested, or 0 to not request
+                one.
+            window_size: The windowsize option requested when reading, or 0
+                to not request one.
+            loss: The chance of each packet sent or received being dropped.
+            timeout: Seconds to wait for an answer before resending.
+            retries: Resends before a transfer fails.
+        """
+        self.address = address
+        self.file_sizes = file_sizes
+        self.write_ratio = write_ratio
+        self.filename_format = filename_format
+        self.loss = loss
+        self.timeout = timeout
+        self.retries = retries
+        self.options = {}
+        if block_size:
+            self.options["blksize"] = str(block_size)
+        self.read_options = dict(self.options)
+        if window_size:
+            self.read_options["windowsize"] = str(window_size)
+        self.payload = "X" * max([packets.DEFAULT_BLOCK_SIZE, block_size])
+
+        self.poller = Poller()
+        self.timers = TimerHeap()
+        self.clients = {}
+        for _ in xrange(clients):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(("", 0))
+            sock.setblocking(0)
+            self.clients[sock.fileno()] = Client(sock)
+            self.poller.register(sock.fileno())
+
+        self.transfer_limit = 0
+        self.started = 0
+        self.completed = 0
+        self.failed = 0
+        self.reads = 0
+        self.writes = 0
+        self.bytes = 0
+        self.packets_sent = 0
+        self.packets_received = 0
+        self.packets_dropped = 0
+        self.resends = 0
+        self.latencies = []
+
+    def run(self, duration, transfers=0):
+        """Runs transfers until the duration is over or, if a transfer limit
+        is given, until that many transfers ended. Transfers still running
+        then are abandoned.
+
+        Args:
+            duration: The most seconds to run for.
+            transfers: The amount of transfers to run, or 0 for no limit.
+
+        Returns:
+            The seconds run for.
+        """
+        self.transfer_limit = transfers
+        start = monotonic()
+        deadline = start + duration
+        for client in self.clients.itervalues():
+            self.start_transfer(client)
+        while monotonic() < deadline and self.timers:
+            wait = deadline - monotonic()
+            next_deadline = self.timers.next_deadline()
+            if next_deadline is not None:
+                wait = min(wait, next_deadline - monotonic())
+            for fileno, _ in self.poller.poll(max(0, wait)):
+                self.receive(self.clients[fileno])
+            for fileno in self.timers.pop_due():
+                self.expire(self.clients[fileno])
+        return monotonic() - start
+
+    def close(self):
+        for client in self.clients.itervalues():
+            client.sock.close()
+
+    def start_transfer(self, client):
+        """Starts the next transfer of a client by sending its request,
+        unless the transfer limit was reached.
+        """
+        if self.transfer_limit and self.started >= self.transfer_limit:
+            client.last_packet = None
+            return
+        self.started += 1
+        client.writing = random.random() < self.write_ratio
+        client.size = random.choice(self.file_sizes)
+        client.server_addr = self.address
+        client.block_num = 0
+        client.block_size = packets.DEFAULT_BLOCK_SIZE
+        client.window_size = packets.DEFAULT_WINDOW_SIZE
+        client.unacknowledged = 0
+        client.pending_bytes = None
+        client.started = monotonic()
+        filename = self.filename_format % client.size
+        if client.writing:
+            self.writes += 1
+            request = packets.WriteRequestPacket(filename, "octet",
+                                                 self.options)
+        else:
+            self.reads += 1
+            request = packets.ReadRequestPacket(filename, "octet",
+                                                self.read_options)
+        self.send(client, request.pack())
+
+    def finish_transfer(self, client, succeeded):
+        """Records the outcome of a client's transfer and starts its next
+        one.
+        """
+        if succeeded:
+            self.completed += 1
+            self.latencies.append(monotonic() - client.started)
+        else:
+            self.failed += 1
+        self.timers.cancel(client.sock.fileno())
+        client.last_packet = None
+        self.start_transfer(client)
+
+    def send(self, client, data):
+        """Sends a packet to the server, unless it is dropped, and waits for
+        the answer until the timeout.
+        """
+        client.last_packet = data
+        client.retries = 0
+        self.transmit(client)
+
+    def transmit(self, client):
+        self.packets_sent += 1
+        self.timers.schedule(client.sock.fileno(),
+                             monotonic() + self.timeout)
+        if self.loss and random.random() < self.loss:
+            self.packets_dropped += 1
+            return
+        try:
+            client.sock.sendto(client.last_packet, client.server_addr)
+        except socket.error as ex:
+            if ex.errno not in (errno.EAGAIN, errno.EWOULDBLOCK,
+                                errno.ENOBUFS):
+                raise
+            self.packets_dropped += 1
+
+    def expire(self, client):
+        """Resends the last packet of a client whose server went quiet, or
+        fails the transfer once out of retries.
+        """
+        if client.retries >= self.retries:
+            self.finish_transfer(client, False)
+            return
+        client.retries += 1
+        self.resends += 1
+        self.transmit(client)
+
+    def receive(self, client):
+        """Handles every datagram waiting on a client's socket."""
+        while True:
+            try:
+                data, addr = client.sock.recvfrom(65536)
+            except socket.error as ex:
+                if ex.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            self.packets_received += 1
+            if self.loss and random.random() < self.loss:
+                self.packets_dropped += 1
+                continue
+            if client.last_packet is None:
+                continue
+            packet = packets.unpack_packet(data)
+            if isinstance(packet, packets.ErrorPacket):
+                self.finish_transfer(client, False)
+                continue
+            client.server_addr = addr
+            if client.writing:
+                self.receive_while_writing(client, packet)
+            else:
+                self.receive_while_reading(client, packet)
+
+    def receive_while_reading(self, client, packet):
+        if isinstance(packet, packets.OptionAcknowledgementPacket):
+            if client.block_num == 0:
+                self.negotiate(client, packet.options)
+                self.send(client, packets.AcknowledgementPacket(0).pack())
+            return
+        if not isinstance(packet, packets.DataPacket):
+            return
+        if packet.block_num != packets.wrap_block_number(client.block_num
+                                                          + 1):
+            # A gap in the window, or a resent block: tell the server where
+            # to go on from
+            if client.block_num:
+                self.send(client, packets.AcknowledgementPacket(
+                    packets.wrap_block_number(client.block_num)).pack())
+            return
+        client.block_num += 1
+        client.unacknowledged += 1
+        self.bytes += len(packet.data)
+        last = len(packet.data) < client.block_size
+        if last or client.unacknowledged >= client.window_size:
+            client.unacknowledged = 0
+            self.send(client,
+                      packets.AcknowledgementPacket(packet.block_num).pack())
+        if last:
+            self.finish_transfer(client, True)
+
+    def receive_while_writing(self, client, packet):
+        if client.pending_bytes is None:
+            # Waiting for the request to be accepted
+            if isinstance(packet, packets.OptionAcknowledgementPacket):
+                self.negotiate(client, packet.options)
+            elif not (isinstance(packet, packets.AcknowledgementPacket)
+                      and packet.block_num == 0):
+                return
+        elif (isinstance(packet, packets.AcknowledgementPacket)
+              and packet.block_num
+              == packets.wrap_block_number(client.block_num + 1)):
+            client.block_num += 1
+            self.bytes += client.pending_bytes
+            if client.pending_bytes < client.block_size:
+                self.finish_transfer(client, True)
+                return
         else:
-            state.lock.release()
+            return
+        offset = client.block_num * client.block_size
+        client.pending_bytes = max(0, min(client.block_size,
+                                          client.size - offset))
+        self.send(client, packets.DataPacket(
+            packets.wrap_block_number(client.block_num + 1),
+            self.payload[:client.pending_bytes]).pack())
+
+    def negotiate(self, client, options):
+        client.block_size = int(options.get("blksize",
+                                            packets.DEFAULT_BLOCK_SIZE))
+        client.window_size = int(options.get("windowsize",
+                                             packets.DEFAULT_WINDOW_SIZE))
+
+    def results(self, elapsed):
+        """Returns the statistics of the run as a dictionary."""
+        latencies = sorted(self.latencies)
+        latency_ms = {}
+        for name, fraction in (("p50", 0.5), ("p99", 0.99), ("p999", 0.999),
+                               ("max", 1.0)):
+            value = percentile(latencies, fraction)
+            latency_ms[name] = None if value is None else value * 1000
+        latency_ms["mean"] = (sum(latencies) / len(latencies) * 1000
+                              if latencies else None)
+        return {
+            "clients": len(self.clients),
+            "seconds": elapsed,
+            "transfers": self.completed,
+            "failed": self.failed,
+            "abandoned": self.started - self.completed - self.failed,
+            "reads": self.reads,
+            "writes": self.writes,
+            "transfers_per_second": self.completed / elapsed,
+            "bytes": self.bytes,
+            "bytes_per_second": self.bytes / elapsed,
+            "packets_sent": self.packets_sent,
+            "packets_received": self.packets_received,
+            "packets_dropped": self.packets_dropped,
+            "resends": self.resends,
+            "latency_ms": latency_ms,
+        }
+
 
 def usage_and_exit():
-    print "Usage: %s hostname filename..." % sys.argv[0]
-    print "Blasts a TFTP server with lousy requests"
+    print "Usage: %s [hostname]" % sys.argv[0]
+    print "Loads a TFTP server, or a local one, with concurrent transfers"
     print FLAGS
     exit(1)
 
+
 def main():
-    gflags.DEFINE_integer("concurrency", 1, "concurrency", 1, short_name="c")
+    gflags.DEFINE_integer("clients", 100, "concurrent clients", 1,
+                          short_name="c")
+    gflags.DEFINE_float("duration", 10.0, "most seconds to run for",
+                        short_name="d")
+    gflags.DEFINE_integer("transfers", 0, "transfers to run, 0 for as many "
+                          "as fit in the duration", 0, short_name="n")
     gflags.DEFINE_integer("port", 69, "port of tftp server", 1, 65535,
                           short_name="p")
-    gflags.DEFINE_integer("requests", 1, "amount of requests to make", 1,
+    gflags.DEFINE_list("file_sizes", ["16384"], "file sizes in bytes, one of "
+                       "which is picked at random for every transfer",
+                       short_name="s")
+    gflags.DEFINE_float("write_ratio", 0.0, "share of transfers that are "
+                        "writes", 0.0, 1.0, short_name="w")
+    gflags.DEFINE_string("filename", "bench/%d", "filename of a transfer, "
+                         "formatted with its file size", short_name="f")
+    gflags.DEFINE_integer("blksize", 0, "blksize option to request, 0 for "
+                          "none", 0, packets.MAX_BLOCK_SIZE, short_name="b")
+    gflags.DEFINE_integer("windowsize", 0, "windowsize option to request "
+                          "when reading, 0 for none", 0,
+                          packets.MAX_WINDOW_SIZE)
+    gflags.DEFINE_float("loss", 0.0, "chance of dropping each packet sent or "
+                        "received", 0.0, 1.0, short_name="l")
+    gflags.DEFINE_float("timeout", 1.0, "seconds to wait before resending",
+                        short_name="t")
+    gflags.DEFINE_integer("retries", 5, "resends before a transfer fails", 0,
                           short_name="r")
+    gflags.DEFINE_integer("batch_size", 64, "datagrams per system call on "
+                          "the local server", 1)
     args = FLAGS(sys.argv)
 
-    if len(args) < 3:
+    if len(args) > 2:
         usage_and_exit()
-    host = args[1]
-    filenames = args[2:]
-
-    # Initialize State
-    state = ProgressState(FLAGS.concurrency, host, FLAGS.port, FLAGS.requests,
-                          filenames)
-
-    # Spawn and run threads
-    for i in xrange(state.concurrency):
-        th = threading.Thread(target=run_thread, args=(state, i))
-        state.threads.append(th)
-        th.start()
-
-    # Wait for threads to finish
-    for th in state.threads:
-        th.join()
+    if FLAGS.blksize and FLAGS.blksize < packets.MIN_BLOCK_SIZE:
+        usage_and_exit()
+    if not raise_file_limit(FLAGS.clients + RESERVED_FILE_DESCRIPTORS):
+        print "Too many clients for the limit on open files"
+        exit(1)
+
+    pid = None
+    if len(args) == 2:
+        address = (socket.gethostbyname(args[1]), FLAGS.port)
+    else:
+        pid, address = start_server(FLAGS.batch_size)
+        time.sleep(0.5)
+    generator = LoadGenerator(address, FLAGS.clients,
+                              [int(size) for size in FLAGS.file_sizes],
+                              FLAGS.write_ratio, FLAGS.filename,
+                              FLAGS.blksize, FLAGS.windowsize, FLAGS.loss,
+                              FLAGS.timeout, FLAGS.retries)
+    try:
+        elapsed = generator.run(FLAGS.duration, FLAGS.transfers)
+    finally:
+        generator.close()
+        if pid:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+    results = generator.results(elapsed)
+    results["options"] = {
+        "file_sizes": [int(size) for size in FLAGS.file_sizes],
+        "write_ratio": FLAGS.write_ratio,
+        "blksize": FLAGS.blksize,
+        "windowsize": FLAGS.windowsize,
+        "loss": FLAGS.loss,
+    }
+    print json.dumps(results, indent=2, sort_keys=True)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""
+    memory_bench
+
+Measures the memory that idle conversations take up in the conversation
+table, and the memory and construction time of the packets that pass
+through the server by the million. Memory is measured as the growth of the
+process's resident set while the objects are alive, divided by their count.
+"""
+import gc
+import gflags
+import os
+import resource
+import sys
+import timeit
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+import packets
+from conversation_table import ShardedConversationTable
+from tftp_conversation import TFTPConversation
+
+FLAGS = gflags.FLAGS
+
+PAGE_SIZE = resource.getpagesize()
+
+
+def resident_bytes():
+    """Returns the resident set size of the process in bytes."""
+    gc.collect()
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * PAGE_SIZE
+
+
+def idle_conversations(count):
+    """Fills a conversation table with conversations that sent a packet and
+    wait for the answer, as an idle client leaves them.
+    """
+    table = ShardedConversationTable()
+    for i in xrange(count):
+        host = "10.%d.%d.%d" % (i >> 16 & 255, i >> 8 & 255, i & 255)
+        conversation = TFTPConversation(host, 69, None)
+        conversation.cached_packet = packets.AcknowledgementPacket(1)
+        table.add_conversation(host, 69, conversation)
+    return table
+
+
+def bytes_per_object(create, count):
+    """Returns the resident memory that each of count objects takes up."""
+    before = resident_bytes()
+    objects = create(count)
+    after = resident_bytes()
+    del objects
+    return float(after - before) / count
+
+
+def main():
+    gflags.DEFINE_integer("conversations", 100000, "idle conversations", 1,
+                          short_name="c")
+    gflags.DEFINE_integer("packets", 1000000, "packets of each kind", 1,
+                          short_name="p")
+    FLAGS(sys.argv)
+
+    data = "x" * 512
+    kinds = [
+        ("TFTPConversation", FLAGS.conversations, idle_conversations, None),
+        ("DataPacket", FLAGS.packets,
+         lambda count: [packets.DataPacket(i, data) for i in xrange(count)],
+         lambda: packets.DataPacket(1, data)),
+        ("AcknowledgementPacket", FLAGS.packets,
+         lambda count: [packets.AcknowledgementPacket(i)
+                        for i in xrange(count)],
+         lambda: packets.AcknowledgementPacket(1)),
+    ]
+    print "%-22s %10s %12s" % ("object", "bytes", "create (ns)")
+    for name, count, create, create_one in kinds:
+        size = bytes_per_object(create, count)
+        if create_one:
+            create_time = min(timeit.Timer(create_one).repeat(5, 100000))
+            print "%-22s %10.0f %12.0f" % (name, size, create_time * 1e4)
+        else:
+            print "%-22s %10.0f %12s" % (name, size, "-")
+
+
+if __name__ == "__main__":
+    main()
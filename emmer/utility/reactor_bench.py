@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+"""
+    reactor_bench
+
+Compares read throughput of the thread per message Reactor against the
+EventLoopReactor. For each reactor, a server is forked onto a local port and a
+single event loop driven client runs many concurrent lock-step read transfers
+against it for a fixed duration.
+"""
+import gflags
+import os
+import select
+import signal
+import socket
+import sys
+import thread
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+import packets
+from conversation_table import ConversationTable
+from performer import Performer
+from reactor import EventLoopReactor, Reactor
+from response_router import ResponseRouter
+from worker_pool import WorkerPool
+
+FLAGS = gflags.FLAGS
+
+
+def serve(sock, event_loop, file_size, workers, batch_size):
+    """Runs an Emmer server on an already bound socket. Never returns."""
+    action_pool = WorkerPool(workers)
+    action_pool.start()
+    router = ResponseRouter(action_pool)
+    payload = "X" * file_size
+    router.append_read_rule(".*", lambda host, port, filename: payload)
+    table = ConversationTable()
+    if event_loop:
+        reactor = EventLoopReactor(sock, router, table,
+                                   batch_size=batch_size)
+    else:
+        reactor = Reactor(sock, router, table)
+    performer = Performer(sock, table, 5, 6, batch_size)
+    thread.start_new_thread(performer.run, (1,))
+    reactor.run()
+
+
+def start_server(event_loop, file_size, workers, batch_size):
+    """Forks a server process.
+
+    Returns:
+        A tuple of (process id, server address).
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    pid = os.fork()
+    if pid == 0:
+        try:
+            serve(sock, event_loop, file_size, workers, batch_size)
+        finally:
+            os._exit(0)
+    address = sock.getsockname()
+    sock.close()
+    return pid, address
+
+
+def run_clients(address, concurrency, duration):
+    """Runs `concurrency` lock-step read clients for `duration` seconds.
+
+    Returns:
+        A tuple of (transfers completed, packets received).
+    """
+    poller = select.epoll()
+    clients = {}
+    request = packets.ReadRequestPacket("bench", "octet").pack()
+    for _ in xrange(concurrency):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(("127.0.0.1", 0))
+        sock.setblocking(0)
+        clients[sock.fileno()] = [sock, time.time()]
+        poller.register(sock.fileno(), select.EPOLLIN)
+        sock.sendto(request, address)
+
+    transfers = 0
+    received = 0
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        for fileno, _ in poller.poll(0.1):
+            client = clients[fileno]
+            sock = client[0]
+            data = sock.recv(1024)
+            received += 1
+            packet = packets.unpack_packet(data)
+            if not isinstance(packet, packets.DataPacket):
+                continue
+            sock.sendto(packets.AcknowledgementPacket(packet.block_num).pack(),
+                        address)
+            if len(packet.data) < 512:
+                transfers += 1
+                sock.sendto(request, address)
+            client[1] = time.time()
+        # Restart transfers that have stalled on a lost packet
+        now = time.time()
+        for client in clients.itervalues():
+            if now - client[1] > 1:
+                client[0].sendto(request, address)
+                client[1] = now
+
+    for client in clients.itervalues():
+        client[0].close()
+    poller.close()
+    return transfers, received
+
+
+def bench(event_loop):
+    pid, address = start_server(event_loop, FLAGS.file_size, FLAGS.workers,
+                                FLAGS.batch_size)
+    time.sleep(0.5)
+    try:
+        transfers, received = run_clients(address, FLAGS.concurrency,
+                                          FLAGS.duration)
+    finally:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+    return transfers / FLAGS.duration, received / FLAGS.duration
+
+
+def main():
+    gflags.DEFINE_integer("concurrency", 64, "concurrent clients", 1,
+                          short_name="c")
+    gflags.DEFINE_float("duration", 5.0, "seconds to run each reactor",
+                        short_name="d")
+    gflags.DEFINE_integer("file_size", 16384, "bytes served per transfer", 0,
+                          short_name="s")
+    gflags.DEFINE_integer("workers", 8, "action worker threads", 1,
+                          short_name="w")
+    gflags.DEFINE_integer("batch_size", 1,
+                          "datagrams per system call on the event loop", 1,
+                          short_name="b")
+    FLAGS(sys.argv)
+
+    print "%-12s %14s %14s" % ("reactor", "transfers/sec", "packets/sec")
+    for name, event_loop in (("threaded", False), ("event_loop", True)):
+        transfers, received = bench(event_loop)
+        print "%-12s %14.1f %14.1f" % (name, transfers, received)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""
+    route_bench
+
+Measures how long finding the route of a request takes with many routes, as
+an application that registers a route per client host has. Every host gets a
+route of its own, with a catch-all route at the end, and requests are looked
+up for random hosts and for files that only the catch-all route matches.
+
+The RouteIndex of the ResponseRouter is compared with trying every route's
+pattern in turn, as the ResponseRouter used to.
+"""
+import gflags
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from response_router import ResponseRouter
+
+FLAGS = gflags.FLAGS
+
+
+def linear_find(rules, filename):
+    """Finds the first matching route by trying every route's pattern."""
+    for route in rules:
+        if re.match(route.filename_pattern, filename):
+            return route
+    return None
+
+
+def host_pattern(i):
+    return "hosts/10.%d.%d.%d/.*" % (i >> 16 & 255, i >> 8 & 255, i & 255)
+
+
+def create_filenames(routes, lookups):
+    filenames = []
+    for _ in xrange(lookups):
+        i = random.randrange(routes)
+        if random.random() < FLAGS.miss_ratio:
+            filenames.append("shared/%d.cfg" % i)
+        else:
+            filenames.append(host_pattern(i).replace(".*", "pxelinux.cfg"))
+    return filenames
+
+
+def bench(routes):
+    router = ResponseRouter()
+    start = time.time()
+    for i in xrange(routes):
+        router.append_read_rule(host_pattern(i), None)
+    router.append_read_rule(".*", None)
+    registration = time.time() - start
+    filenames = create_filenames(routes, FLAGS.lookups)
+    results = []
+    for find in (linear_find, router.find_route):
+        start = time.time()
+        for filename in filenames:
+            find(router.read_rules, filename)
+        results.append((time.time() - start) / len(filenames) * 1e6)
+    for filename in filenames[:100]:
+        assert (linear_find(router.read_rules, filename)
+                is router.find_route(router.read_rules, filename))
+    return (registration,) + tuple(results)
+
+
+def main():
+    gflags.DEFINE_list("routes", ["10", "100", "1000", "10000"],
+                       "route counts to measure", short_name="r")
+    gflags.DEFINE_integer("lookups", 200, "lookups per route count", 1,
+                          short_name="l")
+    gflags.DEFINE_float("miss_ratio", 0.1,
+                        "share of lookups that only the catch-all matches")
+    FLAGS(sys.argv)
+
+    print "%-8s %18s %16s %16s" % ("routes", "registration (s)",
+                                   "linear (us)", "indexed (us)")
+    for routes in FLAGS.routes:
+        print "%-8s %18.3f %16.1f %16.1f" % ((routes,) + bench(int(routes)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+"""
+    table_bench
+
+Measures conversation lookup latency under contention. Reader threads, as
+the threads of a Reactor would, look up random conversations in a large
+table and start and finish conversations of their own, while a Performer
+keeps checking the table. Every conversation's timeout is set to expire
+immediately, so that every Performer pass touches every conversation: the
+worst case for lock hold times.
+
+A single ConversationTable is compared with ShardedConversationTables.
+"""
+import gflags
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+import packets
+from conversation_table import ConversationTable, ShardedConversationTable
+from performer import Performer
+from tftp_conversation import TFTPConversation
+
+FLAGS = gflags.FLAGS
+
+
+class NullSocket(object):
+    """A socket that drops everything sent from it."""
+    def sendto(self, data, addr):
+        pass
+
+
+def create_conversation(client_host, client_port):
+    conversation = TFTPConversation(client_host, client_port, None)
+    conversation.cached_packet = packets.AcknowledgementPacket(1)
+    return conversation
+
+
+def fill_table(table, conversations):
+    addresses = []
+    for i in xrange(conversations):
+        address = ("10.%d.%d.%d" % (i >> 16 & 255, i >> 8 & 255, i & 255),
+                   69)
+        table.add_conversation(address[0], address[1],
+                               create_conversation(*address))
+        addresses.append(address)
+    return addresses
+
+
+def read(table, addresses, thread_num, deadline, latencies):
+    """Looks up random conversations until the deadline, and every
+    `churn` lookups starts and finishes a conversation of its own.
+    """
+    churn_host = "172.16.0.%d" % thread_num
+    lookups = 0
+    while time.time() < deadline:
+        address = random.choice(addresses)
+        start = time.time()
+        table.get_conversation(*address)
+        latencies.append(time.time() - start)
+        lookups += 1
+        if lookups % FLAGS.churn == 0:
+            table.lock.acquire()
+            try:
+                table.add_conversation(churn_host, lookups,
+                                       create_conversation(churn_host,
+                                                           lookups))
+            finally:
+                table.lock.release()
+            table.delete_conversation(churn_host, lookups)
+
+
+def perform(performer, deadline, passes):
+    while time.time() < deadline:
+        performer.perform_tasks()
+        passes.append(True)
+
+
+def bench(shard_count):
+    if shard_count == 1:
+        table = ConversationTable()
+    else:
+        table = ShardedConversationTable(shard_count)
+    addresses = fill_table(table, FLAGS.conversations)
+    performer = Performer(NullSocket(), table, 0, sys.maxint)
+    deadline = time.time() + FLAGS.duration
+    latencies = [[] for _ in xrange(FLAGS.threads)]
+    passes = []
+    threads = [threading.Thread(target=read,
+                                args=(table, addresses, i, deadline,
+                                      latencies[i]))
+               for i in xrange(FLAGS.threads)]
+    threads.append(threading.Thread(target=perform,
+                                    args=(performer, deadline, passes)))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    latencies = sorted(sum(latencies, []))
+    percentile = lambda p: latencies[int(len(latencies) * p)] * 1e6
+    return (len(latencies) / FLAGS.duration, percentile(0.5),
+            percentile(0.99), latencies[-1] * 1e6, len(passes))
+
+
+def main():
+    gflags.DEFINE_list("shards", ["1", "4", "16", "64"],
+                       "shard counts to measure; 1 is a ConversationTable",
+                       short_name="s")
+    gflags.DEFINE_integer("conversations", 50000,
+                          "conversations in the table", 1, short_name="c")
+    gflags.DEFINE_integer("threads", 8, "reader threads", 1, short_name="t")
+    gflags.DEFINE_integer("churn", 100,
+                          "lookups per conversation started and finished",
+                          1)
+    gflags.DEFINE_float("duration", 5.0, "seconds to run each table",
+                        short_name="d")
+    FLAGS(sys.argv)
+
+    print "%-8s %14s %10s %10s %12s %8s" % (
+        "shards", "lookups/sec", "p50 (us)", "p99 (us)", "max (us)",
+        "passes")
+    for shard_count in FLAGS.shards:
+        print "%-8s %14.1f %10.1f %10.1f %12.1f %8d" % (
+            (shard_count,) + bench(int(shard_count)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,304 @@
+import itertools
+import logging
+import multiprocessing
+import Queue
+import threading
+import time
+
+from clock import monotonic
+from deferred import Deferred
+from utility import lock
+
+
+# How many seconds a ProcessWorkerPool waits between checks for tasks that
+# the pool failed without reporting an outcome
+FAILED_TASK_CHECK_INTERVAL = 0.1
+
+
+class WorkerPoolFull(Exception):
+    """Raised when a task is submitted to a WorkerPool whose queue is full."""
+
+
+class WorkerPool(object):
+    """A WorkerPool runs submitted tasks on a fixed set of long lived worker
+    threads. It is used to run application actions, so that the amount of
+    actions running at once stays bounded no matter how many requests arrive.
+
+    Tasks wait in a queue until a worker is free. If the queue is bounded and
+    full, submitting raises WorkerPoolFull instead of growing the queue.
+
+    Properties:
+        queue_depth: The amount of tasks waiting for a free worker.
+        average_wait_time: The average amount of seconds tasks waited in the
+            queue before starting.
+        max_wait_time: The longest amount of seconds a task waited in the
+            queue before starting.
+        tasks_started: The amount of tasks that have left the queue.
+        tasks_rejected: The amount of tasks refused because the queue was
+            full.
+    """
+    def __init__(self, thread_count, max_queue_size=0):
+        """
+        Args:
+            thread_count: The amount of worker threads to run tasks on.
+            max_queue_size: The amount of tasks that may wait for a free
+                worker. 0 leaves the queue unbounded.
+        """
+        self.thread_count = thread_count
+        self.max_queue_size = max_queue_size
+        self.tasks = Queue.Queue(max_queue_size)
+        self.threads = []
+        self.lock = threading.Lock()
+        self.tasks_started = 0
+        self.tasks_rejected = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    @property
+    def queue_depth(self):
+        return self.tasks.qsize()
+
+    @property
+    def average_wait_time(self):
+        if not self.tasks_started:
+            return 0.0
+        return self.total_wait_time / self.tasks_started
+
+    def start(self):
+        """Starts the worker threads. Tasks submitted before the pool is
+        started are held until a worker becomes available.
+        """
+        for _ in xrange(self.thread_count):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self.threads.append(worker)
+
+    def submit(self, function, *args):
+        """Schedules a function to run on one of the workers.
+
+        Args:
+            function: The function to invoke.
+            args: The arguments to invoke the function with.
+
+        Raises:
+            WorkerPoolFull: The queue of waiting tasks is full.
+        """
+        try:
+            self.tasks.put_nowait((monotonic(), function, args))
+        except Queue.Full:
+            self._record_rejection()
+            raise WorkerPoolFull("%s tasks already waiting"
+                                 % self.max_queue_size)
+
+    def defer(self, function, *args):
+        """Schedules a function to run on one of the workers and returns a
+        Deferred for its result. Exceptions raised by the function fail the
+        Deferred.
+
+        Args:
+            function: The function to invoke.
+            args: The arguments to invoke the function with.
+
+        Returns:
+            A Deferred that completes once the function has run.
+
+        Raises:
+            WorkerPoolFull: The queue of waiting tasks is full.
+        """
+        deferred = Deferred()
+        self.submit(_complete_deferred, deferred, function, args)
+        return deferred
+
+    def _work(self):
+        """Runs tasks from the task queue forever."""
+        while True:
+            submitted_at, function, args = self.tasks.get()
+            self._record_wait(monotonic() - submitted_at)
+            try:
+                function(*args)
+            except Exception:
+                logging.exception("Worker task %s failed" % function)
+
+    @lock
+    def _record_wait(self, wait_time):
+        """Accounts for a task that waited wait_time seconds to start."""
+        self.tasks_started += 1
+        self.total_wait_time += wait_time
+        self.max_wait_time = max(self.max_wait_time, wait_time)
+
+    @lock
+    def _record_rejection(self):
+        """Accounts for a task that was refused because the queue was full."""
+        self.tasks_rejected += 1
+
+
+class ProcessWorkerPool(WorkerPool):
+    """A ProcessWorkerPool runs tasks on a pool of worker processes instead of
+    threads, so that CPU heavy actions are not serialized by the GIL. Tasks,
+    their arguments and their results must be picklable, which means actions
+    have to be module level functions.
+
+    The pool forks its processes when started, so it should be started after
+    all routes have been registered.
+
+    Tasks that the pool fails without running them to the end, because the
+    task or its result could not be pickled or the pool itself broke, are
+    found by a waiter thread that fails their Deferreds.
+    """
+    def __init__(self, process_count, max_queue_size=0):
+        """
+        Args:
+            process_count: The amount of worker processes to run tasks on.
+            max_queue_size: The amount of tasks that may wait for a free
+                worker. 0 leaves the queue unbounded.
+        """
+        WorkerPool.__init__(self, process_count, max_queue_size)
+        self.pool = None
+        self.tasks_pending = 0
+        # Maps task ids to the [Deferred, AsyncResult] of tasks in flight
+        self.in_flight = {}
+        self.task_ids = itertools.count()
+
+    @property
+    def queue_depth(self):
+        return max(0, self.tasks_pending - self.thread_count)
+
+    def start(self):
+        """Forks the worker processes, and starts the thread that waits on
+        the tasks that the pool fails.
+        """
+        self.pool = multiprocessing.Pool(self.thread_count)
+        waiter = threading.Thread(target=self._wait_for_failures)
+        waiter.daemon = True
+        waiter.start()
+        self.threads.append(waiter)
+
+    def submit(self, function, *args):
+        """Schedules a function to run on one of the workers.
+
+        Args:
+            function: The function to invoke.
+            args: The arguments to invoke the function with.
+
+        Raises:
+            WorkerPoolFull: The queue of waiting tasks is full.
+        """
+        self.defer(function, *args)
+
+    def defer(self, function, *args):
+        """Schedules a function to run on one of the workers and returns a
+        Deferred for its result. Exceptions raised by the function fail the
+        Deferred.
+
+        Args:
+            function: The function to invoke.
+            args: The arguments to invoke the function with.
+
+        Returns:
+            A Deferred that completes once the function has run.
+
+        Raises:
+            WorkerPoolFull: The queue of waiting tasks is full.
+        """
+        if not self._reserve():
+            self._record_rejection()
+            raise WorkerPoolFull("%s tasks already waiting"
+                                 % self.max_queue_size)
+        deferred = Deferred()
+        task_id = next(self.task_ids)
+        task = [deferred, None]
+        self.lock.acquire()
+        self.in_flight[task_id] = task
+        self.lock.release()
+        try:
+            # The callback only runs for tasks that succeed, others are left
+            # to the waiter
+            task[1] = self.pool.apply_async(
+                _call_in_process, (monotonic(), function, args),
+                callback=lambda outcome: self._complete(task_id, outcome))
+        except Exception as ex:
+            self._fail(task_id, ex)
+        return deferred
+
+    @lock
+    def _reserve(self):
+        """Accounts for a new pending task if the queue has room for it.
+
+        Returns:
+            True if the task may be submitted.
+        """
+        if self.max_queue_size and self.queue_depth >= self.max_queue_size:
+            return False
+        self.tasks_pending += 1
+        return True
+
+    def _complete(self, task_id, outcome):
+        """Completes the Deferred of a task with the outcome reported by a
+        worker, unless the task was already completed.
+        """
+        wait_time, succeeded, result = outcome
+        self.lock.acquire()
+        task = self.in_flight.pop(task_id, None)
+        if task is not None:
+            self.tasks_pending -= 1
+        self.lock.release()
+        if task is None:
+            return
+        deferred = task[0]
+        self._record_wait(wait_time)
+        if succeeded:
+            deferred.resolve(result)
+        else:
+            deferred.fail(Exception(result))
+
+    def _fail(self, task_id, error):
+        """Fails the Deferred of a task that the pool failed to run."""
+        logging.error("Worker task failed in the pool: %s" % error)
+        self._complete(task_id, (0.0, False, "%s: %s"
+                                 % (error.__class__.__name__, error)))
+
+    def _wait_for_failures(self):
+        """Fails the tasks that the pool reports as failed, forever. The pool
+        never runs the callback of those tasks.
+        """
+        while True:
+            time.sleep(FAILED_TASK_CHECK_INTERVAL)
+            self.lock.acquire()
+            failed = [(task_id, result) for task_id, (_, result)
+                      in self.in_flight.iteritems()
+                      if result is not None and result.ready()
+                      and not result.successful()]
+            self.lock.release()
+            for task_id, result in failed:
+                try:
+                    result.get(0)
+                except Exception as ex:
+                    self._fail(task_id, ex)
+
+
+def _complete_deferred(deferred, function, args):
+    """Runs a function and completes a Deferred with its outcome."""
+    try:
+        result = function(*args)
+    except Exception as ex:
+        deferred.fail(ex)
+        return
+    deferred.resolve(result)
+
+
+def _call_in_process(submitted_at, function, args):
+    """Runs a function inside a worker process. Exceptions are reported as
+    strings since they are not guaranteed to be picklable. Results that
+    cannot be pickled, such as streams and mapped files, fail in the pool.
+
+    Returns:
+        A tuple of (seconds waited before starting, whether the function
+        succeeded, its result or a description of its exception).
+    """
+    wait_time = monotonic() - submitted_at
+    try:
+        result = function(*args)
+    except Exception as ex:
+        return wait_time, False, "%s: %s" % (ex.__class__.__name__, ex)
+    return wait_time, True, result
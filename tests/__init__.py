@@ -1,11 +1,22 @@
 import unittest
+from test_admission import *
+from test_batch_io import *
+from test_clock import *
 from test_conversation_manager import *
+from test_deferred import *
 from test_performer import *
 from test_emmer import *
 from test_packets import *
+from test_rate_limit import *
 from test_reactor import *
+from test_response_cache import *
 from test_response_router import *
+from test_rtt import *
+from test_scheduler import *
+from test_single_flight import *
+from test_supervisor import *
 from test_tftp_conversation import *
+from test_worker_pool import *
 
 if __name__ == "__main__":
     unittest.main()
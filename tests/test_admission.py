@@ -0,0 +1,61 @@
+import os
+import sys
+import unittest
+sys.path.append(os.path.join(os.path.dirname(__file__), "../emmer"))
+
+from admission import AdmissionController
+from conversation_table import ConversationTable
+
+
+class StubConversation(object):
+    pass
+
+
+class TestAdmissionController(unittest.TestCase):
+    def setUp(self):
+        self.table = ConversationTable()
+
+    def test_no_limits(self):
+        controller = AdmissionController(self.table)
+        for port in xrange(100):
+            self.assertTrue(controller.admit("10.26.0.1", port))
+        self.assertEqual(controller.conversations_admitted, 100)
+
+    def test_max_conversations(self):
+        controller = AdmissionController(self.table, max_conversations=2)
+        self.table.add_conversation("10.26.0.1", 3942, StubConversation())
+        self.assertTrue(controller.admit("10.26.0.2", 3942))
+        self.table.add_conversation("10.26.0.2", 3942, StubConversation())
+        self.assertFalse(controller.admit("10.26.0.3", 3942))
+        self.assertEqual(controller.rejected_for_total, 1)
+        self.assertEqual(controller.active_conversations, 2)
+
+        # Retransmitted requests of active conversations are still admitted
+        self.assertTrue(controller.admit("10.26.0.1", 3942))
+
+        self.table.delete_conversation("10.26.0.1", 3942)
+        self.assertTrue(controller.admit("10.26.0.3", 3942))
+
+    def test_max_conversations_per_host(self):
+        controller = AdmissionController(self.table,
+                                         max_conversations_per_host=1)
+        self.table.add_conversation("10.26.0.1", 3942, StubConversation())
+        self.assertFalse(controller.admit("10.26.0.1", 3943))
+        self.assertTrue(controller.admit("10.26.0.2", 3943))
+        self.assertEqual(controller.rejected_for_host, 1)
+
+    def test_max_new_per_second(self):
+        controller = AdmissionController(self.table, max_new_per_second=2)
+        self.assertTrue(controller.admit("10.26.0.1", 1))
+        self.assertTrue(controller.admit("10.26.0.1", 2))
+        self.assertFalse(controller.admit("10.26.0.1", 3))
+        self.assertEqual(controller.rejected_for_rate, 1)
+
+        # Half a second later, one more conversation may start
+        controller.new_conversation_bucket.last_refill -= 0.5
+        self.assertTrue(controller.admit("10.26.0.1", 3))
+        self.assertFalse(controller.admit("10.26.0.1", 4))
+
+
+if __name__ == "__main__":
+    unittest.main()
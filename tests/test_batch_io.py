@@ -0,0 +1,87 @@
+import os
+import socket
+import sys
+import unittest
+sys.path.append(os.path.join(os.path.dirname(__file__), "../emmer"))
+
+from batch_io import BATCH_SYSCALLS_AVAILABLE, BatchIO
+
+
+class TestBatchIO(unittest.TestCase):
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.setblocking(0)
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.client.bind(('127.0.0.1', 0))
+        self.client.setblocking(0)
+
+    def tearDown(self):
+        self.server.close()
+        self.client.close()
+
+    def assert_round_trip(self, batch_io):
+        datagrams = [("datagram %s\x00" % i, self.server.getsockname())
+                     for i in xrange(10)]
+        self.assertEqual(batch_io.send(self.client, datagrams), 10)
+        received = []
+        while True:
+            batch = batch_io.recv(self.server)
+            if not batch:
+                break
+            self.assertTrue(len(batch) <= batch_io.batch_size)
+            received.extend(batch)
+        self.assertEqual([data for data, _ in received],
+                         [data for data, _ in datagrams])
+        for _, addr in received:
+            self.assertEqual(addr, self.client.getsockname())
+
+    def test_round_trip(self):
+        batch_io = BatchIO(4)
+        self.assertEqual(batch_io.use_syscalls,
+                         BATCH_SYSCALLS_AVAILABLE)
+        self.assert_round_trip(batch_io)
+
+    def test_round_trip_without_batching(self):
+        batch_io = BatchIO(1)
+        self.assertFalse(batch_io.use_syscalls)
+        self.assert_round_trip(batch_io)
+
+    def test_send_skips_failed_datagram(self):
+        # A socket bound to loopback cannot reach other addresses
+        datagrams = [("first", self.server.getsockname()),
+                     ("unreachable", ("10.26.0.1", 3942)),
+                     ("second", self.server.getsockname())]
+        for batch_size in (1, 4):
+            batch_io = BatchIO(batch_size)
+            self.assertEqual(batch_io.send(self.client, datagrams), 2)
+            self.assertEqual(self.server.recvfrom(1024)[0], "first")
+            self.assertEqual(self.server.recvfrom(1024)[0], "second")
+
+    def test_send_header_and_payload(self):
+        payload = "0123456789" * 100
+        datagrams = [(("header %s:" % i, buffer(payload, i * 10, 500)),
+                      self.server.getsockname())
+                     for i in xrange(6)]
+        datagrams.append(("whole", self.server.getsockname()))
+        # Large payloads are gathered from where they are
+        datagrams.append((("large:", buffer(payload * 10, 5, 8000)),
+                          self.server.getsockname()))
+        for batch_size in (1, 4):
+            batch_io = BatchIO(batch_size)
+            self.assertEqual(batch_io.send(self.client, datagrams), 8)
+            for i in xrange(6):
+                self.assertEqual(self.server.recvfrom(1024)[0],
+                                 "header %s:" % i
+                                 + payload[i * 10:i * 10 + 500])
+            self.assertEqual(self.server.recvfrom(1024)[0], "whole")
+            self.assertEqual(self.server.recvfrom(9000)[0],
+                             "large:" + (payload * 10)[5:8005])
+
+    def test_recv_nothing_waiting(self):
+        self.assertEqual(BatchIO(4).recv(self.server), [])
+        self.assertEqual(BatchIO(1).recv(self.server), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,19 @@
+import os
+import sys
+import time
+import unittest
+sys.path.append(os.path.join(os.path.dirname(__file__), "../emmer"))
+
+from clock import monotonic
+
+
+class TestClock(unittest.TestCase):
+    def test_monotonic(self):
+        before = monotonic()
+        time.sleep(0.01)
+        elapsed = monotonic() - before
+        self.assertTrue(0.005 < elapsed < 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -3,7 +3,8 @@ import sys
 import unittest
 sys.path.append(os.path.join(os.path.dirname(__file__), "../emmer"))
 
-from conversation_table import ConversationTable
+from clock import monotonic
+from conversation_table import ConversationTable, ShardedConversationTable
 
 
 class StubConversation(object):
@@ -53,5 +54,115 @@ class TestConversationTable(unittest.TestCase):
             or table.conversations == [conversation_two, conversation_one],
             "conversations retrieved don't match")
 
+    def test_count_for_host(self):
+        table = ConversationTable()
+        table.add_conversation("10.0.0.1", "3942", StubConversation())
+        table.add_conversation("10.0.0.1", "3942", StubConversation())
+        table.add_conversation("10.0.0.1", "3943", StubConversation())
+        table.add_conversation("10.0.0.2", "3942", StubConversation())
+        self.assertEqual(table.count_for_host("10.0.0.1"), 2)
+        self.assertEqual(table.count_for_host("10.0.0.2"), 1)
+        table.delete_conversation("10.0.0.1", "3942")
+        table.delete_conversation("10.0.0.2", "3942")
+        self.assertEqual(table.count_for_host("10.0.0.1"), 1)
+        self.assertEqual(table.count_for_host("10.0.0.2"), 0)
+        self.assertEqual(table.host_counts, {"10.0.0.1": 1})
+
+    def test_checks(self):
+        table = ConversationTable()
+        table.add_conversation("10.0.0.1", "3942", StubConversation())
+        table.add_conversation("10.0.0.2", "3942", StubConversation())
+        now = monotonic()
+        # New conversations are due right away
+        self.assertEqual(table.pop_due_checks(now),
+                         [("10.0.0.1", "3942"), ("10.0.0.2", "3942")])
+        self.assertEqual(table.pop_due_checks(now), [])
+        table.schedule_check("10.0.0.1", "3942", now + 5)
+        table.schedule_check("10.0.0.2", "3942", deadline=now + 1)
+        self.assertFalse(table.schedule_check("10.0.0.3", "3942", now))
+        self.assertEqual(table.pop_due_checks(now=now + 2),
+                         [("10.0.0.2", "3942")])
+        table.delete_conversation("10.0.0.1", "3942")
+        self.assertEqual(table.pop_due_checks(now + 10), [])
+
+    def test_retire(self):
+        table = ConversationTable(5)
+        conversation = StubConversation()
+        table.add_conversation("10.0.0.1", "3942", conversation)
+        self.assertTrue(table.retire_conversation("10.0.0.1", "3942"))
+        self.assertFalse(table.retire_conversation("10.0.0.1", "3942"))
+        self.assertIsNone(table.get_conversation("10.0.0.1", "3942"))
+        self.assertEqual(table.get_tombstone("10.0.0.1", "3942"),
+                         conversation)
+        # Tombstones are not live conversations
+        self.assertEqual(len(table), 0)
+        self.assertEqual(table.count_for_host("10.0.0.1"), 0)
+        self.assertEqual(table.pop_due_checks(), [])
+        now = monotonic()
+        table.expire_tombstones(now)
+        self.assertEqual(table.get_tombstone("10.0.0.1", "3942"),
+                         conversation)
+        table.expire_tombstones(now=now + 5)
+        self.assertIsNone(table.get_tombstone("10.0.0.1", "3942"))
+        self.assertTrue(table.lock._RLock__count == 0)
+
+    def test_retire_without_tombstones(self):
+        table = ConversationTable()
+        table.add_conversation("10.0.0.1", "3942", StubConversation())
+        self.assertTrue(table.retire_conversation("10.0.0.1", "3942"))
+        self.assertIsNone(table.get_conversation("10.0.0.1", "3942"))
+        self.assertIsNone(table.get_tombstone("10.0.0.1", "3942"))
+
+
+class TestShardedConversationTable(unittest.TestCase):
+    def test_add_get_delete(self):
+        table = ShardedConversationTable(4)
+        conversations = {}
+        for port in xrange(100):
+            conversations[port] = StubConversation()
+            table.add_conversation("10.0.0.1", port, conversations[port])
+        self.assertEqual(len(table), 100)
+        self.assertTrue(all(len(shard) for shard in table.shards))
+        for port in xrange(100):
+            self.assertEqual(table.get_conversation("10.0.0.1", port),
+                             conversations[port])
+        self.assertTrue(table.delete_conversation("10.0.0.1", 7))
+        self.assertFalse(table.delete_conversation("10.0.0.1", 7))
+        self.assertIsNone(table.get_conversation("10.0.0.1", 7))
+        self.assertEqual(len(table.conversations), 99)
+
+    def test_count_for_host(self):
+        table = ShardedConversationTable(4)
+        for port in xrange(10):
+            table.add_conversation("10.0.0.1", port, StubConversation())
+        table.add_conversation("10.0.0.2", 1, StubConversation())
+        self.assertEqual(table.count_for_host("10.0.0.1"), 10)
+        self.assertEqual(table.count_for_host("10.0.0.2"), 1)
+        self.assertEqual(table.count_for_host("10.0.0.3"), 0)
+
+    def test_checks(self):
+        table = ShardedConversationTable(4)
+        for port in xrange(10):
+            table.add_conversation("10.0.0.1", port, StubConversation())
+        now = monotonic()
+        self.assertEqual(len(table.pop_due_checks(now)), 10)
+        self.assertTrue(table.schedule_check("10.0.0.1", 3, now + 1))
+        self.assertFalse(table.schedule_check("10.0.0.1", 30, now + 1))
+        self.assertEqual(table.pop_due_checks(now + 2), [("10.0.0.1", 3)])
+
+    def test_retire(self):
+        table = ShardedConversationTable(4, 5)
+        conversations = {}
+        for port in xrange(10):
+            conversations[port] = StubConversation()
+            table.add_conversation("10.0.0.1", port, conversations[port])
+        for port in xrange(10):
+            self.assertTrue(table.retire_conversation("10.0.0.1", port))
+        self.assertEqual(len(table), 0)
+        self.assertEqual(table.get_tombstone("10.0.0.1", 3),
+                         conversations[3])
+        table.expire_tombstones(monotonic() + 5)
+        self.assertIsNone(table.get_tombstone("10.0.0.1", 3))
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,71 @@
+import os
+import sys
+import unittest
+sys.path.append(os.path.join(os.path.dirname(__file__), "../emmer"))
+
+from deferred import Deferred
+
+
+class TestDeferred(unittest.TestCase):
+    def test_callback_after_resolve(self):
+        deferred = Deferred()
+        received = []
+        deferred.add_callback(received.append)
+        self.assertEqual(received, [])
+        deferred.resolve("result")
+        self.assertEqual(received, [deferred])
+        self.assertTrue(deferred.completed)
+        self.assertEqual(deferred.result, "result")
+        self.assertIsNone(deferred.error)
+
+    def test_callback_when_already_resolved(self):
+        deferred = Deferred()
+        deferred.resolve("result")
+        received = []
+        deferred.add_callback(received.append)
+        self.assertEqual(received, [deferred])
+
+    def test_fail(self):
+        deferred = Deferred()
+        error = ValueError("stub error")
+        deferred.fail(error)
+        self.assertTrue(deferred.completed)
+        self.assertEqual(deferred.error, error)
+
+    def test_complete_twice_keeps_first_outcome(self):
+        deferred = Deferred()
+        deferred.resolve("first")
+        deferred.fail(ValueError("second"))
+        self.assertEqual(deferred.result, "first")
+        self.assertIsNone(deferred.error)
+
+    def test_resolve_with_deferred(self):
+        deferred = Deferred()
+        inner = Deferred()
+        deferred.resolve(inner)
+        self.assertFalse(deferred.completed)
+        inner.resolve("result")
+        self.assertEqual(deferred.result, "result")
+
+    def test_then(self):
+        deferred = Deferred()
+        chained = deferred.then(lambda result: result * 2)
+        deferred.resolve(21)
+        self.assertEqual(chained.result, 42)
+
+    def test_then_carries_failures(self):
+        deferred = Deferred()
+        chained = deferred.then(lambda result: result * 2)
+        error = ValueError("stub error")
+        deferred.fail(error)
+        self.assertEqual(chained.error, error)
+
+    def test_then_catches_exceptions(self):
+        deferred = Deferred()
+        chained = deferred.then(lambda result: result.missing_attribute)
+        deferred.resolve(None)
+        self.assertTrue(isinstance(chained.error, AttributeError))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -52,6 +52,16 @@ class TestPackets(unittest.TestCase):
         self.assertEqual(packet.data, data)
         self.assertEqual(packet.pack(), packet_data)
 
+    def test_pack_segments(self):
+        data = "X" * 512
+        packet = packets.DataPacket(5394, buffer(data, 0, 256))
+        header, payload = packets.pack_segments(packet)
+        self.assertEqual(header, "\x00\x03\x15\x12")
+        self.assertEqual(str(payload), "X" * 256)
+        self.assertEqual(packet.pack(), "\x00\x03\x15\x12" + "X" * 256)
+        packet = packets.AcknowledgementPacket(5394)
+        self.assertEqual(packets.pack_segments(packet), packet.pack())
+
     def test_pack_and_unpack_packet_to_ack(self):
         packet_data = "\x00\x04\x15\x12"
         packet = packets.unpack_packet(packet_data)
@@ -67,5 +77,72 @@ class TestPackets(unittest.TestCase):
         self.assertEqual(packet.error_message, "error_message_example")
         self.assertEqual(packet.pack(), packet_data)
 
+    def test_pack_and_unpack_packet_to_oack(self):
+        packet_data = "\x00\x06blksize\x001428\x00"
+        packet = packets.unpack_packet(packet_data)
+        self.assertEqual(packet.__class__,
+                         packets.OptionAcknowledgementPacket)
+        self.assertEqual(packet.options, {'blksize': "1428"})
+        self.assertEqual(packet.pack(), packet_data)
+
+    def test_pack_and_unpack_unsigned_block_numbers(self):
+        for block_num, packed in ((40000, "\x9c\x40"), (65535, "\xff\xff")):
+            packet = packets.unpack_packet("\x00\x03" + packed + "data")
+            self.assertEqual(packet.block_num, block_num)
+            self.assertEqual(packets.DataPacket(block_num, "data").pack(),
+                             "\x00\x03" + packed + "data")
+            packet = packets.unpack_packet("\x00\x04" + packed)
+            self.assertEqual(packet.block_num, block_num)
+
+    def test_wrap_block_number(self):
+        self.assertEqual([packets.wrap_block_number(block_num)
+                          for block_num in (0, 1, 65535, 65536, 65537,
+                                            131071, 131072)],
+                         [0, 1, 65535, 0, 1, 65535, 0])
+        self.assertEqual([packets.wrap_block_number(block_num, 1)
+                          for block_num in (0, 1, 65535, 65536, 65537,
+                                            131070, 131071)],
+                         [0, 1, 65535, 1, 2, 65535, 1])
+        self.assertEqual(packets.wrap_block_number(2 ** 40), 0)
+
+    def test_unwrap_block_number(self):
+        for rollover in (0, 1):
+            for reference in (0, 5, 65535, 65536, 65600, 200000):
+                for block_num in (reference, reference - 1, reference - 63):
+                    if block_num < 0:
+                        continue
+                    self.assertEqual(packets.unwrap_block_number(
+                        packets.wrap_block_number(block_num, rollover),
+                        reference, rollover), block_num)
+        # Blocks that were never sent unwrap to before the transfer
+        self.assertTrue(packets.unwrap_block_number(6, 5) < 0)
+        self.assertTrue(packets.unwrap_block_number(65535, 65534, 1) < 0)
+        # Block 0 is never sent again when rolling over to 1
+        self.assertEqual(packets.unwrap_block_number(0, 65600, 1), 0)
+
+    def test_unwrap_last_block_before_wrap(self):
+        for rollover in (0, 1):
+            self.assertEqual(
+                packets.unwrap_block_number(65535, 65535, rollover), 65535)
+            self.assertEqual(
+                packets.unwrap_block_number(65535, 65536, rollover), 65535)
+
+    def test_packets_have_no_dict(self):
+        for packet in [packets.ReadRequestPacket("f", "octet"),
+                       packets.WriteRequestPacket("f", "octet"),
+                       packets.DataPacket(1, "data"),
+                       packets.AcknowledgementPacket(1),
+                       packets.ErrorPacket(1, "error"),
+                       packets.OptionAcknowledgementPacket({}),
+                       packets.NoOpPacket()]:
+            self.assertFalse(hasattr(packet, "__dict__"))
+
+    def test_unpack_malformed_packets(self):
+        for packet_data in ["", "\x00", "\x00\x04\x15", "\x00\x03",
+                            "\x00\x01filename_without_mode",
+                            "\x00\x07\x15\x12", "\x01\x04\x15\x12"]:
+            self.assertEqual(packets.unpack_packet(packet_data).__class__,
+                             packets.NoOpPacket)
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,11 +1,15 @@
+import errno
 import os
+import socket
 import sys
 import tftp_conversation
 import unittest
 sys.path.append(os.path.join(os.path.dirname(__file__), "../emmer"))
 
-from conversation_table import ConversationTable
+from clock import monotonic
+from conversation_table import ConversationTable, ShardedConversationTable
 from performer import Performer
+from rtt import RTTEstimator
 
 
 class StubPacket(object):
@@ -19,10 +23,20 @@ class StubConversation(object):
         self.cached_packet = StubPacket()
         self.client_host = "stub_host"
         self.client_port = "stub_port"
+        self.rtt_estimator = RTTEstimator()
+        self.retries_made = 0
+        self.sock = None
+        self.state = tftp_conversation.READING
+        self.timeout = None
 
     def mark_retry(self):
+        self.retries_made += 1
+        self.time_of_last_interaction = monotonic()
         return self.cached_packet
 
+    def give_up(self):
+        self.state = tftp_conversation.COMPLETED
+
 
 class StubSocket(object):
     def __init__(self):
@@ -34,29 +48,21 @@ class StubSocket(object):
         self.sent_addr = addr
 
 
-class TestPerformer(unittest.TestCase):
-    def setUp(self):
-        self.sock = StubSocket()
+class ClosedSocket(object):
+    def sendto(self, data, addr):
+        raise socket.error(errno.EBADF, "Bad file descriptor")
 
-    def test_get_stale_conversations(self):
-        table = ConversationTable()
-        conversation_one = StubConversation(12344)
-        conversation_two = StubConversation(12345)
-        conversation_three = StubConversation(12346)
-        table.conversation_table = {
-            ("10.26.0.1", "3942"): conversation_one,
-            ("10.26.0.2", "3942"): conversation_two,
-            ("10.26.0.3", "3942"): conversation_three
-        }
 
-        performer = Performer(self.sock, table, 10, 6)
+class StubBatchIO(object):
+    """Sends datagrams one by one, raising errors as a batch send does."""
+    def send(self, sock, datagrams):
+        for data, addr in datagrams:
+            sock.sendto(data, addr)
+
 
-        # Either order of returned results is fine
-        self.assertTrue(performer._get_stale_conversations(5, 12350)
-            == [conversation_one, conversation_two]
-            or performer.get_stale_conversations(5, 12350)
-            == [conversation_two, conversation_one],
-            "stale conversations found don't match")
+class TestPerformer(unittest.TestCase):
+    def setUp(self):
+        self.sock = StubSocket()
 
     def test_handle_stale_conversation_retry(self):
         conversation = StubConversation(12344)
@@ -78,34 +84,140 @@ class TestPerformer(unittest.TestCase):
             '\x00\x05\x00\x00Conversation Timed Out\x00')
         self.assertEqual(self.sock.sent_addr, ("stub_host", "stub_port"))
         self.assertIsNone(table.get_conversation("stub_host", "stub_port"), None)
+        self.assertEqual(conversation.state, tftp_conversation.COMPLETED)
 
-    def test_find_and_handle_stale_conversations(self):
+    def test_handle_stale_conversation_with_own_socket(self):
         conversation = StubConversation(12344)
-        conversation.retries_made = 6
+        conversation.retries_made = 0
+        conversation.sock = StubSocket()
+        performer = Performer(self.sock, ConversationTable(), 10, 6)
+        performer._handle_stale_conversation(conversation)
+        self.assertEqual(conversation.sock.sent_data, "stub_packet_data")
+        self.assertIsNone(self.sock.sent_data)
+
+    def test_handle_stale_conversation_queues_resend(self):
+        conversation = StubConversation(12344)
+        conversation.retries_made = 0
         table = ConversationTable()
         table.add_conversation("stub_host", "stub_port", conversation)
         performer = Performer(self.sock, table, 10, 6)
-        performer.find_and_handle_stale_conversations()
-        self.assertEqual(len(table), 0)
-
-    def test_sweep_completed_conversations(self):
-        conversation_one = StubConversation(12344)
-        conversation_one.state = tftp_conversation.COMPLETED
-
-        conversation_two = StubConversation(12345)
-        conversation_two.state = tftp_conversation.READING
+        outgoing = {}
+        performer._handle_stale_conversation(conversation, outgoing)
+        self.assertIsNone(self.sock.sent_data)
+        self.assertEqual(outgoing, {self.sock: [("stub_packet_data",
+                                                 ("stub_host", "stub_port"))]})
 
-        conversation_three = StubConversation(12346)
-        conversation_three.state = tftp_conversation.COMPLETED
+    def test_handle_stale_conversation_resends_window(self):
+        conversation = StubConversation(12344)
+        conversation.retries_made = 0
+        conversation.cached_packet = [StubPacket(), StubPacket()]
+        performer = Performer(self.sock, ConversationTable(), 10, 6)
+        outgoing = {}
+        performer._handle_stale_conversation(conversation, outgoing)
+        self.assertEqual(outgoing, {self.sock: [
+            ("stub_packet_data", ("stub_host", "stub_port")),
+            ("stub_packet_data", ("stub_host", "stub_port"))]})
+
+    def test_get_resend_timeout(self):
+        performer = Performer(self.sock, ConversationTable(), 3, 6,
+                              min_resend_timeout=0.2, max_resend_timeout=10)
+        conversation = StubConversation(12344)
+        self.assertEqual(performer.get_resend_timeout(conversation), 3)
+        conversation.rtt_estimator.sample(0.01)
+        self.assertEqual(performer.get_resend_timeout(conversation), 0.2)
+        conversation.rtt_estimator.sample(1)
+        timeout = performer.get_resend_timeout(conversation)
+        self.assertTrue(1 < timeout < 10)
+        conversation.rtt_estimator.back_off()
+        self.assertEqual(performer.get_resend_timeout(conversation),
+                         2 * timeout)
+        for _ in xrange(5):
+            conversation.rtt_estimator.back_off()
+        self.assertEqual(performer.get_resend_timeout(conversation), 10)
+        conversation.timeout = 7
+        self.assertEqual(performer.get_resend_timeout(conversation), 7)
+
+    def test_check_due_conversations(self):
+        now = monotonic()
+        stale_conversation = StubConversation(now - 6)
+        fresh_conversation = StubConversation(now - 4)
+        completed_conversation = StubConversation(now - 1)
+        completed_conversation.state = tftp_conversation.COMPLETED
+        table = ConversationTable()
+        table.add_conversation("10.26.0.1", "3942", stale_conversation)
+        table.add_conversation("10.26.0.2", "3942", fresh_conversation)
+        table.add_conversation("10.26.0.3", "3942", completed_conversation)
+        performer = Performer(self.sock, table, 5, 6)
+        performer.check_due_conversations()
+
+        self.assertEqual(stale_conversation.retries_made, 1)
+        self.assertEqual(fresh_conversation.retries_made, 0)
+        self.assertEqual(sorted(table.conversation_table),
+                         [("10.26.0.1", "3942"), ("10.26.0.2", "3942")])
+        # Only conversations whose timeout expires are due again
+        self.assertEqual(table.pop_due_checks(now + 0.5), [])
+        self.assertEqual(table.pop_due_checks(now + 1),
+                         [("10.26.0.2", "3942")])
+
+    def test_check_due_conversations_with_closed_socket(self):
+        now = monotonic()
+        closed_conversation = StubConversation(now - 6)
+        closed_conversation.sock = ClosedSocket()
+        conversation = StubConversation(now - 6)
+        table = ConversationTable()
+        table.add_conversation("10.26.0.1", "3942", closed_conversation)
+        table.add_conversation("10.26.0.2", "3942", conversation)
+        performer = Performer(self.sock, table, 5, 6)
+        performer.batch_io = StubBatchIO()
+        performer.check_due_conversations()
+        self.assertEqual(self.sock.sent_data, "stub_packet_data")
 
+    def test_check_due_conversations_gives_up(self):
+        now = monotonic()
+        conversation = StubConversation(now - 60)
+        conversation.retries_made = 6
         table = ConversationTable()
-        table.conversation_table = {
-                ("10.26.0.1", "3942"): conversation_one,
-                ("10.26.0.2", "3942"): conversation_two,
-                ("10.26.0.3", "3942"): conversation_three
-        }
+        table.add_conversation("stub_host", "stub_port", conversation)
+        performer = Performer(self.sock, table, 10, 6)
+        performer.check_due_conversations()
+        self.assertEqual(len(table), 0)
+        self.assertEqual(len(table.checks), 0)
 
+    def test_check_due_conversations_expires_tombstones(self):
+        table = ConversationTable(5)
+        table.add_conversation("stub_host", "stub_port",
+                               StubConversation(monotonic()))
+        table.retire_conversation("stub_host", "stub_port")
         performer = Performer(self.sock, table, 10, 6)
-        performer.sweep_completed_conversations()
-        self.assertEqual(table.conversation_table,
-            {("10.26.0.2", "3942"): conversation_two, })
+        performer.check_due_conversations()
+        self.assertIsNotNone(table.get_tombstone("stub_host", "stub_port"))
+        performer.check_due_conversations(monotonic() + 5)
+        self.assertIsNone(table.get_tombstone("stub_host", "stub_port"))
+
+    def test_check_due_conversations_uses_their_own_timeout(self):
+        now = monotonic()
+        fast_conversation = StubConversation(now - 1)
+        fast_conversation.rtt_estimator.sample(0.01)
+        slow_conversation = StubConversation(now - 1)
+        table = ConversationTable()
+        table.add_conversation("10.26.0.1", "3942", fast_conversation)
+        table.add_conversation("10.26.0.2", "3942", slow_conversation)
+        performer = Performer(self.sock, table, 5, 6,
+                              min_resend_timeout=0.2, max_resend_timeout=10)
+        performer.check_due_conversations()
+        self.assertEqual(fast_conversation.retries_made, 1)
+        self.assertEqual(slow_conversation.retries_made, 0)
+
+    def test_check_due_conversations_of_sharded_table(self):
+        now = monotonic()
+        table = ShardedConversationTable(4)
+        for port in xrange(20):
+            conversation = StubConversation(now - 6)
+            if port % 2:
+                conversation.state = tftp_conversation.COMPLETED
+            table.add_conversation("10.26.0.1", port, conversation)
+        performer = Performer(self.sock, table, 5, 6)
+        performer.check_due_conversations()
+        self.assertEqual(len(table), 10)
+        self.assertTrue(all(conversation.retries_made == 1
+                            for conversation in table.conversations))
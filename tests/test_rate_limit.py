@@ -0,0 +1,74 @@
+import os
+import sys
+import unittest
+sys.path.append(os.path.join(os.path.dirname(__file__), "../emmer"))
+
+from clock import monotonic
+from rate_limit import RateLimit, RateLimiter, TokenBucket
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_reserve(self):
+        bucket = TokenBucket(100)
+        now = bucket.last_refill
+        self.assertEqual(bucket.reserve(60, now), 0)
+        self.assertEqual(bucket.reserve(40, now), 0)
+        # The bucket goes into debt, paid off at 100 tokens per second
+        self.assertAlmostEqual(bucket.reserve(50, now), 0.5)
+        self.assertAlmostEqual(bucket.reserve(50, now), 1.0)
+        self.assertAlmostEqual(bucket.reserve(50, now + 1), 0.5)
+
+    def test_take(self):
+        bucket = TokenBucket(2)
+        now = bucket.last_refill
+        self.assertTrue(bucket.take(1, now))
+        self.assertTrue(bucket.take(1, now))
+        self.assertFalse(bucket.take(1, now))
+        self.assertTrue(bucket.take(1, now + 0.5))
+
+    def test_refills_up_to_a_second_worth(self):
+        bucket = TokenBucket(10)
+        now = bucket.last_refill
+        self.assertTrue(bucket.is_full(now + 60))
+        self.assertEqual(bucket.tokens, 10)
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_no_limits(self):
+        limiter = RateLimiter()
+        for _ in xrange(1000):
+            self.assertEqual(limiter.reserve("10.26.0.1", 516), 0)
+        self.assertEqual(limiter.host_buckets, {})
+
+    def test_global_limit(self):
+        limiter = RateLimiter(global_limit=RateLimit(bytes_per_second=1000))
+        self.assertEqual(limiter.reserve("10.26.0.1", 500), 0)
+        self.assertEqual(limiter.reserve("10.26.0.2", 500), 0)
+        self.assertTrue(limiter.reserve("10.26.0.3", 500) > 0)
+
+    def test_host_limit(self):
+        limiter = RateLimiter(host_limit=RateLimit(packets_per_second=2))
+        self.assertEqual(limiter.reserve("10.26.0.1", 516), 0)
+        self.assertEqual(limiter.reserve("10.26.0.1", 516), 0)
+        self.assertTrue(limiter.reserve("10.26.0.1", 516) > 0)
+        # Other hosts are not held back by a busy one
+        self.assertEqual(limiter.reserve("10.26.0.2", 516), 0)
+
+    def test_route_limit_overrides_host_limit(self):
+        limiter = RateLimiter(host_limit=RateLimit(packets_per_second=1))
+        route_limit = RateLimit(packets_per_second=3)
+        for _ in xrange(3):
+            self.assertEqual(limiter.reserve("10.26.0.1", 516, route_limit), 0)
+        self.assertTrue(limiter.reserve("10.26.0.1", 516, route_limit) > 0)
+        self.assertEqual(limiter.reserve("10.26.0.1", 516), 0)
+
+    def test_forget_idle_hosts(self):
+        limiter = RateLimiter(host_limit=RateLimit(packets_per_second=1))
+        limiter.reserve("10.26.0.1", 516)
+        limiter.reserve("10.26.0.2", 516)
+        limiter._forget_idle_hosts(monotonic() + 1)
+        self.assertEqual(limiter.host_buckets, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
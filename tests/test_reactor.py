@@ -1,10 +1,69 @@
+import errno
+import os
+import socket
 import unittest
 
 import packets
+import tftp_conversation
+from admission import AdmissionController
+from clock import monotonic
 from conversation_table import ConversationTable
-from reactor import Reactor
+from deferred import Deferred
+from rate_limit import RateLimit, RateLimiter
+from reactor import EventLoopReactor, Poller, Reactor
+from response_router import ResponseRouter
 from tftp_conversation import TFTPConversation
 
+
+class StubSocket(object):
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, addr):
+        self.sent.append((data, addr))
+
+
+class StubConversation(object):
+    def __init__(self):
+        self.client_host = '10.26.0.1'
+        self.client_port = 3942
+        self.handled = []
+        self.sock = None
+        self.state = tftp_conversation.READING
+
+    def handle_packet(self, packet):
+        self.handled.append(packet)
+        return packets.NoOpPacket()
+
+    def advance(self, packet):
+        return self.handle_packet(packet), None
+
+
+class StubPendingConversation(StubConversation):
+    def __init__(self):
+        StubConversation.__init__(self)
+        self.state = tftp_conversation.PENDING
+        self.pending_action = Deferred()
+
+    def advance(self, packet):
+        self.handled.append(packet)
+        return packets.NoOpPacket(), self.pending_action
+
+    def resume(self):
+        self.state = tftp_conversation.READING
+        return packets.DataPacket(1, self.pending_action.result)
+
+
+class GivingUpConversation(TFTPConversation):
+    """A conversation that the Performer gives up on right after each
+    packet, before the reactor is done with it.
+    """
+    def advance(self, packet):
+        output = TFTPConversation.advance(self, packet)
+        self.give_up()
+        return output
+
+
 class TestReactor(unittest.TestCase):
 
     def test_get_conversation_new_with_reading_packet(self):
@@ -27,7 +86,8 @@ class TestReactor(unittest.TestCase):
         conversation_table = ConversationTable()
         packet = packets.AcknowledgementPacket('stub block number')
         old_conversation = TFTPConversation('10.26.0.1', 3942, 'stub_router')
-        conversation_table.add_conversation('10.26.0.1', 3942, old_conversation)
+        conversation_table.add_conversation('10.26.0.1', 3942,
+                                            old_conversation)
         reactor = Reactor('stub_socket', 'stub_router', conversation_table)
         conversation = reactor.get_conversation('10.26.0.1', 3942, packet)
         self.assertEqual(len(conversation_table), 1)
@@ -38,13 +98,388 @@ class TestReactor(unittest.TestCase):
         conversation_table = ConversationTable()
         packet = packets.DataPacket('stub block number', 'stub data')
         old_conversation = TFTPConversation('10.26.0.1', 3942, 'stub_router')
-        conversation_table.add_conversation('10.26.0.1', 3942, old_conversation)
+        conversation_table.add_conversation('10.26.0.1', 3942,
+                                            old_conversation)
         reactor = Reactor('stub_socket', 'stub_router', conversation_table)
         conversation = reactor.get_conversation('10.26.0.1', 3942, packet)
         self.assertEqual(len(conversation_table), 1)
         self.assertTrue(isinstance(conversation, TFTPConversation))
         self.assertEqual(conversation, old_conversation)
 
+    def test_get_conversation_with_per_transfer_sockets(self):
+        conversation_table = ConversationTable()
+        listening_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        listening_sock.bind(('127.0.0.1', 0))
+        reactor = Reactor(listening_sock, 'stub_router', conversation_table,
+                          per_transfer_sockets=True)
+        watched = []
+        reactor.watch_transfer_socket = watched.append
+        packet = packets.ReadRequestPacket('stub filename', 'stub mode')
+        conversation = reactor.get_conversation('10.26.0.1', 3942, packet)
+        self.assertEqual(watched, [conversation])
+        self.assertEqual(conversation.sock.getsockname()[0], '127.0.0.1')
+        self.assertNotEqual(conversation.sock.getsockname(),
+                            listening_sock.getsockname())
+
+        # A retransmitted request does not start a new transfer
+        self.assertIsNone(reactor.get_conversation('10.26.0.1', 3942, packet))
+        self.assertEqual(
+            conversation_table.get_conversation('10.26.0.1', 3942),
+            conversation)
+
+        # A new request after completion does
+        conversation.state = tftp_conversation.COMPLETED
+        new_conversation = reactor.get_conversation('10.26.0.1', 3942, packet)
+        self.assertNotEqual(new_conversation, conversation)
+        self.assertEqual(len(watched), 2)
+        for sock in (listening_sock, conversation.sock, new_conversation.sock):
+            sock.close()
+
+    def test_get_conversation_refused_by_admission_controller(self):
+        conversation_table = ConversationTable()
+        sock = StubSocket()
+        reactor = Reactor(sock, 'stub_router', conversation_table,
+                          admission_controller=AdmissionController(
+                              conversation_table, max_conversations=1))
+        packet = packets.ReadRequestPacket('stub filename', 'stub mode')
+        self.assertIsNotNone(reactor.get_conversation('10.26.0.1', 3942,
+                                                      packet))
+        self.assertIsNone(reactor.get_conversation('10.26.0.2', 3942, packet))
+        self.assertEqual(len(conversation_table), 1)
+        self.assertEqual(sock.sent, [(packets.ErrorPacket(
+            0, "Server busy. Host: 10.26.0.2, Port: 3942").pack(),
+            ('10.26.0.2', 3942))])
+
+        # Silently refused requests are not answered
+        reactor.admission_controller.reject_silently = True
+        self.assertIsNone(reactor.get_conversation('10.26.0.3', 3942, packet))
+        self.assertEqual(len(sock.sent), 1)
+
+    def test_unrouted_requests_are_rejected_without_conversation(self):
+        sock = StubSocket()
+        router = ResponseRouter()
+        router.append_read_rule('boot/.*', lambda x, y, z: 'data')
+        router.append_write_rule('uploads/.*', lambda x, y, z, data: None)
+        conversation_table = ConversationTable()
+        reactor = Reactor(sock, router, conversation_table)
+        reactor.handle_message(
+            sock, ('10.26.0.1', 3942),
+            packets.ReadRequestPacket('etc/passwd', 'octet').pack())
+        reactor.handle_message(
+            sock, ('10.26.0.1', 3943),
+            packets.WriteRequestPacket('boot/kernel', 'octet').pack())
+        self.assertEqual(len(conversation_table), 0)
+        errors = [packets.unpack_packet(data) for data, _ in sock.sent]
+        self.assertEqual([error.error_code for error in errors], [1, 2])
+        self.assertEqual([addr for _, addr in sock.sent],
+                         [('10.26.0.1', 3942), ('10.26.0.1', 3943)])
+        self.assertEqual(router.read_rules.unmatched, set(['etc/passwd']))
+
+        reactor.handle_message(
+            sock, ('10.26.0.1', 3944),
+            packets.ReadRequestPacket('boot/kernel', 'octet').pack())
+        self.assertEqual(len(conversation_table), 1)
+
+    def test_retransmitted_request_reaches_pending_conversation(self):
+        sock = StubSocket()
+        deferred = Deferred()
+        router = ResponseRouter()
+        router.append_read_rule('boot/.*', lambda x, y, z: deferred)
+        conversation_table = ConversationTable()
+        reactor = Reactor(sock, router, conversation_table)
+        request = packets.ReadRequestPacket('boot/kernel', 'octet').pack()
+        reactor.handle_message(sock, ('10.26.0.1', 3942), request)
+        conversation = conversation_table.get_conversation('10.26.0.1', 3942)
+        reactor.handle_message(sock, ('10.26.0.1', 3942), request)
+        self.assertEqual(conversation_table.get_conversation('10.26.0.1',
+                                                             3942),
+                         conversation)
+        self.assertEqual(sock.sent, [])
+
+        # Only the first request is answered once the action completes
+        deferred.resolve('data')
+        self.assertEqual(sock.sent, [(packets.DataPacket(1, 'data').pack(),
+                                      ('10.26.0.1', 3942))])
+
+    def test_pending_conversation_given_up_before_callback(self):
+        sock = StubSocket()
+        deferred = Deferred()
+        router = ResponseRouter()
+        router.append_read_rule('boot/.*', lambda x, y, z: deferred)
+        reactor = Reactor(sock, router, ConversationTable())
+        conversation = GivingUpConversation('10.26.0.1', 3942, router)
+        reactor.handle_packet(
+            conversation, packets.ReadRequestPacket('boot/kernel', 'octet'))
+        deferred.resolve('data')
+        self.assertEqual(conversation.state, tftp_conversation.COMPLETED)
+        self.assertEqual(sock.sent, [])
+
+    def test_malformed_packets_are_rejected(self):
+        sock = StubSocket()
+        conversation_table = ConversationTable()
+        reactor = Reactor(sock, ResponseRouter(), conversation_table)
+        reactor.handle_message(sock, ('10.26.0.1', 3942), '\x00\x01no mode')
+        reactor.handle_message(sock, ('10.26.0.1', 3942), '\x00\x63')
+        self.assertEqual(len(conversation_table), 0)
+        errors = [packets.unpack_packet(data) for data, _ in sock.sent]
+        self.assertEqual([error.error_code for error in errors], [4, 4])
+
+    def test_malformed_packets_from_active_clients_are_ignored(self):
+        sock = StubSocket()
+        conversation_table = ConversationTable(5)
+        reactor = Reactor(sock, ResponseRouter(), conversation_table)
+        conversation = StubConversation()
+        conversation_table.add_conversation('10.26.0.1', 3942, conversation)
+        reactor.handle_message(sock, ('10.26.0.1', 3942), '\x00\x63')
+        conversation_table.retire_conversation('10.26.0.1', 3942)
+        reactor.handle_message(sock, ('10.26.0.1', 3942), '\x00\x63')
+        self.assertEqual(sock.sent, [])
+        self.assertEqual(conversation.handled, [])
+
+    def test_malformed_packets_rejected_silently(self):
+        sock = StubSocket()
+        conversation_table = ConversationTable()
+        reactor = Reactor(sock, ResponseRouter(), conversation_table,
+                          admission_controller=AdmissionController(
+                              conversation_table, reject_silently=True))
+        reactor.handle_message(sock, ('10.26.0.1', 3942), '\x00')
+        self.assertEqual(sock.sent, [])
+
+    def test_completed_conversation_is_retired(self):
+        table = ConversationTable(5)
+        reactor = Reactor(StubSocket(), 'stub_router', table)
+        conversation = StubConversation()
+        client_addr = (conversation.client_host, conversation.client_port)
+        table.add_conversation(client_addr[0], client_addr[1], conversation)
+        reactor.handle_packet(conversation, packets.AcknowledgementPacket(1))
+        self.assertEqual(table.get_conversation(*client_addr), conversation)
+        conversation.state = tftp_conversation.COMPLETED
+        reactor.handle_packet(conversation, packets.AcknowledgementPacket(2))
+        self.assertIsNone(table.get_conversation(*client_addr))
+        # Late packets still reach the conversation through its tombstone
+        packet = packets.DataPacket(2, "")
+        self.assertEqual(reactor.get_conversation(client_addr[0],
+                                                  client_addr[1], packet),
+                         conversation)
+
+    def test_handle_transfer_message(self):
+        reactor = Reactor('stub_socket', 'stub_router', ConversationTable(),
+                          per_transfer_sockets=True)
+        conversation = StubConversation()
+        conversation.sock = StubSocket()
+        reactor.handle_transfer_message(
+            conversation, ('10.26.0.1', 3942),
+            packets.AcknowledgementPacket(1).pack())
+        self.assertEqual([packet.block_num for packet in conversation.handled],
+                         [1])
+
+    def test_handle_transfer_message_from_unknown_transfer_id(self):
+        reactor = Reactor('stub_socket', 'stub_router', ConversationTable(),
+                          per_transfer_sockets=True)
+        conversation = StubConversation()
+        conversation.sock = StubSocket()
+        reactor.handle_transfer_message(
+            conversation, ('10.26.0.1', 4000),
+            packets.AcknowledgementPacket(1).pack())
+        self.assertEqual(conversation.handled, [])
+        self.assertEqual(conversation.sock.sent,
+                         [(packets.ErrorPacket(5,
+                                               "Unknown transfer ID").pack(),
+                           ('10.26.0.1', 4000))])
+
+    def test_is_transfer_finished(self):
+        conversation_table = ConversationTable()
+        reactor = Reactor('stub_socket', 'stub_router', conversation_table,
+                          per_transfer_sockets=True)
+        conversation = StubConversation()
+        conversation_table.add_conversation('10.26.0.1', 3942, conversation)
+        self.assertFalse(reactor.is_transfer_finished(conversation))
+        conversation_table.delete_conversation('10.26.0.1', 3942)
+        self.assertTrue(reactor.is_transfer_finished(conversation))
+
+    def test_is_transfer_finished_after_tombstone_expires(self):
+        conversation_table = ConversationTable(5)
+        reactor = Reactor('stub_socket', 'stub_router', conversation_table,
+                          per_transfer_sockets=True)
+        conversation = StubConversation()
+        conversation_table.add_conversation('10.26.0.1', 3942, conversation)
+        conversation_table.retire_conversation('10.26.0.1', 3942)
+        self.assertFalse(reactor.is_transfer_finished(conversation))
+        conversation_table.expire_tombstones(monotonic() + 5)
+        self.assertTrue(reactor.is_transfer_finished(conversation))
+
+
+class TestEventLoopReactor(unittest.TestCase):
+    def setUp(self):
+        self.reactor = EventLoopReactor('stub_socket', 'stub_router',
+                                        ConversationTable())
+
+    def test_drain_socket(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.setblocking(0)
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client.bind(('127.0.0.1', 0))
+        conversation = StubConversation()
+        self.reactor.sock = server
+        self.reactor.conversation_table.add_conversation(
+            '127.0.0.1', client.getsockname()[1], conversation)
+        client.sendto(packets.AcknowledgementPacket(1).pack(),
+                      server.getsockname())
+        client.sendto(packets.AcknowledgementPacket(2).pack(),
+                      server.getsockname())
+        self.reactor.add_reader(server.fileno(), self.reactor.drain_socket)
+        self.reactor.run_once(1)
+        self.assertEqual([packet.block_num for packet in conversation.handled],
+                         [1, 2])
+        server.close()
+        client.close()
+
+    def test_drain_socket_in_batches(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.setblocking(0)
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client.bind(('127.0.0.1', 0))
+        client.settimeout(1)
+        conversation = StubConversation()
+        conversation.client_host, conversation.client_port = (
+            client.getsockname())
+        conversation.handle_packet = lambda packet: (
+            packets.AcknowledgementPacket(packet.block_num))
+        reactor = EventLoopReactor(server, 'stub_router', ConversationTable(),
+                                   batch_size=4)
+        reactor.conversation_table.add_conversation(
+            '127.0.0.1', client.getsockname()[1], conversation)
+        for block_num in xrange(1, 11):
+            client.sendto(packets.DataPacket(block_num, "data").pack(),
+                          server.getsockname())
+        reactor.add_reader(server.fileno(), reactor.drain_socket)
+        reactor.run_once(1)
+        responses = [packets.unpack_packet(client.recvfrom(1024)[0])
+                     for _ in xrange(10)]
+        self.assertEqual([packet.block_num for packet in responses],
+                         range(1, 11))
+        server.close()
+        client.close()
+
+    def test_resume_deferred_conversation_on_loop(self):
+        sock = StubSocket()
+        self.reactor.sock = sock
+        conversation = StubPendingConversation()
+        packet = packets.ReadRequestPacket('stub filename', 'stub mode')
+        self.reactor.handle_packet(conversation, packet)
+        self.assertEqual(sock.sent, [])
+
+        # Completing the Deferred only queues the conversation; it is resumed
+        # and answered from the event loop.
+        conversation.pending_action.resolve("stub data")
+        self.assertEqual(sock.sent, [])
+        self.reactor.run_once(1)
+        self.assertEqual(sock.sent,
+                         [(packets.DataPacket(1, "stub data").pack(),
+                           ('10.26.0.1', 3942))])
+        self.assertEqual(conversation.state, tftp_conversation.READING)
+
+    def test_respond_with_window(self):
+        sock = StubSocket()
+        self.reactor.sock = sock
+        window = [packets.DataPacket(block_num, "data")
+                  for block_num in xrange(1, 5)]
+        self.reactor.respond_to_conversation(StubConversation(), window)
+        self.reactor.flush_outgoing()
+        self.assertEqual([data for data, _ in sock.sent],
+                         [packet.pack() for packet in window])
+
+    def test_rate_limited_packets_are_deferred(self):
+        sock = StubSocket()
+        self.reactor.sock = sock
+        self.reactor.rate_limiter = RateLimiter(
+            host_limit=RateLimit(packets_per_second=10))
+        conversation = StubConversation()
+        sent_marks = []
+        conversation.rate_limit = None
+        conversation.mark_sent = lambda: sent_marks.append(True)
+        for block_num in xrange(1, 12):
+            self.reactor.respond_to_conversation(
+                conversation, packets.DataPacket(block_num, "data"))
+        self.reactor.flush_outgoing()
+        # A second's worth of packets goes out right away, the rest later
+        self.assertEqual(len(sock.sent), 10)
+        self.assertEqual(len(self.reactor.scheduler), 1)
+        self.reactor.run_once(1)
+        self.assertEqual(len(sock.sent), 11)
+        self.assertEqual(sock.sent[-1][0],
+                         packets.DataPacket(11, "data").pack())
+        self.assertEqual(sent_marks, [True])
+
+    def test_transfer_socket(self):
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client.bind(('127.0.0.1', 0))
+        conversation = StubConversation()
+        conversation.client_host, conversation.client_port = (
+            client.getsockname())
+        conversation.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        conversation.sock.bind(('127.0.0.1', 0))
+        self.reactor.conversation_table.add_conversation(
+            conversation.client_host, conversation.client_port, conversation)
+        self.reactor.watch_transfer_socket(conversation)
+
+        client.sendto(packets.AcknowledgementPacket(1).pack(),
+                      conversation.sock.getsockname())
+        self.reactor.run_once(1)
+        self.assertEqual([packet.block_num for packet in conversation.handled],
+                         [1])
+
+        # Once the conversation leaves the table, its socket is closed
+        self.reactor.conversation_table.delete_conversation(
+            conversation.client_host, conversation.client_port)
+        self.reactor.close_finished_transfers()
+        self.assertEqual(self.reactor.transfer_conversations, {})
+        self.assertRaises(socket.error, conversation.sock.getsockname)
+        client.close()
+
+    def test_run_once_runs_performer(self):
+        class StubPerformer(object):
+            passes = 0
+            def perform_tasks(self):
+                self.passes += 1
+        performer = StubPerformer()
+        self.reactor.performer = performer
+        self.reactor.run_once(0)
+        self.reactor.run_once(0)
+        self.assertEqual(performer.passes, 1)
+
+    def test_run_once_survives_failing_callback(self):
+        calls = []
+        def fail():
+            calls.append('fail')
+            raise socket.error(errno.EBADF, 'Bad file descriptor')
+        readable, writable = os.pipe()
+        os.write(writable, 'x')
+        self.reactor.add_reader(readable, fail)
+        self.reactor.run_once(1)
+        self.reactor.run_once(1)
+        self.assertEqual(calls, ['fail', 'fail'])
+        self.reactor.remove_reader(readable)
+        os.close(readable)
+        os.close(writable)
+
+
+class TestPoller(unittest.TestCase):
+    def test_poll_retries_when_interrupted(self):
+        class InterruptedPoller(object):
+            calls = 0
+            def poll(self, timeout):
+                self.calls += 1
+                if self.calls == 1:
+                    raise IOError(errno.EINTR, 'Interrupted system call')
+                return [(3, 1)]
+        poller = Poller()
+        poller.poller = InterruptedPoller()
+        self.assertEqual(poller.poll(1), [(3, 1)])
+        self.assertEqual(poller.poller.calls, 2)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,62 @@
+import os
+import sys
+import unittest
+sys.path.append(os.path.join(os.path.dirname(__file__), "../emmer"))
+
+from response_cache import ResponseCache
+
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = ResponseCache(10)
+
+    def test_get_and_put(self):
+        self.assertIsNone(self.cache.get("a", 0))
+        self.cache.put("a", "aaaa", 4, 60, 0)
+        self.assertEqual(self.cache.get("a", 0), "aaaa")
+        self.assertEqual(self.cache.size, 4)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_results_are_shared(self):
+        data = "x" * 8
+        self.cache.put("a", data, 8, 60, 0)
+        self.assertTrue(self.cache.get("a", 0) is data)
+
+    def test_expiry(self):
+        self.cache.put("a", "aaaa", 4, 60, now=0)
+        self.assertEqual(self.cache.get("a", now=59), "aaaa")
+        self.assertIsNone(self.cache.get("a", now=60))
+        self.assertEqual(self.cache.size, 0)
+
+    def test_least_recently_used_are_evicted(self):
+        self.cache.put("a", "aaaa", 4, 60, 0)
+        self.cache.put("b", "bbbb", 4, 60, 0)
+        self.cache.get("a", 0)
+        self.cache.put("c", "cccc", 4, 60, 0)
+        self.assertEqual(self.cache.get("a", 0), "aaaa")
+        self.assertIsNone(self.cache.get("b", 0))
+        self.assertEqual(self.cache.get("c", 0), "cccc")
+        self.assertEqual(self.cache.size, 8)
+
+    def test_put_replaces_entry(self):
+        self.cache.put("a", "aaaa", 4, 60, 0)
+        self.cache.put("a", "aa", 2, 60, 0)
+        self.assertEqual(self.cache.get("a", 0), "aa")
+        self.assertEqual(self.cache.size, 2)
+
+    def test_results_larger_than_budget_are_not_cached(self):
+        self.cache.put("a", "aaaa", 4, 60, 0)
+        self.cache.put("b", "b" * 11, 11, 60, 0)
+        self.assertIsNone(self.cache.get("b", 0))
+        self.assertEqual(self.cache.get("a", 0), "aaaa")
+
+    def test_invalidate_and_clear(self):
+        self.cache.put("a", "aaaa", 4, 60, 0)
+        self.cache.put("b", "bbbb", 4, 60, 0)
+        self.cache.invalidate("a")
+        self.cache.invalidate("missing")
+        self.assertIsNone(self.cache.get("a", 0))
+        self.assertEqual(self.cache.size, 4)
+        self.cache.clear()
+        self.assertIsNone(self.cache.get("b", 0))
+        self.assertEqual(self.cache.size, 0)
@@ -1,8 +1,20 @@
 import os
+import re
+import shutil
+import StringIO
 import sys
+import tempfile
 import unittest
 sys.path.append(os.path.join(os.path.dirname(__file__), "../emmer"))
-from response_router import ResponseRouter
+from deferred import Deferred
+from rate_limit import RateLimit
+from response_cache import ResponseCache
+import response_router
+from response_router import (WILDCARD, MappedReadBuffer, ReadBuffer,
+                             ResponseRouter, Route, RouteIndex,
+                             SpoolingWriteSink, StreamReadBuffer, WriteBuffer,
+                             map_file, pattern_prefix)
+from worker_pool import WorkerPoolFull
 
 
 class TestResponseRouter(unittest.TestCase):
@@ -34,6 +46,25 @@ class TestResponseRouter(unittest.TestCase):
         read_buffer = self.router.initialize_read("test3if", "127.0.0.1", 3942)
         self.assertEqual(read_buffer.data, "3")
 
+    def test_initialize_read_with_rate_limit(self):
+        rate_limit = RateLimit(bytes_per_second=1024)
+        self.router.append_read_rule("limited", lambda x, y, z: "data",
+                                     rate_limit)
+        read_buffer = self.router.initialize_read("limited", "127.0.0.1", 3942)
+        self.assertEqual(read_buffer.rate_limit, rate_limit)
+        read_buffer = self.router.initialize_read("test1", "127.0.0.1", 3942)
+        self.assertIsNone(read_buffer.rate_limit)
+
+    def test_initialize_read_with_deferred_action(self):
+        deferred = Deferred()
+        self.router.append_read_rule("deferred", lambda x, y, z: deferred)
+        result = self.router.initialize_read("deferred", "127.0.0.1", 3942)
+        self.assertTrue(isinstance(result, Deferred))
+        self.assertFalse(result.completed)
+        deferred.resolve("deferred data")
+        self.assertEqual(result.result.__class__, ReadBuffer)
+        self.assertEqual(result.result.data, "deferred data")
+
     def test_initialize_read_for_no_action(self):
         read_buffer = self.router.initialize_read("test4", "127.0.0.1", 3942)
         self.assertEqual(read_buffer, None)
@@ -52,5 +83,468 @@ class TestResponseRouter(unittest.TestCase):
         write_action = self.router.initialize_write("test4", "127.0.0.1", 3942)
         self.assertEqual(write_action, None)
 
+class TestRouteIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = RouteIndex()
+        for pattern in ["hosts/10.0.0.1/.*", "hosts/10.0.0.2/boot",
+                        "hosts/.*/boot", "hosts/10.0.0.2/.*", "(?i)HOSTS/x",
+                        ".*\\.cfg", "pxelinux\\.0", "[a-c]at"]:
+            self.index.append(Route(pattern, pattern))
+
+    def find(self, filename):
+        route = self.index.find(filename)
+        return route and route.action
+
+    def test_first_match_wins(self):
+        self.assertEqual(self.find("hosts/10.0.0.1/boot"),
+                         "hosts/10.0.0.1/.*")
+        self.assertEqual(self.find("hosts/10.0.0.2/boot"),
+                         "hosts/10.0.0.2/boot")
+        self.assertEqual(self.find("hosts/10.0.0.2/kernel"),
+                         "hosts/10.0.0.2/.*")
+        self.assertEqual(self.find("hosts/10.0.0.3/boot"), "hosts/.*/boot")
+        self.assertEqual(self.find("hosts/x"), "(?i)HOSTS/x")
+        self.assertEqual(self.find("hosts/10.0.0.3/a.cfg"), ".*\\.cfg")
+        self.assertEqual(self.find("bat"), "[a-c]at")
+
+    def test_no_match(self):
+        self.assertIsNone(self.find("hosts/10.0.0.3/kernel"))
+        self.assertIsNone(self.find("pxelinux"))
+        self.assertIsNone(self.find(""))
+
+    def test_matches_linear_scan(self):
+        filenames = ["hosts/10.0.0.1/", "hosts/10x0y0z1/a", "pxelinux.0",
+                     "pxelinux.0.cfg", "HOSTS/x", "cat", "dat", "hosts/"]
+        for filename in filenames:
+            expected = None
+            for route in self.index:
+                if re.match(route.filename_pattern, filename):
+                    expected = route.action
+                    break
+            self.assertEqual(self.find(filename), expected)
+
+    def test_unmatched_filenames_are_remembered(self):
+        self.assertIsNone(self.find("etc/passwd"))
+        self.assertEqual(self.index.unmatched, set(["etc/passwd"]))
+        self.assertIsNone(self.find("etc/passwd"))
+        self.index.append(Route("etc/.*", "etc/.*"))
+        self.assertEqual(self.index.unmatched, set())
+        self.assertEqual(self.find("etc/passwd"), "etc/.*")
+
+    def test_unmatched_filenames_are_bounded(self):
+        for i in xrange(response_router.MAX_UNMATCHED_FILENAMES + 1):
+            self.find("missing/%d" % i)
+        self.assertEqual(self.index.unmatched, set(["missing/%d" % i]))
+
+    def test_pattern_prefix(self):
+        prefix = lambda pattern: "".join(
+            char or "?" for char in pattern_prefix(re.compile(pattern)))
+        self.assertEqual(prefix("abc"), "abc")
+        self.assertEqual(prefix("^abc"), "abc")
+        self.assertEqual(prefix("ab?c"), "a")
+        self.assertEqual(prefix("ab+c"), "a")
+        self.assertEqual(prefix("a\\.b.c"), "a.b?c")
+        self.assertEqual(prefix("[0-9]\\d/x"), "??/x")
+        self.assertEqual(prefix("ab|ac"), "a?")
+        self.assertEqual(prefix("(?i)abc"), "")
+        self.assertEqual(pattern_prefix(re.compile("a.")), ["a", WILDCARD])
+
+
+class TestReadBuffer(unittest.TestCase):
+    def test_get_block_with_block_size(self):
+        read_buffer = ReadBuffer("X" * 3000)
+        self.assertEqual(read_buffer.get_block_count(1428), 3)
+        self.assertEqual(read_buffer.get_block(1, 1428), "X" * 1428)
+        self.assertEqual(read_buffer.get_block(3, 1428), "X" * 144)
+
+    def test_get_block_count_for_exact_multiple(self):
+        read_buffer = ReadBuffer("X" * 1024)
+        self.assertEqual(read_buffer.get_block_count(), 3)
+        self.assertEqual(read_buffer.get_block(3), "")
+
+
+class TestMappedReadBuffer(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "image")
+        self.data = "".join(chr(i % 251) for i in xrange(3000))
+        self.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, data):
+        # Replace the file, as files being served should be
+        temporary_path = self.path + ".new"
+        with open(temporary_path, "wb") as f:
+            f.write(data)
+        os.rename(temporary_path, self.path)
+
+    def test_get_block(self):
+        read_buffer = MappedReadBuffer(map_file(self.path))
+        self.assertEqual(read_buffer.get_block_count(1428), 3)
+        block = read_buffer.get_block(2, 1428)
+        self.assertTrue(isinstance(block, buffer))
+        self.assertEqual(str(block), self.data[1428:2856])
+        self.assertEqual(str(read_buffer.get_block(3, 1428)),
+                         self.data[2856:])
+
+    def test_mapping_is_shared(self):
+        mapped_file = map_file(self.path)
+        self.assertTrue(map_file(self.path) is mapped_file)
+        self.write("new data")
+        new_mapped_file = map_file(self.path)
+        self.assertFalse(new_mapped_file is mapped_file)
+        self.assertEqual(new_mapped_file.data[:], "new data")
+        self.assertEqual(mapped_file.data[:], self.data)
+
+    def test_empty_file(self):
+        self.write("")
+        read_buffer = MappedReadBuffer(map_file(self.path))
+        self.assertEqual(read_buffer.get_block_count(), 1)
+        self.assertEqual(str(read_buffer.get_block(1)), "")
+
+    def test_route_creates_mapped_read_buffer(self):
+        router = ResponseRouter()
+        router.append_read_rule("image", lambda x, y, z: map_file(self.path))
+        read_buffer = router.initialize_read("image", "127.0.0.1", 3942)
+        self.assertTrue(isinstance(read_buffer, MappedReadBuffer))
+
+
+class StubStream(object):
+    def __init__(self, data):
+        self.stream = StringIO.StringIO(data)
+        self.closed = False
+
+    def read(self, length):
+        # Short reads, as pipes and sockets give
+        return self.stream.read(min(length, 100))
+
+    def close(self):
+        self.closed = True
+
+
+class TestStreamReadBuffer(unittest.TestCase):
+    def setUp(self):
+        self.data = "".join(chr(i % 251) for i in xrange(3000))
+
+    def read_all(self, read_buffer, block_size):
+        blocks = []
+        block_num = 1
+        while read_buffer.get_block_count(block_size) is None:
+            blocks.append(read_buffer.get_block(block_num, block_size))
+            read_buffer.release(block_num)
+            block_num += 1
+        self.assertEqual(read_buffer.get_block_count(block_size),
+                         len(blocks))
+        self.assertTrue(all(len(block) == block_size
+                            for block in blocks[:-1]))
+        self.assertTrue(len(blocks[-1]) < block_size)
+        return "".join(blocks)
+
+    def test_file(self):
+        read_buffer = StreamReadBuffer(StringIO.StringIO(self.data))
+        self.assertEqual(self.read_all(read_buffer, 512), self.data)
+
+    def test_file_with_short_reads(self):
+        stream = StubStream(self.data)
+        read_buffer = StreamReadBuffer(stream)
+        self.assertEqual(self.read_all(read_buffer, 1428), self.data)
+        read_buffer.close()
+        self.assertTrue(stream.closed)
+
+    def test_iterator(self):
+        chunks = ["", self.data[:700], "", self.data[700:701],
+                  self.data[701:]]
+        read_buffer = StreamReadBuffer(iter(chunks))
+        self.assertEqual(self.read_all(read_buffer, 512), self.data)
+
+    def test_function_of_offset_and_length(self):
+        read_buffer = StreamReadBuffer(
+            lambda offset, length: self.data[offset:offset + length])
+        self.assertEqual(self.read_all(read_buffer, 256), self.data)
+
+    def test_exact_multiple(self):
+        read_buffer = StreamReadBuffer(["X" * 1024])
+        self.assertEqual(read_buffer.get_block(2), "X" * 512)
+        self.assertIsNone(read_buffer.get_block_count())
+        self.assertEqual(read_buffer.get_block(3), "")
+        self.assertEqual(read_buffer.get_block_count(), 3)
+
+    def test_blocks_are_read_lazily_and_released(self):
+        chunks_read = []
+        def chunks():
+            for i in xrange(10):
+                chunks_read.append(i)
+                yield "X" * 512
+        read_buffer = StreamReadBuffer(chunks())
+        self.assertEqual(chunks_read, [])
+        read_buffer.get_block(1)
+        read_buffer.get_block(4)
+        self.assertEqual(chunks_read, [0, 1, 2, 3])
+        self.assertEqual(sorted(read_buffer.blocks), [1, 2, 3, 4])
+        read_buffer.release(2)
+        self.assertEqual(sorted(read_buffer.blocks), [3, 4])
+        # Blocks that were read but not acknowledged can be read again
+        self.assertEqual(read_buffer.get_block(3), "X" * 512)
+
+    def test_route_creates_stream_read_buffer(self):
+        router = ResponseRouter()
+        router.append_read_rule("stream", lambda x, y, z: iter(["1"]))
+        read_buffer = router.initialize_read("stream", "127.0.0.1", 3942)
+        self.assertTrue(isinstance(read_buffer, StreamReadBuffer))
+        self.assertEqual(read_buffer.get_block(1), "1")
+
+
+class TestResponseRouterWithCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = ResponseCache(1 << 20)
+        self.router = ResponseRouter(response_cache=self.cache)
+        self.calls = []
+        self.router.append_read_rule("cached", self.read_action, cache_ttl=60)
+        self.router.append_read_rule("per_host", self.read_action,
+                                     cache_ttl=60,
+                                     cache_key=lambda x, y, z: (x, z))
+        self.router.append_read_rule("uncached", self.read_action)
+
+    def read_action(self, client_host, client_port, filename):
+        self.calls.append(filename)
+        return "data %d" % len(self.calls)
+
+    def test_results_are_cached_and_shared(self):
+        first = self.router.initialize_read("cached", "10.26.0.1", 1000)
+        second = self.router.initialize_read("cached", "10.26.0.2", 1001)
+        self.assertEqual(self.calls, ["cached"])
+        self.assertEqual(second.data, "data 1")
+        self.assertTrue(first.data is second.data)
+        self.assertFalse(first is second)
+
+    def test_uncached_route(self):
+        self.router.initialize_read("uncached", "10.26.0.1", 1000)
+        self.router.initialize_read("uncached", "10.26.0.1", 1000)
+        self.assertEqual(self.calls, ["uncached", "uncached"])
+
+    def test_cache_key(self):
+        self.router.initialize_read("per_host", "10.26.0.1", 1000)
+        self.router.initialize_read("per_host", "10.26.0.1", 1001)
+        self.router.initialize_read("per_host", "10.26.0.2", 1000)
+        self.assertEqual(self.calls, ["per_host", "per_host"])
+
+    def test_invalidate_cache(self):
+        self.router.initialize_read("cached", "10.26.0.1", 1000)
+        self.router.invalidate_cache("cached")
+        read_buffer = self.router.initialize_read("cached", "10.26.0.1", 1000)
+        self.assertEqual(read_buffer.data, "data 2")
+        self.router.invalidate_cache()
+        self.assertEqual(self.cache.size, 0)
+
+    def test_deferred_results_are_cached(self):
+        deferred = Deferred()
+        self.router.append_read_rule("deferred", lambda x, y, z: deferred,
+                                     cache_ttl=60)
+        result = self.router.initialize_read("deferred", "10.26.0.1", 1000)
+        deferred.resolve("deferred data")
+        self.assertEqual(result.result.data, "deferred data")
+        read_buffer = self.router.initialize_read("deferred", "10.26.0.2",
+                                                  1000)
+        self.assertEqual(read_buffer.data, "deferred data")
+
+    def test_streams_are_not_cached(self):
+        self.router.append_read_rule("stream",
+                                     lambda x, y, z: iter(["a", "b"]),
+                                     cache_ttl=60)
+        first = self.router.initialize_read("stream", "10.26.0.1", 1000)
+        second = self.router.initialize_read("stream", "10.26.0.1", 1000)
+        self.assertEqual(first.__class__, StreamReadBuffer)
+        self.assertFalse(first.source is second.source)
+        self.assertEqual(self.cache.size, 0)
+
+
+class StubActionPool(object):
+    def __init__(self):
+        self.deferred = []
+
+    def defer(self, function, *args):
+        deferred = Deferred()
+        self.deferred.append((deferred, function, args))
+        return deferred
+
+
+class TestResponseRouterWithActionPool(unittest.TestCase):
+    def setUp(self):
+        self.action_pool = StubActionPool()
+        self.router = ResponseRouter(self.action_pool)
+        self.read_action = lambda x, y, z: "1"
+        self.write_action = lambda x, y, z, data: "%s_4" % data
+        self.router.append_read_rule("test1", self.read_action)
+        self.router.append_write_rule("test1", self.write_action)
+
+    def test_initialize_read(self):
+        result = self.router.initialize_read("test1", "127.0.0.1", 3942)
+        self.assertTrue(isinstance(result, Deferred))
+        deferred, function, args = self.action_pool.deferred[0]
+        self.assertEqual(function, self.read_action)
+        self.assertEqual(args, ("127.0.0.1", 3942, "test1"))
+        deferred.resolve(function(*args))
+        self.assertEqual(result.result.data, "1")
+
+    def test_initialize_read_for_no_action(self):
+        read_buffer = self.router.initialize_read("test4", "127.0.0.1", 3942)
+        self.assertEqual(read_buffer, None)
+        self.assertEqual(self.action_pool.deferred, [])
+
+    def test_initialize_write(self):
+        write_action = self.router.initialize_write("test1", "127.0.0.1", 3942)
+        result = write_action("a", "b", "c", "d")
+        self.assertTrue(isinstance(result, Deferred))
+        deferred, function, args = self.action_pool.deferred[0]
+        self.assertEqual(function, self.write_action)
+        self.assertEqual(args, ("a", "b", "c", "d"))
+
+    def test_initialize_write_with_spool(self):
+        self.router.append_write_rule("spooled", self.write_action,
+                                      spool=True)
+        sink = self.router.initialize_write("spooled", "127.0.0.1", 3942)
+        sink.write("data")
+        result = sink.close()
+        self.assertTrue(isinstance(result, Deferred))
+        deferred, function, args = self.action_pool.deferred[0]
+        self.assertEqual(args[:3], ("127.0.0.1", 3942, "spooled"))
+        # The spool lasts until the action is done with it
+        self.assertEqual(args[3].read(), "data")
+        deferred.resolve(None)
+        self.assertTrue(sink.spool.closed)
+
+
+class TestResponseRouterCoalescing(unittest.TestCase):
+    def setUp(self):
+        self.action_pool = StubActionPool()
+        self.router = ResponseRouter(self.action_pool)
+        self.read_action = lambda x, y, z: "1"
+        self.router.append_read_rule("coalesced", self.read_action,
+                                     coalesce=True)
+        self.router.append_read_rule("stream", lambda x, y, z: iter(["a"]),
+                                     coalesce=True)
+        self.router.append_read_rule("uncoalesced", self.read_action)
+
+    def test_concurrent_requests_share_one_run(self):
+        results = [self.router.initialize_read("coalesced", "10.26.0.1", port)
+                   for port in xrange(1000, 1005)]
+        self.assertEqual(len(self.action_pool.deferred), 1)
+        deferred, function, args = self.action_pool.deferred[0]
+        deferred.resolve(function(*args))
+        for result in results:
+            self.assertEqual(result.result.data, "1")
+        self.assertEqual(len(set(id(result.result) for result in results)), 5)
+        self.assertEqual(self.router.single_flight.calls, 1)
+        self.assertEqual(self.router.single_flight.coalesced, 4)
+
+    def test_failure_fans_out(self):
+        results = [self.router.initialize_read("coalesced", "10.26.0.1", port)
+                   for port in xrange(1000, 1003)]
+        error = IOError("backend down")
+        self.action_pool.deferred[0][0].fail(error)
+        for result in results:
+            self.assertTrue(result.error is error)
+
+    def test_full_action_pool_fans_out(self):
+        followers = []
+        def defer(function, *args):
+            # Another request arrives while the first is being submitted
+            followers.append(self.router.initialize_read(
+                "coalesced", "10.26.0.1", 1001))
+            raise WorkerPoolFull("1 tasks already waiting")
+        self.action_pool.defer = defer
+        self.assertRaises(WorkerPoolFull, self.router.initialize_read,
+                          "coalesced", "10.26.0.1", 1000)
+        self.assertTrue(isinstance(followers[0].error, WorkerPoolFull))
+
+    def test_uncoalesced_route(self):
+        self.router.initialize_read("uncoalesced", "10.26.0.1", 1000)
+        self.router.initialize_read("uncoalesced", "10.26.0.1", 1001)
+        self.assertEqual(len(self.action_pool.deferred), 2)
+
+    def test_streams_are_not_shared(self):
+        first = self.router.initialize_read("stream", "10.26.0.1", 1000)
+        second = self.router.initialize_read("stream", "10.26.0.1", 1001)
+        deferred, function, args = self.action_pool.deferred[0]
+        deferred.resolve(function(*args))
+        self.assertTrue(isinstance(first.result, StreamReadBuffer))
+        # The coalesced request runs the action again for its own stream
+        self.assertEqual(len(self.action_pool.deferred), 2)
+        deferred, function, args = self.action_pool.deferred[1]
+        deferred.resolve(function(*args))
+        self.assertTrue(isinstance(second.result, StreamReadBuffer))
+        self.assertFalse(first.result.source is second.result.source)
+
+    def test_coalesced_results_are_cached(self):
+        self.router.response_cache = ResponseCache(1 << 20)
+        self.router.append_read_rule("both", self.read_action, cache_ttl=60,
+                                     coalesce=True)
+        first = self.router.initialize_read("both", "10.26.0.1", 1000)
+        second = self.router.initialize_read("both", "10.26.0.1", 1001)
+        deferred, function, args = self.action_pool.deferred[0]
+        deferred.resolve(function(*args))
+        self.assertEqual(second.result.data, "1")
+        read_buffer = self.router.initialize_read("both", "10.26.0.1", 1002)
+        self.assertEqual(read_buffer.data, "1")
+        self.assertEqual(len(self.action_pool.deferred), 1)
+
+class StubWriteSink(object):
+    def __init__(self, *args):
+        self.args = args
+
+
+class TestWriteRoutes(unittest.TestCase):
+    def setUp(self):
+        self.router = ResponseRouter(spool_size=1024)
+        self.received = []
+        self.router.append_write_sink_rule("sink", StubWriteSink)
+        self.router.append_write_rule("spooled", self.spooled_action,
+                                      spool=True)
+
+    def spooled_action(self, client_host, client_port, filename, spool):
+        self.received.append((filename, spool.read(), spool._rolled))
+        return "result"
+
+    def test_initialize_write_sink(self):
+        sink = self.router.initialize_write("sink", "127.0.0.1", 3942)
+        self.assertTrue(isinstance(sink, StubWriteSink))
+        self.assertEqual(sink.args, ("127.0.0.1", 3942, "sink"))
+
+    def test_spooling_write_sink(self):
+        for size in (1000, 5000):
+            sink = self.router.initialize_write("spooled", "127.0.0.1", 3942)
+            self.assertTrue(isinstance(sink, SpoolingWriteSink))
+            for i in xrange(0, size, 512):
+                sink.write("X" * min(512, size - i))
+            self.assertEqual(sink.close(), "result")
+            self.assertTrue(sink.spool.closed)
+        # Only the upload that outgrew the spool size went to a file
+        self.assertEqual(self.received, [("spooled", "X" * 1000, False),
+                                         ("spooled", "X" * 5000, True)])
+
+    def test_spooling_write_sink_abort(self):
+        sink = self.router.initialize_write("spooled", "127.0.0.1", 3942)
+        sink.write("X" * 5000)
+        sink.abort()
+        self.assertTrue(sink.spool.closed)
+        self.assertEqual(self.received, [])
+
+
+class TestWriteBuffer(unittest.TestCase):
+    def test_receive_data(self):
+        write_buffer = WriteBuffer()
+        self.assertEqual(write_buffer.data, "")
+        write_buffer.receive_data("abc")
+        write_buffer.receive_data("def")
+        self.assertEqual(write_buffer.data, "abcdef")
+        write_buffer.receive_data("g")
+        self.assertEqual(write_buffer.data, "abcdefg")
+        write_buffer.data = "X"
+        write_buffer.receive_data("Y")
+        self.assertEqual(write_buffer.data, "XY")
+
+
 if __name__ == "__main__":
     unittest.main()
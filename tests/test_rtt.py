@@ -0,0 +1,47 @@
+import os
+import sys
+import unittest
+sys.path.append(os.path.join(os.path.dirname(__file__), "../emmer"))
+
+from rtt import RTTEstimator
+
+
+class TestRTTEstimator(unittest.TestCase):
+    def test_initial_timeout(self):
+        estimator = RTTEstimator()
+        self.assertEqual(estimator.timeout(1, 0.2, 10), 1)
+
+    def test_first_sample(self):
+        estimator = RTTEstimator()
+        estimator.sample(0.1)
+        self.assertEqual(estimator.smoothed_rtt, 0.1)
+        self.assertEqual(estimator.rtt_variance, 0.05)
+        self.assertAlmostEqual(estimator.timeout(1, 0, 10), 0.3)
+
+    def test_samples_are_smoothed(self):
+        estimator = RTTEstimator()
+        estimator.sample(0.1)
+        estimator.sample(0.5)
+        self.assertAlmostEqual(estimator.smoothed_rtt, 0.15)
+        self.assertAlmostEqual(estimator.rtt_variance, 0.1375)
+
+    def test_timeout_is_clamped(self):
+        estimator = RTTEstimator()
+        estimator.sample(0.001)
+        self.assertEqual(estimator.timeout(1, 0.2, 10), 0.2)
+        estimator.sample(30)
+        self.assertEqual(estimator.timeout(1, 0.2, 10), 10)
+
+    def test_backoff_holds_until_next_sample(self):
+        estimator = RTTEstimator()
+        estimator.sample(0.1)
+        estimator.back_off()
+        estimator.back_off()
+        self.assertAlmostEqual(estimator.timeout(1, 0, 10), 1.2)
+        estimator.sample(0.1)
+        self.assertEqual(estimator.backoff, 0)
+        self.assertTrue(estimator.timeout(1, 0, 10) < 0.3)
+
+
+if __name__ == "__main__":
+    unittest.main()
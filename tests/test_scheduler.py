@@ -0,0 +1,71 @@
+import os
+import sys
+import unittest
+sys.path.append(os.path.join(os.path.dirname(__file__), "../emmer"))
+
+from scheduler import Scheduler, TimerHeap
+
+
+class TestScheduler(unittest.TestCase):
+    def test_run_due(self):
+        scheduler = Scheduler()
+        calls = []
+        scheduler.call_later(0, calls.append, 1)
+        scheduler.call_later(60, calls.append, 3)
+        scheduler.call_later(0, calls.append, 2)
+        scheduler.run_due()
+        self.assertEqual(calls, [1, 2])
+        self.assertEqual(len(scheduler), 1)
+        self.assertTrue(55 < scheduler.time_until_next() <= 60)
+
+    def test_failing_call_does_not_stop_others(self):
+        scheduler = Scheduler()
+        calls = []
+        scheduler.call_later(0, lambda: 1 / 0)
+        scheduler.call_later(0, calls.append, 1)
+        scheduler.run_due()
+        self.assertEqual(calls, [1])
+
+    def test_nothing_scheduled(self):
+        self.assertIsNone(Scheduler().time_until_next())
+
+
+class TestTimerHeap(unittest.TestCase):
+    def test_pop_due(self):
+        timers = TimerHeap()
+        timers.schedule("b", 2)
+        timers.schedule("a", 1)
+        timers.schedule("c", 3)
+        self.assertEqual(timers.next_deadline(), 1)
+        self.assertEqual(timers.pop_due(2), ["a", "b"])
+        self.assertEqual(timers.pop_due(2), [])
+        self.assertEqual(len(timers), 1)
+
+    def test_schedule_replaces_deadline(self):
+        timers = TimerHeap()
+        timers.schedule("a", 1)
+        timers.schedule("a", 5)
+        timers.schedule("b", 3)
+        timers.schedule("b", 2)
+        self.assertEqual(timers.next_deadline(), 2)
+        self.assertEqual(timers.pop_due(4), ["b"])
+        self.assertEqual(timers.pop_due(5), ["a"])
+
+    def test_cancel(self):
+        timers = TimerHeap()
+        timers.schedule("a", 1)
+        timers.cancel("a")
+        timers.cancel("b")
+        self.assertFalse("a" in timers)
+        self.assertIsNone(timers.next_deadline())
+        self.assertEqual(timers.pop_due(10), [])
+
+    def test_rescheduling_does_not_grow_heap(self):
+        timers = TimerHeap()
+        for deadline in xrange(10000):
+            timers.schedule("a", deadline)
+        self.assertTrue(len(timers.heap) < 100)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+import os
+import sys
+import threading
+import unittest
+sys.path.append(os.path.join(os.path.dirname(__file__), "../emmer"))
+
+from deferred import Deferred
+from single_flight import SingleFlight
+
+
+class TestSingleFlight(unittest.TestCase):
+    def setUp(self):
+        self.single_flight = SingleFlight()
+
+    def test_sequential_calls_are_not_coalesced(self):
+        self.assertEqual(self.single_flight.run("a", lambda x: x * 2, 1),
+                         (2, False))
+        self.assertEqual(self.single_flight.run("a", lambda x: x * 3, 1),
+                         (3, False))
+        self.assertEqual(self.single_flight.calls, 2)
+        self.assertEqual(self.single_flight.coalesced, 0)
+
+    def test_calls_during_deferred_are_coalesced(self):
+        deferred = Deferred()
+        result, coalesced = self.single_flight.run("a", lambda: deferred)
+        self.assertTrue(result is deferred)
+        self.assertFalse(coalesced)
+        waiting = [self.single_flight.run("a", lambda: "again")
+                   for _ in xrange(3)]
+        other, coalesced = self.single_flight.run("b", lambda: "b")
+        self.assertEqual((other, coalesced), ("b", False))
+        for shared, coalesced in waiting:
+            self.assertTrue(coalesced)
+            self.assertFalse(shared.completed)
+        deferred.resolve("data")
+        for shared, _ in waiting:
+            self.assertEqual(shared.result, "data")
+        self.assertEqual(self.single_flight.calls, 2)
+        self.assertEqual(self.single_flight.coalesced, 3)
+        # Once landed, the next call runs again
+        self.assertEqual(self.single_flight.run("a", lambda: "again"),
+                         ("again", False))
+
+    def test_deferred_failure_fans_out(self):
+        deferred = Deferred()
+        self.single_flight.run("a", lambda: deferred)
+        shared, _ = self.single_flight.run("a", lambda: "again")
+        error = IOError("backend down")
+        deferred.fail(error)
+        self.assertTrue(shared.error is error)
+
+    def test_calls_during_running_function_are_coalesced(self):
+        started = threading.Event()
+        release = threading.Event()
+        waiting = []
+
+        def function():
+            started.set()
+            release.wait()
+            raise IOError("backend down")
+
+        def leader():
+            self.assertRaises(IOError, self.single_flight.run, "a", function)
+
+        thread = threading.Thread(target=leader)
+        thread.start()
+        started.wait()
+        waiting.append(self.single_flight.run("a", lambda: "again"))
+        release.set()
+        thread.join()
+        shared, coalesced = waiting[0]
+        self.assertTrue(coalesced)
+        self.assertTrue(isinstance(shared.error, IOError))
+        self.assertEqual(self.single_flight.in_flight, {})
@@ -0,0 +1,43 @@
+import os
+import sys
+import time
+import unittest
+sys.path.append(os.path.join(os.path.dirname(__file__), "../emmer"))
+
+from supervisor import Supervisor
+
+
+def run_forever():
+    while True:
+        time.sleep(1)
+
+
+class TestSupervisor(unittest.TestCase):
+    def test_spawn_workers(self):
+        supervisor = Supervisor(2, run_forever, restart_delay=0)
+        supervisor.spawn_workers()
+        self.assertEqual(len(supervisor.workers), 2)
+        supervisor.stop()
+        self.assertEqual(supervisor.workers, set())
+
+    def test_restart_dead_worker(self):
+        supervisor = Supervisor(2, run_forever, restart_delay=0)
+        supervisor.spawn_workers()
+        dead_worker = min(supervisor.workers)
+        os.kill(dead_worker, 9)
+        supervisor.wait_and_restart()
+        self.assertEqual(len(supervisor.workers), 2)
+        self.assertFalse(dead_worker in supervisor.workers)
+        supervisor.stop()
+
+    def test_restart_worker_that_returns(self):
+        supervisor = Supervisor(1, lambda: None, restart_delay=0)
+        first_worker = supervisor.spawn_worker()
+        supervisor.wait_and_restart()
+        self.assertEqual(len(supervisor.workers), 1)
+        self.assertFalse(first_worker in supervisor.workers)
+        supervisor.stop()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,8 +5,10 @@ sys.path.append(os.path.join(os.path.dirname(__file__), "../emmer"))
 
 import packets
 import tftp_conversation
+from deferred import Deferred
+from worker_pool import WorkerPoolFull
 from tftp_conversation import TFTPConversation
-from response_router import WriteBuffer
+from response_router import ResponseRouter, WriteBuffer
 
 # A set of stub readers
 class StubResponseRouter(object):
@@ -16,9 +18,14 @@ class StubResponseRouter(object):
         return WriteBuffer()
 
 class StubReadBuffer(object):
-    def get_block_count(self):
+    rate_limit = None
+    def release(self, block_num):
+        pass
+    def close(self):
+        pass
+    def get_block_count(self, block_size=512):
         return 1
-    def get_block(self, block_num):
+    def get_block(self, block_num, block_size=512):
         if block_num == 1:
             return "abcde"
 
@@ -29,10 +36,10 @@ class StubResponseRouterTwo(object):
     def initialize_write(self, urn, client_host, client_port):
         return StubWriteBufferTwo()
 
-class StubReadBufferTwo(object):
-    def get_block_count(self):
+class StubReadBufferTwo(StubReadBuffer):
+    def get_block_count(self, block_size=512):
         return 3
-    def get_block(self, block_num):
+    def get_block(self, block_num, block_size=512):
         # This won't be used to test any initial state
         assert block_num != 1
         if block_num == 2:
@@ -44,6 +51,21 @@ class StubWriteBufferTwo(object):
     def receive_data(self, data):
         self.data = data
 
+# Stub reader for actions that return a Deferred
+class DeferredResponseRouterStub(object):
+    def __init__(self):
+        self.deferred = Deferred()
+    def initialize_read(self, urn, client_host, client_port):
+        return self.deferred
+
+# Stub reader for a full action pool
+class BusyResponseRouterStub(object):
+    def initialize_read(self, urn, client_host, client_port):
+        raise WorkerPoolFull()
+
+def busy_write_action(host, port, filename, data):
+    raise WorkerPoolFull()
+
 # Stub reader for no action case
 class NoActionAvailableResponseRouterStub(object):
     def initialize_read(self, urn, client_host, client_port):
@@ -121,6 +143,88 @@ class TestTFTPConversationRead(unittest.TestCase):
         self.assertEqual(response_packet.__class__, packets.DataPacket)
         self.assertEqual(conversation.cached_packet, response_packet)
 
+    def test_begin_reading_with_full_action_pool(self):
+        packet = packets.ReadRequestPacket("example_filename", "netascii")
+        conversation = TFTPConversation(self.client_host, self.client_port,
+                                        BusyResponseRouterStub())
+        response_packet = conversation.handle_packet(packet)
+
+        self.assertEqual(conversation.state, tftp_conversation.COMPLETED)
+        self.assertEqual(response_packet.__class__, packets.ErrorPacket)
+        self.assertEqual(response_packet.error_code, 0)
+
+    def test_begin_reading_with_deferred_action(self):
+        packet = packets.ReadRequestPacket("example_filename", "netascii")
+        router = DeferredResponseRouterStub()
+        conversation = TFTPConversation(self.client_host, self.client_port,
+                                        router)
+        response_packet = conversation.handle_packet(packet)
+
+        self.assertEqual(conversation.state, tftp_conversation.PENDING)
+        self.assertEqual(conversation.pending_action, router.deferred)
+        self.assertEqual(response_packet.__class__, packets.NoOpPacket)
+
+        # Retransmitted requests are ignored while the action is outstanding
+        response_packet = conversation.handle_packet(packet)
+        self.assertEqual(conversation.state, tftp_conversation.PENDING)
+        self.assertEqual(response_packet.__class__, packets.NoOpPacket)
+
+        router.deferred.resolve(StubReadBuffer())
+        response_packet = conversation.resume()
+        self.assertEqual(conversation.state, tftp_conversation.READING)
+        self.assertEqual(conversation.current_block_num, 1)
+        self.assertEqual(response_packet.__class__, packets.DataPacket)
+        self.assertEqual(response_packet.data, "abcde")
+        self.assertEqual(conversation.cached_packet, response_packet)
+        self.assertIsNone(conversation.pending_action)
+
+    def test_resume_with_failed_action(self):
+        packet = packets.ReadRequestPacket("example_filename", "netascii")
+        router = DeferredResponseRouterStub()
+        conversation = TFTPConversation(self.client_host, self.client_port,
+                                        router)
+        conversation.handle_packet(packet)
+        router.deferred.fail(ValueError("backend unavailable"))
+        response_packet = conversation.resume()
+
+        self.assertEqual(conversation.state, tftp_conversation.COMPLETED)
+        self.assertEqual(response_packet.__class__, packets.ErrorPacket)
+        self.assertEqual(response_packet.error_code, 0)
+
+    def test_resume_with_full_action_pool(self):
+        packet = packets.ReadRequestPacket("example_filename", "netascii")
+        router = DeferredResponseRouterStub()
+        conversation = TFTPConversation(self.client_host, self.client_port,
+                                        router)
+        conversation.handle_packet(packet)
+        router.deferred.fail(WorkerPoolFull("16 tasks already waiting"))
+        response_packet = conversation.resume()
+
+        self.assertEqual(conversation.state, tftp_conversation.COMPLETED)
+        self.assertEqual(response_packet.error_code, 0)
+        self.assertTrue(response_packet.error_message.startswith(
+            "Server busy"))
+
+    def test_resume_without_file(self):
+        packet = packets.ReadRequestPacket("example_filename", "netascii")
+        router = DeferredResponseRouterStub()
+        conversation = TFTPConversation(self.client_host, self.client_port,
+                                        router)
+        conversation.handle_packet(packet)
+        router.deferred.resolve(None)
+        response_packet = conversation.resume()
+
+        self.assertEqual(conversation.state, tftp_conversation.COMPLETED)
+        self.assertEqual(response_packet.__class__, packets.ErrorPacket)
+        self.assertEqual(response_packet.error_code, 1)
+
+    def test_resume_when_not_pending(self):
+        conversation = TFTPConversation(self.client_host, self.client_port,
+                                        StubResponseRouter())
+        response_packet = conversation.resume()
+        self.assertEqual(conversation.state, tftp_conversation.UNINITIALIZED)
+        self.assertEqual(response_packet.__class__, packets.NoOpPacket)
+
     def test_continue_reading(self):
         packet = packets.AcknowledgementPacket(1)
         conversation = TFTPConversation(self.client_host, self.client_port,
@@ -149,6 +253,10 @@ class TestTFTPConversationRead(unittest.TestCase):
         self.assertEqual(conversation.state, tftp_conversation.COMPLETED)
         self.assertEqual(response_packet.__class__, packets.NoOpPacket)
         self.assertEqual(conversation.cached_packet, response_packet)
+        self.assertIsNone(conversation.read_buffer)
+        # A duplicate of the final acknowledgement is ignored
+        response_packet = conversation.handle_packet(packet)
+        self.assertEqual(response_packet.__class__, packets.NoOpPacket)
 
     def test_illegal_packet_type_during_reading_state(self):
         packet = packets.DataPacket(2, "")
@@ -244,6 +352,48 @@ class TestTFTPConversationWrite(unittest.TestCase):
         # action should get invoked, saving this state in the wrapper class
         self.assertEqual(write_action_wrapper.received_state,
             ("10.26.0.3", 12345, "stub_filename", "X" * 512 + "O" * 511))
+        self.assertIsNone(conversation.write_buffer)
+
+    def test_duplicate_final_data_after_writing(self):
+        conversation = TFTPConversation(self.client_host, self.client_port,
+                                        StubResponseRouterTwo())
+        conversation.state = tftp_conversation.WRITING
+        conversation.write_buffer = WriteBuffer()
+        conversation.filename = "stub_filename"
+        conversation.current_block_num = 0
+        write_action_wrapper = StubWriteActionWrapper()
+        conversation.write_action = write_action_wrapper.stub_action
+        conversation.handle_packet(packets.DataPacket(1, "O" * 511))
+        self.assertEqual(conversation.state, tftp_conversation.COMPLETED)
+
+        # The acknowledgement got lost, so the client sends the block again
+        response_packet = conversation.handle_packet(
+            packets.DataPacket(1, "O" * 511))
+        self.assertEqual(response_packet.__class__,
+                         packets.AcknowledgementPacket)
+        self.assertEqual(response_packet.block_num, 1)
+        response_packet = conversation.handle_packet(
+            packets.DataPacket(2, "O" * 511))
+        self.assertEqual(response_packet.__class__, packets.NoOpPacket)
+        response_packet = conversation.handle_packet(
+            packets.AcknowledgementPacket(1))
+        self.assertEqual(response_packet.__class__, packets.NoOpPacket)
+        self.assertEqual(conversation.state, tftp_conversation.COMPLETED)
+
+    def test_finish_writing_with_full_action_pool(self):
+        packet = packets.DataPacket(1, "O" * 511)
+        conversation = TFTPConversation(self.client_host, self.client_port,
+                                        StubResponseRouterTwo())
+        conversation.state = tftp_conversation.WRITING
+        conversation.write_buffer = WriteBuffer()
+        conversation.filename = "stub_filename"
+        conversation.current_block_num = 0
+        conversation.write_action = busy_write_action
+        response_packet = conversation.handle_packet(packet)
+
+        self.assertEqual(conversation.state, tftp_conversation.COMPLETED)
+        self.assertEqual(response_packet.__class__, packets.ErrorPacket)
+        self.assertEqual(response_packet.error_code, 0)
 
     def test_illegal_packet_type_during_writing_state(self):
         packet = packets.AcknowledgementPacket(2)
@@ -272,5 +422,446 @@ class TestTFTPConversationWrite(unittest.TestCase):
         self.assertEqual(response_packet.__class__, packets.NoOpPacket)
 
 
+
+class TestTFTPConversationOptions(unittest.TestCase):
+    def setUp(self):
+        self.client_host = "10.26.0.3"
+        self.client_port = 12345
+        self.written = []
+        self.router = ResponseRouter()
+        self.router.append_read_rule(".*", lambda host, port, filename:
+                                     "X" * 3000)
+        self.router.append_write_rule(".*", lambda host, port, filename, data:
+                                      self.written.append(data))
+
+    def test_read_with_blksize(self):
+        conversation = TFTPConversation(self.client_host, self.client_port,
+                                        self.router)
+        packet = packets.ReadRequestPacket("example_filename", "octet",
+                                           {"BLKSIZE": "1428"})
+        response_packet = conversation.handle_packet(packet)
+        self.assertEqual(response_packet.__class__,
+                         packets.OptionAcknowledgementPacket)
+        self.assertEqual(response_packet.options, {"blksize": "1428"})
+        self.assertEqual(conversation.cached_packet, response_packet)
+
+        block_sizes = []
+        block_num = 0
+        while conversation.state == tftp_conversation.READING:
+            response_packet = conversation.handle_packet(
+                packets.AcknowledgementPacket(block_num))
+            if isinstance(response_packet, packets.DataPacket):
+                block_num = response_packet.block_num
+                block_sizes.append(len(response_packet.data))
+        self.assertEqual(block_sizes, [1428, 1428, 144])
+
+    def test_read_with_blksize_above_maximum(self):
+        conversation = TFTPConversation(self.client_host, self.client_port,
+                                        self.router, max_block_size=1024)
+        packet = packets.ReadRequestPacket("example_filename", "octet",
+                                           {"blksize": "65464"})
+        response_packet = conversation.handle_packet(packet)
+        self.assertEqual(response_packet.options, {"blksize": "1024"})
+        self.assertEqual(conversation.block_size, 1024)
+
+    def test_invalid_and_unknown_options_are_ignored(self):
+        for options in ({"blksize": "4"}, {"blksize": "many"},
+                        {"unknown": "1"}):
+            conversation = TFTPConversation(self.client_host,
+                                            self.client_port, self.router)
+            packet = packets.ReadRequestPacket("example_filename", "octet",
+                                               options)
+            response_packet = conversation.handle_packet(packet)
+            self.assertEqual(response_packet.__class__, packets.DataPacket)
+            self.assertEqual(len(response_packet.data), 512)
+
+    def test_write_with_blksize(self):
+        conversation = TFTPConversation(self.client_host, self.client_port,
+                                        self.router)
+        packet = packets.WriteRequestPacket("example_filename", "octet",
+                                            {"blksize": "1024"})
+        response_packet = conversation.handle_packet(packet)
+        self.assertEqual(response_packet.__class__,
+                         packets.OptionAcknowledgementPacket)
+        self.assertEqual(response_packet.options, {"blksize": "1024"})
+
+        # A 512 byte block no longer ends the transfer
+        conversation.handle_packet(packets.DataPacket(1, "X" * 1024))
+        conversation.handle_packet(packets.DataPacket(2, "X" * 512))
+        self.assertEqual(conversation.state, tftp_conversation.COMPLETED)
+        self.assertEqual(self.written, ["X" * 1536])
+
+    def test_read_with_windowsize(self):
+        conversation = TFTPConversation(self.client_host, self.client_port,
+                                        self.router)
+        packet = packets.ReadRequestPacket("example_filename", "octet",
+                                           {"blksize": "256",
+                                            "windowsize": "4"})
+        response_packet = conversation.handle_packet(packet)
+        self.assertEqual(response_packet.options,
+                         {"blksize": "256", "windowsize": "4"})
+
+        window = conversation.handle_packet(packets.AcknowledgementPacket(0))
+        self.assertEqual([packet.block_num for packet in window],
+                         [1, 2, 3, 4])
+        self.assertEqual(conversation.cached_packet, window)
+
+        # Acknowledgements within the window are ignored
+        response_packet = conversation.handle_packet(
+            packets.AcknowledgementPacket(5))
+        self.assertEqual(response_packet.__class__, packets.NoOpPacket)
+
+        window = conversation.handle_packet(packets.AcknowledgementPacket(4))
+        self.assertEqual([packet.block_num for packet in window],
+                         [5, 6, 7, 8])
+
+        # The client lost block 7, so the next window starts from it
+        window = conversation.handle_packet(packets.AcknowledgementPacket(6))
+        self.assertEqual([packet.block_num for packet in window],
+                         [7, 8, 9, 10])
+
+        # Stale acknowledgements are ignored
+        response_packet = conversation.handle_packet(
+            packets.AcknowledgementPacket(4))
+        self.assertEqual(response_packet.__class__, packets.NoOpPacket)
+
+        # The last window is cut short at the last block
+        window = conversation.handle_packet(packets.AcknowledgementPacket(10))
+        self.assertEqual([(packet.block_num, len(packet.data))
+                          for packet in window], [(11, 256), (12, 184)])
+        conversation.handle_packet(packets.AcknowledgementPacket(12))
+        self.assertEqual(conversation.state, tftp_conversation.COMPLETED)
+
+    def test_windowsize_above_maximum(self):
+        conversation = TFTPConversation(self.client_host, self.client_port,
+                                        self.router, max_window_size=2)
+        packet = packets.ReadRequestPacket("example_filename", "octet",
+                                           {"windowsize": "16"})
+        response_packet = conversation.handle_packet(packet)
+        self.assertEqual(response_packet.options, {"windowsize": "2"})
+        window = conversation.handle_packet(packets.AcknowledgementPacket(0))
+        self.assertEqual([packet.block_num for packet in window], [1, 2])
+
+    def test_windowsize_ignored_for_writes(self):
+        conversation = TFTPConversation(self.client_host, self.client_port,
+                                        self.router)
+        packet = packets.WriteRequestPacket("example_filename", "octet",
+                                            {"windowsize": "16"})
+        response_packet = conversation.handle_packet(packet)
+        self.assertEqual(response_packet.__class__,
+                         packets.AcknowledgementPacket)
+
+    def test_timeout_option(self):
+        for options, timeout in (({"timeout": "3"}, 3),
+                                 ({"timeout": "0"}, None),
+                                 ({"timeout": "256"}, None)):
+            conversation = TFTPConversation(self.client_host,
+                                            self.client_port, self.router)
+            packet = packets.WriteRequestPacket("example_filename", "octet",
+                                                options)
+            conversation.handle_packet(packet)
+            self.assertEqual(conversation.timeout, timeout)
+
+    def test_round_trip_time_is_sampled(self):
+        conversation = TFTPConversation(self.client_host, self.client_port,
+                                        self.router)
+        conversation.handle_packet(
+            packets.ReadRequestPacket("example_filename", "octet"))
+        self.assertIsNone(conversation.rtt_estimator.smoothed_rtt)
+        conversation.time_of_last_interaction -= 0.5
+        conversation.handle_packet(packets.AcknowledgementPacket(1))
+        self.assertTrue(0.5 <= conversation.rtt_estimator.smoothed_rtt < 1)
+
+    def test_round_trip_time_not_sampled_after_resend(self):
+        conversation = TFTPConversation(self.client_host, self.client_port,
+                                        self.router)
+        conversation.handle_packet(
+            packets.ReadRequestPacket("example_filename", "octet"))
+        conversation.mark_retry()
+        conversation.handle_packet(packets.AcknowledgementPacket(1))
+        self.assertIsNone(conversation.rtt_estimator.smoothed_rtt)
+        # The backoff holds until a packet is answered without a resend
+        self.assertEqual(conversation.rtt_estimator.backoff, 1)
+        conversation.handle_packet(packets.AcknowledgementPacket(2))
+        self.assertEqual(conversation.rtt_estimator.backoff, 0)
+
+    def test_ignored_packet_keeps_cached_packet(self):
+        conversation = TFTPConversation(self.client_host, self.client_port,
+                                        self.router)
+        conversation.handle_packet(
+            packets.ReadRequestPacket("example_filename", "octet"))
+        data_packet = conversation.handle_packet(
+            packets.AcknowledgementPacket(1))
+        conversation.mark_retry()
+        response_packet = conversation.handle_packet(
+            packets.AcknowledgementPacket(1))
+        self.assertEqual(response_packet.__class__, packets.NoOpPacket)
+        self.assertEqual(conversation.cached_packet, data_packet)
+        self.assertEqual(conversation.retries_made, 1)
+
+    def test_client_refusing_oack(self):
+        conversation = TFTPConversation(self.client_host, self.client_port,
+                                        self.router)
+        packet = packets.ReadRequestPacket("example_filename", "octet",
+                                           {"blksize": "1024"})
+        conversation.handle_packet(packet)
+        response_packet = conversation.handle_packet(
+            packets.ErrorPacket(8, "Option refused"))
+        self.assertEqual(conversation.state, tftp_conversation.COMPLETED)
+        self.assertEqual(response_packet.__class__, packets.NoOpPacket)
+
+
+class TestTFTPConversationBlockRollover(unittest.TestCase):
+    def setUp(self):
+        self.client_host = "10.26.0.3"
+        self.client_port = 12345
+        # More than 65535 blocks of 8 bytes
+        self.data = "".join("%07d\n" % i for i in xrange(70000)) + "end"
+        self.written = []
+        self.router = ResponseRouter()
+        self.router.append_read_rule(".*", lambda host, port, filename:
+                                     self.data)
+        self.router.append_write_rule(".*", lambda host, port, filename, data:
+                                      self.written.append(data))
+
+    def read(self, block_rollover):
+        conversation = TFTPConversation(self.client_host, self.client_port,
+                                        self.router,
+                                        block_rollover=block_rollover)
+        packet = packets.ReadRequestPacket("example_filename", "octet",
+                                           {"blksize": "8",
+                                            "windowsize": "16"})
+        conversation.handle_packet(packet)
+        block_nums = []
+        received = []
+        window = conversation.handle_packet(packets.AcknowledgementPacket(0))
+        while conversation.state == tftp_conversation.READING:
+            if isinstance(window, packets.DataPacket):
+                window = [window]
+            block_nums.extend(packet.block_num for packet in window)
+            received.extend(packet.data for packet in window)
+            window = conversation.handle_packet(
+                packets.AcknowledgementPacket(window[-1].block_num))
+        self.assertEqual("".join(received), self.data)
+        return block_nums
+
+    def test_read_rolls_over_to_zero(self):
+        block_nums = self.read(0)
+        self.assertEqual(len(block_nums), 70001)
+        self.assertEqual(block_nums[65533:65538], [65534, 65535, 0, 1, 2])
+        self.assertEqual(block_nums[-1], 70001 - 65536)
+
+    def test_read_rolls_over_to_one(self):
+        block_nums = self.read(1)
+        self.assertEqual(len(block_nums), 70001)
+        self.assertEqual(block_nums[65533:65538], [65534, 65535, 1, 2, 3])
+        self.assertEqual(block_nums[-1], 70001 - 65535)
+
+    def test_stale_acknowledgement_after_rollover(self):
+        conversation = TFTPConversation(self.client_host, self.client_port,
+                                        self.router)
+        conversation.handle_packet(
+            packets.ReadRequestPacket("example_filename", "octet",
+                                      {"blksize": "8"}))
+        conversation.acked_block_num = 65534
+        conversation.current_block_num = 65535
+        response_packet = conversation.handle_packet(
+            packets.AcknowledgementPacket(65535))
+        self.assertEqual(response_packet.block_num, 0)
+        self.assertEqual(conversation.current_block_num, 65536)
+        # The acknowledgement of the block before is ignored rather than
+        # taken for a block that was never sent
+        response_packet = conversation.handle_packet(
+            packets.AcknowledgementPacket(65535))
+        self.assertEqual(response_packet.__class__, packets.NoOpPacket)
+        response_packet = conversation.handle_packet(
+            packets.AcknowledgementPacket(0))
+        self.assertEqual(response_packet.block_num, 1)
+        self.assertEqual(response_packet.data,
+                         self.data[65536 * 8:65537 * 8])
+
+    def test_acknowledgement_of_block_65535_rolling_over_to_one(self):
+        conversation = TFTPConversation(self.client_host, self.client_port,
+                                        self.router, block_rollover=1)
+        conversation.handle_packet(
+            packets.ReadRequestPacket("example_filename", "octet",
+                                      {"blksize": "8", "windowsize": "2"}))
+        conversation.acked_block_num = 65532
+        conversation.current_block_num = 65533
+        window = conversation.handle_packet(
+            packets.AcknowledgementPacket(65533))
+        self.assertEqual([packet.block_num for packet in window],
+                         [65534, 65535])
+        window = conversation.handle_packet(
+            packets.AcknowledgementPacket(65535))
+        self.assertEqual([packet.block_num for packet in window], [1, 2])
+        self.assertEqual(conversation.acked_block_num, 65535)
+
+    def test_write_rolls_over(self):
+        for block_rollover in (0, 1):
+            conversation = TFTPConversation(self.client_host,
+                                            self.client_port, self.router,
+                                            block_rollover=block_rollover)
+            conversation.handle_packet(
+                packets.WriteRequestPacket("example_filename", "octet"))
+            conversation.current_block_num = 65534
+            response_packet = conversation.handle_packet(
+                packets.DataPacket(65535, "X" * 512))
+            self.assertEqual(response_packet.block_num, 65535)
+            # The block number that does not follow is ignored
+            response_packet = conversation.handle_packet(
+                packets.DataPacket(1 - block_rollover, "X" * 512))
+            self.assertEqual(response_packet.__class__, packets.NoOpPacket)
+            response_packet = conversation.handle_packet(
+                packets.DataPacket(block_rollover, "X" * 512))
+            self.assertEqual(response_packet.block_num, block_rollover)
+            response_packet = conversation.handle_packet(
+                packets.DataPacket(block_rollover + 1, "end"))
+            self.assertEqual(response_packet.block_num, block_rollover + 1)
+            self.assertEqual(conversation.state, tftp_conversation.COMPLETED)
+        self.assertEqual(self.written, ["X" * 1024 + "end"] * 2)
+
+
+class TestTFTPConversationStreamingRead(unittest.TestCase):
+    def setUp(self):
+        self.client_host = "10.26.0.3"
+        self.client_port = 12345
+        self.router = ResponseRouter()
+        self.closed = []
+
+    def stream(self, chunks, fail_after=None):
+        try:
+            for i in xrange(chunks):
+                if i == fail_after:
+                    raise IOError("disk on fire")
+                yield "X" * 300
+        finally:
+            self.closed.append(True)
+
+    def test_stream_with_windowsize(self):
+        self.router.append_read_rule(".*", lambda host, port, filename:
+                                     self.stream(10))
+        conversation = TFTPConversation(self.client_host, self.client_port,
+                                        self.router)
+        conversation.handle_packet(packets.ReadRequestPacket(
+            "example_filename", "octet", {"windowsize": "2"}))
+        data = ""
+        block_num = 0
+        while conversation.state == tftp_conversation.READING:
+            window = conversation.handle_packet(
+                packets.AcknowledgementPacket(block_num))
+            if isinstance(window, packets.NoOpPacket):
+                break
+            if not isinstance(window, list):
+                window = [window]
+            for packet in window:
+                data += packet.data
+                block_num = packet.block_num
+            if conversation.read_buffer:
+                # Only the blocks of the window are held
+                self.assertTrue(len(conversation.read_buffer.blocks) <= 2)
+        self.assertEqual(data, "X" * 3000)
+        self.assertEqual(block_num, 6)
+        self.assertEqual(conversation.state, tftp_conversation.COMPLETED)
+        self.assertEqual(self.closed, [True])
+
+    def test_stream_failure(self):
+        self.router.append_read_rule(".*", lambda host, port, filename:
+                                     self.stream(10, fail_after=3))
+        conversation = TFTPConversation(self.client_host, self.client_port,
+                                        self.router)
+        response_packet = conversation.handle_packet(
+            packets.ReadRequestPacket("example_filename", "octet", {}))
+        self.assertEqual(response_packet.data, "X" * 512)
+        response_packet = conversation.handle_packet(
+            packets.AcknowledgementPacket(1))
+        self.assertEqual(response_packet.__class__, packets.ErrorPacket)
+        self.assertEqual(response_packet.error_code, 0)
+        self.assertEqual(conversation.state, tftp_conversation.COMPLETED)
+
+
+class RecordingWriteSink(object):
+    def __init__(self, fail_on_write=False):
+        self.fail_on_write = fail_on_write
+        self.blocks = []
+        self.closed = False
+        self.aborted = False
+
+    def write(self, data):
+        if self.fail_on_write:
+            raise IOError("disk full")
+        self.blocks.append(data)
+
+    def close(self):
+        self.closed = True
+
+    def abort(self):
+        self.aborted = True
+
+
+class TestTFTPConversationWriteSink(unittest.TestCase):
+    def setUp(self):
+        self.client_host = "10.26.0.3"
+        self.client_port = 12345
+        self.sinks = []
+        self.router = ResponseRouter()
+        self.router.append_write_sink_rule("fail.*", self.create_failing_sink)
+        self.router.append_write_sink_rule(".*", self.create_sink)
+
+    def create_sink(self, client_host, client_port, filename):
+        self.sinks.append(RecordingWriteSink())
+        return self.sinks[-1]
+
+    def create_failing_sink(self, client_host, client_port, filename):
+        self.sinks.append(RecordingWriteSink(fail_on_write=True))
+        return self.sinks[-1]
+
+    def start(self, filename):
+        conversation = TFTPConversation(self.client_host, self.client_port,
+                                        self.router)
+        response_packet = conversation.handle_packet(
+            packets.WriteRequestPacket(filename, "octet", {}))
+        self.assertEqual(response_packet.block_num, 0)
+        return conversation
+
+    def test_blocks_go_to_sink(self):
+        conversation = self.start("crash.dump")
+        sink = self.sinks[0]
+        self.assertIsNone(conversation.write_buffer)
+        conversation.handle_packet(packets.DataPacket(1, "X" * 512))
+        # Duplicates are not written twice
+        conversation.handle_packet(packets.DataPacket(1, "X" * 512))
+        self.assertEqual(sink.blocks, ["X" * 512])
+        self.assertFalse(sink.closed)
+        response_packet = conversation.handle_packet(
+            packets.DataPacket(2, "O" * 10))
+        self.assertEqual(response_packet.block_num, 2)
+        self.assertEqual(sink.blocks, ["X" * 512, "O" * 10])
+        self.assertTrue(sink.closed)
+        self.assertFalse(sink.aborted)
+        self.assertEqual(conversation.state, tftp_conversation.COMPLETED)
+
+    def test_sink_failure(self):
+        conversation = self.start("fail.dump")
+        response_packet = conversation.handle_packet(
+            packets.DataPacket(1, "X" * 512))
+        self.assertEqual(response_packet.__class__, packets.ErrorPacket)
+        self.assertEqual(conversation.state, tftp_conversation.COMPLETED)
+        self.assertTrue(self.sinks[0].aborted)
+
+    def test_client_error_aborts_sink(self):
+        conversation = self.start("crash.dump")
+        conversation.handle_packet(packets.DataPacket(1, "X" * 512))
+        conversation.handle_packet(packets.ErrorPacket(0, "cancelled"))
+        self.assertTrue(self.sinks[0].aborted)
+        self.assertFalse(self.sinks[0].closed)
+
+    def test_give_up_aborts_sink(self):
+        conversation = self.start("crash.dump")
+        conversation.give_up()
+        self.assertEqual(conversation.state, tftp_conversation.COMPLETED)
+        self.assertTrue(self.sinks[0].aborted)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,130 @@
+import os
+import sys
+import threading
+import unittest
+sys.path.append(os.path.join(os.path.dirname(__file__), "../emmer"))
+
+from worker_pool import ProcessWorkerPool, WorkerPool, WorkerPoolFull
+
+
+def multiply(x, y):
+    return x * y
+
+
+def divide(x, y):
+    return x / y
+
+
+def unpicklable(*args):
+    return threading.Lock()
+
+
+class TestWorkerPool(unittest.TestCase):
+    def test_submit(self):
+        pool = WorkerPool(2)
+        pool.start()
+        done = threading.Event()
+        results = []
+
+        def task(value):
+            results.append(value)
+            done.set()
+
+        pool.submit(task, 42)
+        done.wait(5)
+        self.assertEqual(results, [42])
+        self.assertEqual(len(pool.threads), 2)
+        self.assertEqual(pool.tasks_started, 1)
+
+    def test_failing_task_does_not_kill_worker(self):
+        pool = WorkerPool(1)
+        pool.start()
+        done = threading.Event()
+
+        def failing_task():
+            raise ValueError("stub failure")
+
+        pool.submit(failing_task)
+        pool.submit(done.set)
+        self.assertTrue(done.wait(5))
+
+    def test_defer(self):
+        pool = WorkerPool(1)
+        pool.start()
+        done = threading.Event()
+        deferred = pool.defer(multiply, 6, 7)
+        deferred.add_callback(lambda deferred: done.set())
+        self.assertTrue(done.wait(5))
+        self.assertEqual(deferred.result, 42)
+
+    def test_defer_failure(self):
+        pool = WorkerPool(1)
+        pool.start()
+        done = threading.Event()
+        deferred = pool.defer(divide, 1, 0)
+        deferred.add_callback(lambda deferred: done.set())
+        self.assertTrue(done.wait(5))
+        self.assertTrue(isinstance(deferred.error, ZeroDivisionError))
+
+    def test_full_queue(self):
+        # Without starting the pool, tasks stay queued
+        pool = WorkerPool(1, 2)
+        pool.submit(multiply, 1, 2)
+        pool.defer(multiply, 1, 2)
+        self.assertEqual(pool.queue_depth, 2)
+        self.assertRaises(WorkerPoolFull, pool.submit, multiply, 1, 2)
+        self.assertRaises(WorkerPoolFull, pool.defer, multiply, 1, 2)
+        self.assertEqual(pool.queue_depth, 2)
+        self.assertEqual(pool.tasks_rejected, 2)
+
+    def test_wait_time(self):
+        pool = WorkerPool(1)
+        self.assertEqual(pool.average_wait_time, 0.0)
+        pool._record_wait(1.0)
+        pool._record_wait(3.0)
+        self.assertEqual(pool.tasks_started, 2)
+        self.assertEqual(pool.average_wait_time, 2.0)
+        self.assertEqual(pool.max_wait_time, 3.0)
+
+
+class TestProcessWorkerPool(unittest.TestCase):
+    def test_defer(self):
+        pool = ProcessWorkerPool(1)
+        pool.start()
+        done = threading.Event()
+        success = pool.defer(multiply, 6, 7)
+        failure = pool.defer(divide, 1, 0)
+        failure.add_callback(lambda deferred: done.set())
+        self.assertTrue(done.wait(10))
+        self.assertEqual(success.result, 42)
+        self.assertTrue("ZeroDivisionError" in str(failure.error))
+        self.assertEqual(pool.tasks_started, 2)
+        self.assertEqual(pool.tasks_pending, 0)
+        pool.pool.terminate()
+
+    def test_unpicklable_task_and_result(self):
+        pool = ProcessWorkerPool(1, 1)
+        pool.start()
+        done = threading.Semaphore(0)
+        deferreds = [pool.defer(unpicklable),
+                     pool.defer(multiply, threading.Lock(), 2)]
+        for deferred in deferreds:
+            deferred.add_callback(lambda deferred: done.release())
+        for _ in deferreds:
+            done.acquire()
+        for deferred in deferreds:
+            self.assertIsNotNone(deferred.error)
+        self.assertEqual(pool.tasks_pending, 0)
+        self.assertEqual(pool.in_flight, {})
+        pool.pool.terminate()
+
+    def test_full_queue(self):
+        pool = ProcessWorkerPool(1, 1)
+        pool.tasks_pending = 2
+        self.assertEqual(pool.queue_depth, 1)
+        self.assertRaises(WorkerPoolFull, pool.defer, multiply, 1, 2)
+        self.assertEqual(pool.tasks_rejected, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()